@@ -1,54 +1,479 @@
+# Imported first so its clock starts as close to the process start as possible
+from startup import startup_profile
 import os
-import json
 import logging
+import threading
+import time
+from functools import partial
 from dotenv import load_dotenv
-from concurrent.futures import ThreadPoolExecutor
-from slack_sdk import WebClient
+from concurrent.futures import ThreadPoolExecutor, wait
 from slack_sdk.errors import SlackApiError
-from azure_support import AzureSupportHelper
-from azure.identity import DefaultAzureCredential
+from azure_support import AzureSupportHelper, dataset_services_mapped_path, load_dataset_services_mapped
+from catalog import LiveServiceCatalog, ServiceCatalog, load_support_services
 from slack_bolt import App
-from handlers import OptionsHandler, SupportTicketSubmissionHandler
-from helpers import Blocks, BlockLoader, Shortcuts
+from slack_bolt.authorization import AuthorizeResult
+from handlers import LOADING_VALUE, OptionsHandler, SupportTicketSubmissionHandler
+from helpers import Blocks, BlockLoader, Shortcuts, escape_mrkdwn
+from diagnostics import Diagnostics
+from attachments import AttachmentUploader, UploadProgressStore, attachment_uploads_db_path
+from options_throttle import OptionsThrottle
+from prefetch import PredictivePrefetcher, PrefetchHistoryStore, prefetch_history_db_path
+from lazy_imports import lazy_import, resolve_lazy_imports
+from leader import LeaderElection, SharedSnapshot, shared_state_dir
+from metrics import (
+    InstrumentedExecutor, ListenerExecutor, bolt_metrics_middleware, close_multiprocess_metrics,
+    configure_multiprocess_metrics, register_executor, start_metrics_server
+)
+from slack_client import RateLimitedWebClient
+from serialization import decode_private_metadata
+from structured_logging import configure_logging_from_env, log_event
+from view_model import ModalView
+from tracing import TracedCredential, bolt_tracing_middleware, configure_tracing_from_env, submit_with_context
+from ticket_drafts import TicketDrafts
+from ticket_fanout import MAX_TARGETS, TicketFanOut, get_ticket_targets
+from ticket_index import TicketIndex, ticket_index_db_path
+from ticket_sync import TicketSyncEngine, TicketSyncStore, ticket_sync_db_path
+from token_cache import ARM_SCOPE, CachingCredential, TokenFileCache
+from workspaces import (
+    WorkspaceConfig, WorkspaceInstallationStore, get_current_team_id, load_workspaces, set_cache_quota,
+    workspace_middleware
+)
+
+DefaultAzureCredential = lazy_import('azure.identity', 'DefaultAzureCredential')
+ClientSecretCredential = lazy_import('azure.identity', 'ClientSecretCredential')
 
-# Logger setup
-logging.basicConfig(level=logging.DEBUG)
-logging.getLogger('azure').setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
 
-load_dotenv(dotenv_path=".env")
 
-slack_bot_token = os.environ['SLACK_BOT_TOKEN']
-client = WebClient(slack_bot_token)
-app = App(
-    token=slack_bot_token,
-    signing_secret=os.environ["SLACK_SIGNING_SECRET"])
+def _get_workspace_path(path, workspace):
+    if workspace is None:
+        return path
+    root, ext = os.path.splitext(path)
+    return f'{root}.{workspace.team_id}{ext}'
+
+
+class AppServices:
+    """Dependencies of the Slack listeners in one workspace.
+
+    The slow parts (Slack auth, Azure credential, service dataset, Azure SDK
+    imports) start in parallel when this is created; each property only waits
+    for what it needs, so nothing blocks the import of this module.
+
+    Further workspaces get their own Slack client, Azure credential and
+    caches, and share the executors, the throttle and the service catalog of
+    the first one, `shared`.
+    """
+
+    def __init__(self, client, slack_bot_token, workspace: WorkspaceConfig = None, shared: 'AppServices' = None):
+        self.client = client
+        self.slack_bot_token = slack_bot_token
+        self.workspace = workspace
+        self.shared = shared
+        self.cache_partition = workspace.team_id if workspace else None
+        if workspace is not None and workspace.cache_quota_mb:
+            set_cache_quota(self.cache_partition, workspace.cache_quota_mb * 1024 * 1024)
+        self.ticket_sync_store = TicketSyncStore(
+            _get_workspace_path(os.environ.get('TICKET_SYNC_DB', ticket_sync_db_path), workspace))
+        self.ticket_index = TicketIndex(
+            _get_workspace_path(os.environ.get('TICKET_INDEX_DB', ticket_index_db_path), workspace))
+        self.subscriptions_snapshot = SharedSnapshot(_get_workspace_path(
+            os.path.join(os.environ.get('SHARED_STATE_DIR', shared_state_dir), 'subscriptions.json'), workspace))
+        self.diagnostics = Diagnostics(
+            self, [u.strip() for u in os.environ.get('ADMIN_USER_IDS', '').split(',') if u.strip()])
+        self.init_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='init')
+        self.init_futures = []
+        if shared is not None:
+            self.executor = shared.executor
+            self.options_throttle = shared.options_throttle
+            self._init_workspace_services()
+            return
+
+        self.executor = InstrumentedExecutor()
+        register_executor('executor', self.executor)
+        self.options_throttle = OptionsThrottle(
+            debounce_seconds=int(os.environ.get('OPTIONS_DEBOUNCE_MS', OptionsThrottle.DEBOUNCE_SECONDS * 1000)) / 1000,
+            user_rate=(int(os.environ.get('OPTIONS_USER_RATE', OptionsThrottle.USER_RATE[0])),
+                       OptionsThrottle.USER_RATE[1]),
+            workspace_rate=(int(os.environ.get('OPTIONS_WORKSPACE_RATE', OptionsThrottle.WORKSPACE_RATE[0])),
+                            OptionsThrottle.WORKSPACE_RATE[1]))
+        self.service_catalog_snapshot = SharedSnapshot(
+            os.path.join(os.environ.get('SHARED_STATE_DIR', shared_state_dir), 'service_catalog.json'))
+        self._service_catalog = self._init('service_catalog', self._load_service_catalog)
+        self._init('azure_sdk_imports', resolve_lazy_imports)
+        self._init_workspace_services()
+
+    def _init_workspace_services(self):
+        self._authorization = self._init('slack_auth', self._create_authorization)
+        self._azure_credentials = self._init('azure_credential', self._create_azure_credentials)
+        self._init('azure_token', self._warm_azure_token)
+        self._azure_support = self._init('azure_support', self._create_azure_support)
+        self._options_handler = self._init('options_handler', self._create_options_handler)
+        self._ticket_drafts = self._init('ticket_drafts', self._create_ticket_drafts)
+        self._prefetcher = self._init('prefetcher', self._create_prefetcher)
+        self._ticket_sync = self._init('ticket_sync', self._create_ticket_sync)
+        self._attachment_uploader = self._init('attachment_uploader', self._create_attachment_uploader)
+        self._ticket_fanout = self._init('ticket_fanout', self._create_ticket_fanout)
+        # Workers exit once the queued initialization is done
+        self.init_executor.shutdown(wait=False)
+
+    def _init(self, name, fn, *args):
+        def run():
+            with startup_profile.phase(name):
+                return fn(*args)
+        future = self.init_executor.submit(run)
+        self.init_futures.append(future)
+        return future
+
+    def _create_authorization(self):
+        return AuthorizeResult.from_auth_test_response(
+            auth_test_response=self.client.auth_test(), bot_token=self.slack_bot_token)
+
+    def _create_azure_credentials(self):
+        workspace = self.workspace
+        if workspace is not None and workspace.azure_client_secret:
+            credential = ClientSecretCredential(
+                workspace.azure_tenant_id, workspace.azure_client_id, workspace.azure_client_secret)
+        elif workspace is not None and workspace.azure_client_id:
+            credential = DefaultAzureCredential(managed_identity_client_id=workspace.azure_client_id)
+        else:
+            credential = DefaultAzureCredential()
+        # Tokens of different tenants must not share a file
+        token_cache_path = os.environ.get('AZURE_TOKEN_CACHE_FILE')
+        return CachingCredential(
+            TracedCredential(credential),
+            TokenFileCache(_get_workspace_path(token_cache_path, workspace)) if token_cache_path else None,
+            cache_partition=self.cache_partition)
+
+    def _warm_azure_token(self):
+        # Keeps the chain probing of the first token off the first request
+        try:
+            self.azure_credentials.get_token(ARM_SCOPE)
+        except Exception as e:
+            logger.warning('Failed to get an Azure token on startup: %s', e)
+
+    def _load_service_catalog(self):
+        return LiveServiceCatalog(ServiceCatalog(load_dataset_services_mapped(dataset_services_mapped_path)))
+
+    def _create_azure_support(self):
+        # The service catalog is loaded once and shared by all workspaces
+        return AzureSupportHelper(
+            self.azure_credentials, cache_partition=self.cache_partition,
+            service_catalog=(self.shared or self)._service_catalog.result(),
+            subscriptions_snapshot=self.subscriptions_snapshot)
+
+    def _create_options_handler(self):
+        return OptionsHandler(
+            self.azure_credentials,
+            self.azure_support,
+            deadline_seconds=int(os.environ.get('OPTIONS_DEADLINE_MS', OptionsHandler.DEADLINE_SECONDS * 1000)) / 1000,
+            executor=self.shared.options_handler.executor if self.shared else None,
+            cache_partition=self.cache_partition)
+
+    def _create_ticket_drafts(self):
+        return TicketDrafts(self.azure_support, self.executor, cache_partition=self.cache_partition)
+
+    def _create_prefetcher(self):
+        return PredictivePrefetcher(
+            PrefetchHistoryStore(_get_workspace_path(
+                os.environ.get('PREFETCH_HISTORY_DB', prefetch_history_db_path), self.workspace)),
+            self.options_handler,
+            top_combinations=int(os.environ.get('PREFETCH_TOP', PredictivePrefetcher.TOP_COMBINATIONS)),
+            executor=self.shared.prefetcher.executor if self.shared else None)
+
+    def _create_ticket_sync(self):
+        return TicketSyncEngine(
+            self.azure_credentials,
+            self.client,
+            self.ticket_sync_store,
+            poll_interval=int(os.environ.get('TICKET_SYNC_INTERVAL', TicketSyncEngine.POLL_INTERVAL)),
+            ticket_index=self.ticket_index)
+
+    def _create_attachment_uploader(self):
+        return AttachmentUploader(
+            self.azure_credentials,
+            self.slack_bot_token,
+            UploadProgressStore(_get_workspace_path(
+                os.environ.get('ATTACHMENT_UPLOADS_DB', attachment_uploads_db_path), self.workspace)))
+
+    def _create_ticket_fanout(self):
+        return TicketFanOut(
+            self.azure_support,
+            self.client,
+            executor=self.shared.ticket_fanout.executor if self.shared else None,
+            attachment_uploader=self.attachment_uploader,
+            workers=int(os.environ.get('TICKET_FANOUT_WORKERS', TicketFanOut.WORKERS)),
+            cache_partition=self.cache_partition)
+
+    def authorize(self):
+        # Used by Bolt instead of its own auth.test on startup
+        return self._authorization.result()
+
+    @property
+    def bot_id(self):
+        return self._authorization.result().bot_user_id
+
+    @property
+    def azure_credentials(self):
+        return self._azure_credentials.result()
+
+    @property
+    def service_catalog(self):
+        return (self.shared or self)._service_catalog.result()
+
+    @property
+    def azure_support(self):
+        return self._azure_support.result()
+
+    @property
+    def options_handler(self):
+        return self._options_handler.result()
+
+    @property
+    def ticket_drafts(self):
+        return self._ticket_drafts.result()
+
+    @property
+    def prefetcher(self):
+        return self._prefetcher.result()
+
+    @property
+    def ticket_sync(self):
+        return self._ticket_sync.result()
+
+    @property
+    def attachment_uploader(self):
+        return self._attachment_uploader.result()
+
+    @property
+    def ticket_fanout(self):
+        return self._ticket_fanout.result()
+
+    def is_initialized(self):
+        return all(f.done() for f in self.init_futures)
+
+    def wait_until_initialized(self):
+        wait(self.init_futures)
+        for future in self.init_futures:
+            future.result()
+
+
+class WorkspaceRouter:
+    """Services of the workspace the current request comes from.
+
+    Listeners keep using the module-level `services`; attributes resolve
+    against the workspace set by `workspace_middleware`, or the primary
+    workspace of SLACK_BOT_TOKEN outside of a request and for workspaces
+    without their own configuration.
+    """
+
+    def __init__(self, primary: AppServices, workspaces=()):
+        self.primary = primary
+        self.workspaces = {w.workspace.team_id: w for w in workspaces}
+
+    def current(self):
+        return self.workspaces.get(get_current_team_id(), self.primary)
+
+    def all(self):
+        return [self.primary, *self.workspaces.values()]
+
+    def authorize(self, team_id=None):
+        workspace = self.workspaces.get(team_id)
+        if workspace is not None:
+            return workspace.authorize()
+        authorization = self.primary.authorize()
+        # Without configured workspaces every request is served as before
+        if self.workspaces and team_id is not None and team_id != authorization.team_id:
+            logger.warning('Request from unknown workspace %s', team_id)
+            return None
+        return authorization
+
+    def is_initialized(self):
+        return all(w.is_initialized() for w in self.all())
+
+    def wait_until_initialized(self):
+        for w in self.all():
+            w.wait_until_initialized()
+
+    def __getattr__(self, name):
+        return getattr(self.current(), name)
+
+
+def _create_slack_client(token):
+    return RateLimitedWebClient(
+        token,
+        base_url=os.environ.get('SLACK_API_URL', RateLimitedWebClient.BASE_URL),
+        max_connections=int(os.environ.get('SLACK_MAX_CONNECTIONS', RateLimitedWebClient.MAX_CONNECTIONS)))
+
+
+services = None
+app = None
+election = None
+shutting_down = threading.Event()
+# Seconds between checks for what the elected process published, more often
+# until the first subscriptions arrive since the worker is not ready before
+FOLLOW_SECONDS = 10
+FOLLOW_SECONDS_UNTIL_LOADED = 0.5
+
+
+def create_app():
+    """Builds the Bolt app and starts initializing its dependencies in the
+    background."""
+    global services, app, election
+
+    load_dotenv(dotenv_path=".env")
+    configure_logging_from_env()
+    cassette_path = os.environ.get('AZURE_RECORD_CASSETTE')
+    if cassette_path:
+        # Development only, keeps the recorder's imports off normal startups
+        from cassettes import record_azure_traffic
+        record_azure_traffic(cassette_path)
+
+    slack_bot_token = os.environ['SLACK_BOT_TOKEN']
+    client = _create_slack_client(slack_bot_token)
+    primary = AppServices(client, slack_bot_token)
+    workspaces_path = os.environ.get('WORKSPACES_FILE')
+    installation_store = WorkspaceInstallationStore(load_workspaces(workspaces_path) if workspaces_path else [])
+    workspaces = []
+    for team_id, workspace in installation_store.workspaces.items():
+        bot_token = installation_store.find_bot(enterprise_id=None, team_id=team_id).bot_token
+        workspaces.append(AppServices(_create_slack_client(bot_token), bot_token, workspace, shared=primary))
+    services = WorkspaceRouter(primary, workspaces)
+    election = LeaderElection(os.path.join(os.environ.get('SHARED_STATE_DIR', shared_state_dir), 'leader.lock'))
+    listener_executor = ListenerExecutor()
+    register_executor('listener', listener_executor)
+    app = App(
+        client=client,
+        signing_secret=os.environ["SLACK_SIGNING_SECRET"],
+        authorize=authorize,
+        installation_store=installation_store,
+        listener_executor=listener_executor)
+    app.use(workspace_middleware)
+    app.use(shared_client_middleware)
+    app.use(bolt_tracing_middleware)
+    app.use(bolt_metrics_middleware)
+    register_listeners(app)
+    return app
+
+
+def shared_client_middleware(context, next):
+    # Bolt builds a plain WebClient per request. Listeners and `say` get
+    # the workspace's rate limited client instead, so their calls share its
+    # priorities, 429 retries, metrics and tracing. Runs after
+    # workspace_middleware, which picks the workspace.
+    context['client'] = services.client
+    context.pop('say', None)
+    return next()
+
+
+def authorize(team_id=None):
+    # Bolt passes arguments by the parameter names of this function, which
+    # for a bound method would include `self`.
+    return services.authorize(team_id)
+
+
+def _mark_ready_when_loaded():
+    for workspace in services.all():
+        workspace.azure_support.subscriptions_loaded.wait()
+    startup_profile.mark_ready()
+
+
+def start_background_services():
+    # Threads do not survive a fork, so a pre-forking server calls this in
+    # each worker after the app was created once in the master. Jobs that
+    # should run once per host run in the elected worker, the others load
+    # the subscriptions and service catalog it publishes.
+    configure_tracing_from_env()
+    metrics_dir = os.environ.get('METRICS_DIR')
+    if metrics_dir:
+        configure_multiprocess_metrics(metrics_dir)
+    for workspace in services.all():
+        workspace.azure_credentials.start()
+    election.start(_start_elected_services)
+    threading.Thread(target=_follow_elected_process, daemon=True).start()
+    threading.Thread(target=_mark_ready_when_loaded, daemon=True).start()
+
+
+def _start_elected_services():
+    for workspace in services.all():
+        workspace.azure_support.start()
+        workspace.ticket_sync.start()
+        workspace.attachment_uploader.start()
+    start_service_catalog_refresh()
+
+
+def _get_catalog_refresh_hours():
+    return float(os.environ.get('SERVICE_CATALOG_REFRESH_HOURS', LiveServiceCatalog.REFRESH_SECONDS / 3600))
+
+
+def _follow_elected_process():
+    while not election.is_leader.is_set():
+        try:
+            for workspace in services.all():
+                workspace.azure_support.load_subscription_snapshot()
+            catalog = services.primary.service_catalog_snapshot.read_if_changed() if _get_catalog_refresh_hours() else None
+            if catalog is not None:
+                services.primary.service_catalog.refresh(catalog)
+        except Exception as e:
+            logger.exception('Exception in loading the published snapshots: %s', e)
+        loaded = all(w.azure_support.subscriptions_loaded.is_set() for w in services.all())
+        election.is_leader.wait(FOLLOW_SECONDS if loaded else FOLLOW_SECONDS_UNTIL_LOADED)
+
+
+def _fetch_and_publish(fetch, snapshot):
+    services_list = fetch()
+    snapshot.publish(services_list)
+    return services_list
+
 
-azure_credentials = DefaultAzureCredential()
-azure_support = AzureSupportHelper(azure_credentials)
-options_handler = OptionsHandler(azure_credentials, azure_support)
+def start_service_catalog_refresh():
+    refresh_hours = _get_catalog_refresh_hours()
+    if not refresh_hours:
+        return
+    # A saved services list stands in for the Azure call locally
+    services_file = os.environ.get('SERVICE_CATALOG_FILE')
+    if services_file:
+        fetch = partial(load_support_services, services_file)
+    else:
+        fetch = partial(AzureSupportHelper.get_support_services, services.primary.azure_credentials)
+    services.primary.service_catalog.start(
+        partial(_fetch_and_publish, fetch, services.primary.service_catalog_snapshot), refresh_hours * 60 * 60)
+
+
+def is_ready():
+    return (not shutting_down.is_set()
+            and services.is_initialized()
+            and all(w.azure_support.subscriptions_loaded.is_set() for w in services.all()))
 
-BOT_ID = client.auth_test()['user_id']
-executor = ThreadPoolExecutor()
+
+def shutdown():
+    # Let queued ticket submissions, syncs and uploads finish before exit
+    shutting_down.set()
+    logger.info('Draining executors before shutdown')
+    workspaces = services.all()
+    services.executor.shutdown(wait=True)
+    services.ticket_fanout.executor.shutdown(wait=True)
+    for workspace in workspaces:
+        workspace.ticket_sync.executor.shutdown(wait=True)
+        workspace.attachment_uploader.executor.shutdown(wait=True)
+    # Options fetches only fill caches, the pools are shared by all workspaces
+    services.options_handler.executor.shutdown(wait=False, cancel_futures=True)
+    services.prefetcher.executor.shutdown(wait=False, cancel_futures=True)
+    close_multiprocess_metrics()
 
 
 def handle_contact_information(blocks, private_metadata):
     if private_metadata:
-        for i, b in enumerate(blocks):
-            if b['block_id'] == Blocks.BLOCK_ID_CONTACT_INFO_FULL_NAME:
-                blocks[i]['element']['initial_value'] = private_metadata['real_name']
-            elif b['block_id'] == Blocks.BLOCK_ID_CONTACT_INFO_EMAIL:
-                blocks[i]['element']['initial_value'] = private_metadata['email']
-        logger.debug(f'Contact info blocks after update: {blocks}')
+        view = ModalView(blocks)
+        view.set_initial_value(Blocks.BLOCK_ID_CONTACT_INFO_FULL_NAME, private_metadata['real_name'])
+        view.set_initial_value(Blocks.BLOCK_ID_CONTACT_INFO_EMAIL, private_metadata['email'])
+        blocks = view.blocks
+        # The blocks now hold the user's name and email, log their ids only
+        log_event(logger, logging.DEBUG, 'slack.contact_info_blocks', block_ids=[b.get('block_id') for b in blocks])
     return blocks
 
 
-def get_as_json(data):
-    return json.dumps(data)
-
-
 def get_private_metadata(body) -> dict:
-    return json.loads(body["view"].get("private_metadata", "{}"))
+    return decode_private_metadata(body["view"].get("private_metadata"))
 
 
 def update_private_metadata_from_action(body):
@@ -65,14 +490,13 @@ def update_private_metadata_from_action(body):
         elif 'selected_channel' in action:
             private_metadata[action['action_id']] = action['selected_channel']
     except Exception as e:
-        logger.exception(f"Exception in update_private_metadata_from_action: {e}")
+        logger.exception("Exception in update_private_metadata_from_action: %s", e)
 
     return private_metadata
 
 
 def log_private_metadata(private_metadata, action):
-    for pm in private_metadata:
-        logger.info(f'{pm}: {private_metadata[pm]}')
+    log_event(logger, logging.DEBUG, 'slack.private_metadata', action=action, private_metadata=private_metadata)
 
 
 def get_init_blocks(user_info=None):
@@ -81,12 +505,14 @@ def get_init_blocks(user_info=None):
     blocks.extend(BlockLoader.get_blocks(
         Blocks.SUBJECT,
         Blocks.PROBLEM_DETAILS,
+        Blocks.FILE_ATTACHMENTS,
         Blocks.AZURE_RESOURCE_INFORMATION,
         Blocks.AZURE_SUBSCRIPTION,
         Blocks.AZURE_SERVICE,
         Blocks.AZURE_SERVICE_PROBLEM_CLASSIFICATIONS,
         Blocks.AZURE_SERVICE_PROBLEM_CLASSIFICATIONS_DESCRIPTION,
         Blocks.AZURE_RESOURCE,
+        Blocks.ADDITIONAL_TARGETS,
         Blocks.ADVANCED_DIAGNOSTIC_INFO,
         Blocks.SEVERITY,
         Blocks.PREFERRED_CONTACT_METHOD
@@ -101,15 +527,14 @@ def get_init_blocks(user_info=None):
 
 
 def get_user_info(user_id):
-    user_info = client.users_info(user=user_id)
-    logger.debug(f'Fetched user_info: {user_info}')
+    user_info = services.client.users_info(user=user_id)
     profile = user_info['user']['profile']
     email = profile.get('email')
     real_name = profile.get('real_name')
     phone = profile.get('phone')
 
-    if user_id is not None and user_id != BOT_ID:
-        logger.info(f"Message from user_id: {user_id}")
+    if user_id is not None and user_id != services.bot_id:
+        logger.info("Message from user_id: %s", user_id)
 
     user_info = {
         'user_id': user_id,
@@ -117,13 +542,13 @@ def get_user_info(user_id):
         'phone': phone,
         'email': email
     }
-    logger.info(f'Parsed user_info: {user_info}')
+    log_event(logger, logging.DEBUG, 'slack.user_info', user_info=user_info)
     return user_info
 
 
 def map_submitted_data_to_flat_dict(submitted_data):
     result = {}
-    logger.info(f"Submitted data: {submitted_data}")
+    log_event(logger, logging.DEBUG, 'slack.submitted_data', submitted_data=submitted_data)
 
     for sd in submitted_data:
         if sd == Blocks.BLOCK_ID_CONTACT_INFO_FULL_NAME:
@@ -137,13 +562,18 @@ def map_submitted_data_to_flat_dict(submitted_data):
                 result[Blocks.BLOCK_ID_CONTACT_INFO_ADDITIONAL_EMAILS] = [email.strip(
                 ) for email in submitted_data[sd][sd]['value'].split(',') if email.strip()]
         else:
-            if 'selected_channel' in submitted_data[sd][sd]:
+            if 'files' in submitted_data[sd][sd]:
+                result[sd] = submitted_data[sd][sd]['files']
+            elif 'selected_channel' in submitted_data[sd][sd]:
                 result[sd] = submitted_data[sd][sd]['selected_channel']
             elif 'selected_conversation' in submitted_data[sd][sd]:
                 result[sd] = submitted_data[sd][sd]['selected_conversation']
             elif 'selected_option' in submitted_data[sd][sd]:
                 result[sd] = submitted_data[sd][sd]['selected_option']['value']
                 result[f'{sd}_text'] = submitted_data[sd][sd]['selected_option']['text']['text']
+            elif 'selected_options' in submitted_data[sd][sd]:
+                result[sd] = [o['value'] for o in submitted_data[sd][sd]['selected_options']]
+                result[f'{sd}_text'] = [o['text']['text'] for o in submitted_data[sd][sd]['selected_options']]
             else:
                 result[sd] = submitted_data[sd][sd]['value']
 
@@ -152,29 +582,27 @@ def map_submitted_data_to_flat_dict(submitted_data):
 
 def open_support_modal_common(trigger_id, user_id, logger_message):
     """Common function to open support modal for both shortcut and slash command"""
+    services.prefetcher.prefetch_for_user(user_id)
     try:
         user_info = get_user_info(user_id)
         private_metadata = user_info
 
-        view = {
+        view = ModalView(get_init_blocks(user_info), private_metadata, {
             "type": "modal",
-            "private_metadata": get_as_json(private_metadata),
             "callback_id": Shortcuts.OPEN_AZURE_SUPPORT_TICKET,
             "title": {
                 "type": "plain_text",
                 "text": "Create a support request"},
             "submit": {
                 "type": "plain_text",
-                "text": "Submit"},
-            "blocks": get_init_blocks(user_info)}
-        
-        client.views_open(trigger_id=trigger_id, view=view)
+                "text": "Submit"}})
+
+        services.client.views_open(trigger_id=trigger_id, view=view.render())
         logger.info(logger_message)
     except SlackApiError as e:
-        logger.error(f"Failed to open modal: {e.response['error']}")
+        logger.error("Failed to open modal: %s", e.response['error'])
 
 
-@app.shortcut(Shortcuts.OPEN_AZURE_SUPPORT_TICKET)
 def open_support_modal(ack, body, client, logger):
     ack()
     user_id = body['user']['id']
@@ -183,7 +611,6 @@ def open_support_modal(ack, body, client, logger):
 
 
 # 🚨 CRITICAL FIX: Add the missing slash command handler
-@app.command("/azure-support")
 def handle_azure_support_command(ack, body, client, logger):
     ack()
     user_id = body['user_id']
@@ -191,71 +618,120 @@ def handle_azure_support_command(ack, body, client, logger):
     open_support_modal_common(trigger_id, user_id, 'Opened modal for support request via slash command')
 
 
-def preload_azure_resources(private_metadata):
+def update_ticket_draft(body, private_metadata):
+    services.ticket_drafts.update(body["view"]["id"], private_metadata)
+
+
+def preload_azure_resources(body, private_metadata):
+    # Speculative warm-ups for other picks are no longer needed
+    services.prefetcher.cancel(
+        body['user']['id'],
+        private_metadata.get(Blocks.AZURE_SUBSCRIPTION),
+        private_metadata.get(Blocks.AZURE_SERVICE))
     required_keys = [
         Blocks.AZURE_SUBSCRIPTION,
         Blocks.AZURE_SERVICE
     ]
     if all(k in private_metadata for k in required_keys):
-        def azure_resource():
-            subscription_id = private_metadata[Blocks.AZURE_SUBSCRIPTION]
-            select_azure_service_id = private_metadata[Blocks.AZURE_SERVICE]
-            options_handler.get_select_azure_subscription_resources_raw(
-                subscription_id,
-                select_azure_service_id)
+        services.options_handler.prefetch(
+            private_metadata[Blocks.AZURE_SUBSCRIPTION],
+            private_metadata[Blocks.AZURE_SERVICE])
 
-        executor.submit(azure_resource)
 
-
-@app.event("app_mention")
 def handle_app_mention(event, say):
     user_id = event.get("user")
     text = event.get("text", "")
     channel_id = event.get("channel")
 
-    logger.info(f"handle_message_events.text: {text}")
+    log_event(logger, logging.DEBUG, 'slack.app_mention', text=text)
 
     # Only react if the message is exactly a mention to the bot (no extra text)
-    bot_mention = f"<@{BOT_ID}>"
-    if user_id != BOT_ID and text.strip() == bot_mention:
+    bot_mention = f"<@{services.bot_id}>"
+    if user_id != services.bot_id and text.strip() == bot_mention:
         try:
-            client.reactions_add(
+            services.client.reactions_add(
                 name="eyes",
                 channel=channel_id,
                 timestamp=event["ts"],
             )
         except Exception as e:
-            logger.exception(f"Exception in handle_message_events: {e}")
+            logger.exception("Exception in handle_message_events: %s", e)
 
     command = text.split(' ', 1)[1].strip() if ' ' in text else ''
-    logger.info(f"handle_message_events.command: {command}")
+    logger.info("handle_message_events.command: %s", command)
+    command, *args = command.split() or ['']
 
     # Placeholder, possible approach to handle for user to request status
     # update on a support ticket etc.
     if command == "help":
-        say("Supported commands:\n• help - Show this message\n• status - Get the latest status")
+        say("Supported commands:\n• help - Show this message\n• status - Get the latest status"
+            "\n• diag - Runtime diagnostics, for admins")
+    elif command == "diag":
+        say(services.diagnostics.handle(user_id, args))
     elif command == "status":
         say("Current status: All systems operational.")
     else:
         say("Sorry, I didn't understand that command. Type `help` to see available commands.")
 
 
-@app.event("message")
+def upload_thread_files(ticket, event):
+    uploaded = services.attachment_uploader.upload_slack_files(
+        ticket['subscription_id'], ticket['ticket_name'], event.get('files', []))
+    text = (f"Attached {len(uploaded)} file(s) to the support ticket."
+            if uploaded else "We had some trouble attaching the file(s) to the support ticket.")
+    try:
+        services.client.chat_postMessage(text=text, channel=event['channel'], thread_ts=event['thread_ts'])
+    except SlackApiError as e:
+        logger.error("Failed to post attachment status: %s", e.response['error'])
+
+
 def handle_dm(event, say):
+    # Files shared in a ticket thread are attached to the ticket
+    if event.get("subtype") == "file_share" and event.get("thread_ts"):
+        ticket = services.ticket_sync.store.get_ticket_by_thread(event.get("channel"), event["thread_ts"])
+        if ticket:
+            submit_with_context(services.executor, upload_thread_files, ticket, event)
+            return
+
+    # Replies in a ticket thread are forwarded to Azure as communications
+    if services.ticket_sync.handle_thread_reply(event):
+        return
+
     # Only react to direct messages to the bot
-    if event.get("channel_type") == "im" and event.get("user") != BOT_ID:
+    if event.get("channel_type") == "im" and event.get("user") != services.bot_id:
         try:
-            client.reactions_add(
+            services.client.reactions_add(
                 name="eyes",
                 channel=event["channel"],
                 timestamp=event["ts"],
             )
         except Exception as e:
-            logger.exception(f"Exception in handle_direct_msg: {e}")
+            logger.exception("Exception in handle_direct_msg: %s", e)
 
 
-@app.view(Shortcuts.OPEN_AZURE_SUPPORT_TICKET)
 def handle_view_submission(ack, body, client, logger):
+    submitted_data = body["view"]["state"]["values"]
+    private_metadata = get_private_metadata(body)
+    log_event(logger, logging.DEBUG, 'slack.view_submission',
+              submitted_data=submitted_data, private_metadata=private_metadata)
+
+    data = map_submitted_data_to_flat_dict(submitted_data)
+    loading = [b for b in (Blocks.AZURE_RESOURCE, Blocks.AZURE_SERVICE_PROBLEM_CLASSIFICATIONS)
+               if data.get(b) == LOADING_VALUE]
+    if loading:
+        ack({
+            "response_action": "errors",
+            "errors": {b: "Still loading, type to refresh and pick an option" for b in loading}
+        })
+        return
+    if len(get_ticket_targets(data)) > MAX_TARGETS:
+        ack({
+            "response_action": "errors",
+            "errors": {b: f"Up to {MAX_TARGETS} support requests can be filed at once"
+                       for b in (Blocks.ADDITIONAL_AZURE_SUBSCRIPTIONS, Blocks.ADDITIONAL_AZURE_RESOURCES)}
+        })
+        return
+
     ack({
         "response_action": "update",
         "view": {
@@ -266,158 +742,170 @@ def handle_view_submission(ack, body, client, logger):
         }
     })
 
-    submitted_data = body["view"]["state"]["values"]
-    private_metadata = get_private_metadata(body)
-    logger.debug(f'Submitted data: {submitted_data}')
-    logger.debug(f'Private metadata: {private_metadata}')
+    services.prefetcher.record(
+        body['user']['id'], data.get(Blocks.AZURE_SUBSCRIPTION), data.get(Blocks.AZURE_SERVICE))
 
-    data = map_submitted_data_to_flat_dict(submitted_data)
     SupportTicketSubmissionHandler(
-        data, private_metadata, azure_support, client, executor
+        data, private_metadata, services.azure_support, services.client, services.executor,
+        services.ticket_sync, services.attachment_uploader,
+        services.ticket_drafts, body["view"]["id"], services.ticket_fanout, services.ticket_index
     ).handle()
 
 
-@app.action(Blocks.PREFERRED_CONTACT_METHOD)
 def handle_select_preferred_contact_method(ack, body, client, logger):
     ack()
-    private_metadata = get_private_metadata(body)
+    view = ModalView.from_body(body)
     action = body['actions'][0]
     if action['selected_option']['value'] == 'phone':
-        phone_block = BlockLoader.get_block(
-            Blocks.PREFERRED_CONTACT_METHOD_PHONE, 0)
-        phone_block['element']['initial_value'] = private_metadata.get(
-            'phone', '')
-        blocks = body["view"]['blocks']
-        for i, b in enumerate(blocks):
-            if b['block_id'] == Blocks.PREFERRED_CONTACT_METHOD:
-                blocks.insert(i + 1, phone_block)
-                break
+        if Blocks.PREFERRED_CONTACT_METHOD_PHONE not in view:
+            phone_block = BlockLoader.get_block(
+                Blocks.PREFERRED_CONTACT_METHOD_PHONE, 0)
+            phone_block['element']['initial_value'] = view.private_metadata.get(
+                'phone', '')
+            view.insert_after(Blocks.PREFERRED_CONTACT_METHOD, phone_block)
     else:
-        blocks = body["view"]['blocks']
-        idx = 0
-        for i, b in enumerate(blocks):
-            if b['block_id'] == Blocks.PREFERRED_CONTACT_METHOD:
-                idx = i + 1
-                break
-        if idx < len(blocks) and blocks[idx].get(
-                'block_id') == Blocks.PREFERRED_CONTACT_METHOD_PHONE:
-            blocks.pop(idx)
+        view.remove(Blocks.PREFERRED_CONTACT_METHOD_PHONE)
 
-    push_update_view(body, private_metadata)
+    push_update_view(view)
 
 
-@app.action(Blocks.AZURE_SUBSCRIPTION)
 def handle_select_azure_subscription(ack, body, client, logger):
     ack()
     private_metadata = update_private_metadata_from_action(body)
-    preload_azure_resources(private_metadata)
-    push_update_view(body, private_metadata)
+    preload_azure_resources(body, private_metadata)
+    update_ticket_draft(body, private_metadata)
+    push_update_view(ModalView.from_body(body, private_metadata))
 
 
-@app.action(Blocks.AZURE_SERVICE)
 def handle_select_azure_service(ack, body, client, logger):
     ack()
     private_metadata = update_private_metadata_from_action(body)
-    preload_azure_resources(private_metadata)
-    push_update_view(body, private_metadata)
+    preload_azure_resources(body, private_metadata)
+    update_ticket_draft(body, private_metadata)
+    view = ModalView.from_body(body, private_metadata)
+    update_similar_tickets(view, get_state_value(body, Blocks.SUBJECT))
+    push_update_view(view)
+
+
+def get_state_value(body, block_id):
+    return ((body['view'].get('state') or {}).get('values', {}).get(block_id, {}).get(block_id) or {}).get('value')
+
+
+def format_similar_tickets(similar):
+    lines = ['*Similar open support requests*, one of them may already cover this:']
+    for ticket in similar:
+        subject = escape_mrkdwn(ticket['subject'])
+        filed = time.strftime('%b %d', time.localtime(ticket['filed_at']))
+        lines.append(f"• <{ticket['url']}|{subject}> ({ticket['service']}, filed {filed})")
+    return '\n'.join(lines)
+
+
+def update_similar_tickets(view: ModalView, subject):
+    """Shows the open tickets similar to the subject being typed below the
+    problem details, or removes the list when there are none."""
+    similar = services.ticket_index.find_similar(
+        subject or '', view.private_metadata.get(Blocks.AZURE_SERVICE)) if subject else []
+    if not similar:
+        view.remove(Blocks.SIMILAR_TICKETS)
+        return
+    text = format_similar_tickets(similar)
+    shown = view.get(Blocks.SIMILAR_TICKETS)
+    if shown is not None and shown['text']['text'] == text:
+        # Slack adds fields to the blocks it returns, compare the text only
+        return
+    block = BlockLoader.get_block(Blocks.SIMILAR_TICKETS, 0)
+    block['text']['text'] = text
+    if shown is not None:
+        view.replace(Blocks.SIMILAR_TICKETS, block)
+    else:
+        view.insert_after(Blocks.PROBLEM_DETAILS, block)
+
 
+def handle_subject(ack, body, client, logger):
+    ack()
+    view = ModalView.from_body(body)
+    update_similar_tickets(view, body['actions'][0].get('value'))
+    push_update_view(view)
 
-def handle_select_azure_service_problem_classifications_full_text(details, body):
-    blocks = body["view"]['blocks']
 
+def handle_select_azure_service_problem_classifications_full_text(details, view):
     plain_text = BlockLoader.get_block(
-        Blocks.AZURE_SERVICE_PROBLEM_CLASSIFICATIONS_DESCRIPTION)
-    plain_text[0]['text']['text'] = details['display_name']
-    plain_text_block_id = plain_text[0].get(
-        'block_id', Blocks.AZURE_SERVICE_PROBLEM_CLASSIFICATIONS_DESCRIPTION)
+        Blocks.AZURE_SERVICE_PROBLEM_CLASSIFICATIONS_DESCRIPTION, 0)
+    plain_text['text']['text'] = details['display_name']
+    plain_text.setdefault('block_id', Blocks.AZURE_SERVICE_PROBLEM_CLASSIFICATIONS_DESCRIPTION)
+    view.upsert(plain_text)
+    return view
 
-    found = False
-    for idx, block in enumerate(blocks):
-        if block.get('block_id') == plain_text_block_id:
-            blocks[idx] = plain_text[0]
-            found = True
-            break
-    if not found:
-        blocks.extend(plain_text)
 
-    return body
+def is_loading_option_selected(body):
+    return (body['actions'][0].get('selected_option') or {}).get('value') == LOADING_VALUE
 
 
-@app.action(Blocks.AZURE_SERVICE_PROBLEM_CLASSIFICATIONS)
 def handle_select_azure_service_problem_classifications(ack, body, client, logger):
     ack()
+    if is_loading_option_selected(body):
+        return
     private_metadata = update_private_metadata_from_action(body)
+    update_ticket_draft(body, private_metadata)
     subscription_id = private_metadata[Blocks.AZURE_SUBSCRIPTION]
     select_azure_service_id = private_metadata[Blocks.AZURE_SERVICE]
     select_azure_service_problem_classifications_id = private_metadata[
         Blocks.AZURE_SERVICE_PROBLEM_CLASSIFICATIONS]
 
-    details = azure_support.get_problem_classification_details(
+    details = services.azure_support.get_problem_classification_details(
         subscription_id,
         select_azure_service_id,
         select_azure_service_problem_classifications_id
     )
 
-    body = handle_select_azure_service_problem_classifications_full_text(details, body)
-    push_update_view(body, private_metadata)
+    view = handle_select_azure_service_problem_classifications_full_text(
+        details, ModalView.from_body(body, private_metadata))
+    push_update_view(view)
 
 
-@app.action(Blocks.AZURE_RESOURCE)
 def handle_select_azure_resource(ack, body, client, logger):
     ack()
+    if is_loading_option_selected(body):
+        return
     private_metadata = update_private_metadata_from_action(body)
-    push_update_view(body, private_metadata)
+    update_ticket_draft(body, private_metadata)
+    push_update_view(ModalView.from_body(body, private_metadata))
 
 
-@app.action(Blocks.SEVERITY)
 def handle_select_severity(ack, body, client, logger):
     ack()
     private_metadata = update_private_metadata_from_action(body)
-    push_update_view(body, private_metadata)
+    push_update_view(ModalView.from_body(body, private_metadata))
 
 
-@app.action(Blocks.ADVANCED_DIAGNOSTIC_INFO)
 def handle_select_advanced_diagnostic_information(ack, body, client, logger):
     ack()
     private_metadata = update_private_metadata_from_action(body)
-    push_update_view(body, private_metadata)
+    push_update_view(ModalView.from_body(body, private_metadata))
 
 
-@app.options(Blocks.AZURE_SUBSCRIPTION)
 def options_azure_subscription(ack, body):
     user_input = body.get("value", "")
-    options = options_handler.get_select_azure_sub(user_input)
+    options = services.options_handler.get_select_azure_sub(user_input)
     ack(options=options)
 
 
-def push_update_view(body, private_metadata):
-    client.views_update(
-        view_id=body["view"]["id"],
-        hash=body["view"]["hash"],
-        view={
-            'private_metadata': get_as_json(private_metadata),
-            "type": "modal",
-            "callback_id": body["view"]["callback_id"],
-            "title": {
-                "type": "plain_text",
-                "text": "Create a support request"},
-            "submit": {
-                "type": "plain_text",
-                "text": "Submit"},
-            "blocks": body["view"]['blocks']})
+def push_update_view(view: ModalView):
+    if not view.is_dirty:
+        # Reselecting a value changes nothing in the view
+        return
+    services.client.views_update(view_id=view.view_id, hash=view.view_hash, view=view.render())
 
 
-@app.options(Blocks.AZURE_SERVICE)
 def options_azure_service(ack, body, client):
     user_input = body.get("value", "")
     private_metadata = get_private_metadata(body)
     log_private_metadata(private_metadata, Blocks.AZURE_SERVICE)
 
-    og = options_handler.get_select_azure_service(user_input, private_metadata)
+    og = services.options_handler.get_select_azure_service(user_input, private_metadata)
     ack(option_groups=og)
 
 
-@app.options(Blocks.AZURE_SERVICE_PROBLEM_CLASSIFICATIONS)
 def options_azure_service_problem_classifications(ack, body):
     private_metadata = get_private_metadata(body)
     log_private_metadata(
@@ -429,18 +917,47 @@ def options_azure_service_problem_classifications(ack, body):
         ack(options=[])
         return
 
-    data = options_handler.get_select_azure_service_problem_classifications(
+    data = services.options_handler.get_select_azure_service_problem_classifications(
         private_metadata)
     ack(option_groups=data['values']) if data['type'] == 'option_groups' else ack(
         options=data['values'])
 
 
-@app.options(Blocks.AZURE_RESOURCE)
 def options_azure_resource(ack, body):
     private_metadata = get_private_metadata(body)
-    option_groups = options_handler.get_select_azure_subscription_resources_mapped(private_metadata)
+    if not private_metadata.get(Blocks.AZURE_SUBSCRIPTION) or not private_metadata.get(Blocks.AZURE_SERVICE):
+        ack(options=[])
+        return
+    option_groups = services.options_handler.get_select_azure_subscription_resources_mapped(private_metadata)
     ack(option_groups=option_groups)
 
 
+def register_listeners(app):
+    throttle = services.options_throttle.wrap
+    app.shortcut(Shortcuts.OPEN_AZURE_SUPPORT_TICKET)(open_support_modal)
+    app.command("/azure-support")(handle_azure_support_command)
+    app.event("app_mention")(handle_app_mention)
+    app.event("message")(handle_dm)
+    app.view(Shortcuts.OPEN_AZURE_SUPPORT_TICKET)(handle_view_submission)
+    app.action(Blocks.SUBJECT)(handle_subject)
+    app.action(Blocks.PREFERRED_CONTACT_METHOD)(handle_select_preferred_contact_method)
+    app.action(Blocks.AZURE_SUBSCRIPTION)(handle_select_azure_subscription)
+    app.action(Blocks.AZURE_SERVICE)(handle_select_azure_service)
+    app.action(Blocks.AZURE_SERVICE_PROBLEM_CLASSIFICATIONS)(handle_select_azure_service_problem_classifications)
+    app.action(Blocks.AZURE_RESOURCE)(handle_select_azure_resource)
+    app.action(Blocks.SEVERITY)(handle_select_severity)
+    app.action(Blocks.ADVANCED_DIAGNOSTIC_INFO)(handle_select_advanced_diagnostic_information)
+    # Subscriptions and services are filtered in memory, not throttled
+    app.options(Blocks.AZURE_SUBSCRIPTION)(options_azure_subscription)
+    app.options(Blocks.AZURE_SERVICE)(options_azure_service)
+    app.options(Blocks.AZURE_SERVICE_PROBLEM_CLASSIFICATIONS)(throttle(options_azure_service_problem_classifications))
+    app.options(Blocks.AZURE_RESOURCE)(throttle(options_azure_resource))
+    app.options(Blocks.ADDITIONAL_AZURE_SUBSCRIPTIONS)(options_azure_subscription)
+    app.options(Blocks.ADDITIONAL_AZURE_RESOURCES)(throttle(options_azure_resource))
+
+
 if __name__ == "__main__":
+    create_app()
+    start_background_services()
+    start_metrics_server(int(os.environ.get('METRICS_PORT', 9090)))
     app.start(port=5000)
@@ -0,0 +1,278 @@
+import base64
+import json
+import logging
+import os
+import re
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import TYPE_CHECKING
+
+from lazy_imports import lazy_import
+from metrics import AZURE_CLIENT_KWARGS
+from sqlite_store import SQLiteStore
+
+if TYPE_CHECKING:
+    from azure.identity import ChainedTokenCredential
+
+MicrosoftSupport = lazy_import('azure.mgmt.support', 'MicrosoftSupport')
+FileDetails = lazy_import('azure.mgmt.support.models', 'FileDetails')
+UploadFile = lazy_import('azure.mgmt.support.models', 'UploadFile')
+
+logger = logging.getLogger(__name__)
+
+attachment_uploads_db_path = 'attachment_uploads.db'
+
+UPLOAD_PROGRESS_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS upload_parts (
+        workspace TEXT NOT NULL,
+        file_id TEXT NOT NULL,
+        part INTEGER NOT NULL,
+        PRIMARY KEY (workspace, file_id, part)
+    );
+    CREATE TABLE IF NOT EXISTS upload_chunks (
+        workspace TEXT NOT NULL,
+        file_id TEXT NOT NULL,
+        chunk INTEGER NOT NULL,
+        PRIMARY KEY (workspace, file_id, chunk)
+    );
+    CREATE TABLE IF NOT EXISTS uploads (
+        workspace TEXT NOT NULL,
+        file_id TEXT NOT NULL,
+        subscription_id TEXT NOT NULL,
+        slack_file TEXT NOT NULL,
+        attempted_at REAL NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 1,
+        PRIMARY KEY (workspace, file_id)
+    );
+"""
+
+# Keys of a Slack file needed to upload it again
+SLACK_FILE_KEYS = ('id', 'name', 'size', 'url_private_download')
+
+
+class UploadProgressStore(SQLiteStore):
+    """Remembers which parts were created and which chunks were uploaded so an
+    interrupted upload resumes where it stopped, and the uploads not finished
+    yet so they can be retried."""
+
+    SCHEMA = UPLOAD_PROGRESS_SCHEMA
+
+    def __init__(self, path=attachment_uploads_db_path):
+        super().__init__(path)
+
+    def get_created_parts(self, workspace, file_id):
+        with self.lock:
+            rows = self.conn.execute(
+                'SELECT part FROM upload_parts WHERE workspace = ? AND file_id = ?',
+                (workspace, file_id)).fetchall()
+        return {r[0] for r in rows}
+
+    def add_part(self, workspace, file_id, part):
+        with self.lock, self.conn:
+            self.conn.execute('INSERT OR IGNORE INTO upload_parts VALUES (?, ?, ?)', (workspace, file_id, part))
+            self._touch_upload(workspace, file_id)
+
+    def get_uploaded_chunks(self, workspace, file_id):
+        with self.lock:
+            rows = self.conn.execute(
+                'SELECT chunk FROM upload_chunks WHERE workspace = ? AND file_id = ?',
+                (workspace, file_id)).fetchall()
+        return {r[0] for r in rows}
+
+    def add_chunk(self, workspace, file_id, chunk):
+        with self.lock, self.conn:
+            self.conn.execute('INSERT OR IGNORE INTO upload_chunks VALUES (?, ?, ?)', (workspace, file_id, chunk))
+            self._touch_upload(workspace, file_id)
+
+    def _touch_upload(self, workspace, file_id):
+        # An upload making progress is still running, not stalled
+        self.conn.execute(
+            'UPDATE uploads SET attempted_at = ? WHERE workspace = ? AND file_id = ?',
+            (time.time(), workspace, file_id))
+
+    def add_upload(self, workspace, subscription_id, slack_file, attempted_at=None):
+        slack_file = {k: slack_file.get(k) for k in SLACK_FILE_KEYS}
+        with self.lock, self.conn:
+            self.conn.execute(
+                'INSERT INTO uploads VALUES (?, ?, ?, ?, ?, 1) ON CONFLICT (workspace, file_id) '
+                'DO UPDATE SET attempted_at = excluded.attempted_at, attempts = attempts + 1',
+                (workspace, slack_file['id'], subscription_id, json.dumps(slack_file),
+                 time.time() if attempted_at is None else attempted_at))
+
+    def get_stalled_uploads(self, attempted_before):
+        with self.lock:
+            rows = self.conn.execute(
+                'SELECT workspace, subscription_id, slack_file, attempts FROM uploads WHERE attempted_at < ?',
+                (attempted_before,)).fetchall()
+        return [{'workspace': r[0], 'subscription_id': r[1], 'slack_file': json.loads(r[2]), 'attempts': r[3]}
+                for r in rows]
+
+    def clear(self, workspace, file_id):
+        with self.lock, self.conn:
+            self.conn.execute('DELETE FROM upload_parts WHERE workspace = ? AND file_id = ?', (workspace, file_id))
+            self.conn.execute('DELETE FROM upload_chunks WHERE workspace = ? AND file_id = ?', (workspace, file_id))
+            self.conn.execute('DELETE FROM uploads WHERE workspace = ? AND file_id = ?', (workspace, file_id))
+
+
+class AttachmentUploader:
+    """Streams Slack files into an Azure support file workspace.
+
+    The Support files API caps a file at 5 MB in at most two 2.5 MB chunks, so
+    larger Slack files are split into numbered parts. The download is read
+    one chunk at a time and at most MAX_IN_FLIGHT chunks are held in memory
+    while they upload in parallel.
+
+    Uploads that fail, or stop with the process, are retried in the
+    background from where they stopped, up to MAX_ATTEMPTS times.
+    """
+
+    CHUNK_SIZE = 2 * 1024 * 1024
+    CHUNKS_PER_PART = 2
+    MAX_IN_FLIGHT = 4
+    RESUME_INTERVAL = 10 * 60
+    # An upload without progress for this long is no longer running
+    STALL_SECONDS = 10 * 60
+    MAX_ATTEMPTS = 5
+    # Seconds a Slack download may go without sending data
+    DOWNLOAD_TIMEOUT = 60
+
+    def __init__(self, credentials: 'ChainedTokenCredential', slack_bot_token, store: UploadProgressStore = None,
+                 chunk_size=CHUNK_SIZE, max_in_flight=MAX_IN_FLIGHT):
+        self.credentials = credentials
+        self.slack_bot_token = slack_bot_token
+        self.store = store if store is not None else UploadProgressStore()
+        self.chunk_size = chunk_size
+        self.max_in_flight = max_in_flight
+        self.executor = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix='attachments')
+
+    def start(self):
+        threading.Thread(target=self._resume_forever, daemon=True).start()
+
+    def _resume_forever(self):
+        while True:
+            try:
+                self.resume_uploads()
+            except Exception as e:
+                logger.exception('Exception in resuming attachment uploads: %s', e)
+            time.sleep(self.RESUME_INTERVAL)
+
+    def resume_uploads(self, now=None):
+        """Retries the uploads that stalled, returns the names of the files
+        uploaded."""
+        now = time.time() if now is None else now
+        uploaded = []
+        for upload in self.store.get_stalled_uploads(now - self.STALL_SECONDS):
+            slack_file = upload['slack_file']
+            if upload['attempts'] >= self.MAX_ATTEMPTS:
+                logger.warning('Giving up on uploading %s to %s', slack_file['name'], upload['workspace'])
+                self.store.clear(upload['workspace'], slack_file['id'])
+                continue
+            logger.info('Resuming the upload of %s to %s', slack_file['name'], upload['workspace'])
+            uploaded.extend(self.upload_slack_files(upload['subscription_id'], upload['workspace'], [slack_file]))
+        return uploaded
+
+    @staticmethod
+    def _get_part_name(file_name, part, number_of_parts):
+        file_name = re.sub(r'[^A-Za-z0-9._-]', '_', file_name) or 'attachment'
+        if number_of_parts == 1:
+            return file_name
+        stem, ext = os.path.splitext(file_name)
+        return f'{stem}.part{part + 1:03d}{ext}'
+
+    def _open_download(self, url, offset):
+        headers = {'Authorization': f'Bearer {self.slack_bot_token}'}
+        if offset:
+            headers['Range'] = f'bytes={offset}-'
+        response = urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=self.DOWNLOAD_TIMEOUT)
+        # Without range support the body starts at byte 0.
+        start = offset if response.status == 206 else 0
+        return response, start
+
+    def upload_slack_files(self, subscription_id, workspace_name, slack_files):
+        for slack_file in slack_files:
+            self.store.add_upload(workspace_name, subscription_id, slack_file)
+        support_client = MicrosoftSupport(self.credentials, subscription_id, **AZURE_CLIENT_KWARGS)
+        try:
+            support_client.file_workspaces.get(workspace_name)
+        except Exception:
+            support_client.file_workspaces.create(workspace_name)
+
+        uploaded = []
+        for slack_file in slack_files:
+            try:
+                uploaded.extend(self.upload_slack_file(support_client, workspace_name, slack_file))
+            except Exception as e:
+                logger.exception('Failed to upload %s to %s: %s', slack_file.get('name'), workspace_name, e)
+        return uploaded
+
+    def upload_slack_file(self, support_client, workspace_name, slack_file):
+        file_id = slack_file['id']
+        file_size = slack_file['size']
+        part_size = self.chunk_size * self.CHUNKS_PER_PART
+        number_of_parts = max(1, -(-file_size // part_size))
+        total_chunks = max(1, -(-file_size // self.chunk_size))
+        part_names = [self._get_part_name(slack_file['name'], p, number_of_parts) for p in range(number_of_parts)]
+
+        created_parts = self.store.get_created_parts(workspace_name, file_id)
+        for part, part_name in enumerate(part_names):
+            if part in created_parts:
+                continue
+            part_bytes = min(part_size, file_size - part * part_size)
+            support_client.files.create(
+                workspace_name, part_name,
+                create_file=FileDetails(
+                    file_size=part_bytes,
+                    chunk_size=self.chunk_size,
+                    number_of_chunks=max(1, -(-part_bytes // self.chunk_size))))
+            self.store.add_part(workspace_name, file_id, part)
+
+        done = self.store.get_uploaded_chunks(workspace_name, file_id)
+        pending = [c for c in range(total_chunks) if c not in done]
+        if pending:
+            self._stream_chunks(support_client, workspace_name, slack_file, part_names, pending)
+
+        self.store.clear(workspace_name, file_id)
+        logger.info('Uploaded %s (%s bytes) as %s file(s)', slack_file['name'], file_size, len(part_names))
+        return part_names
+
+    def _stream_chunks(self, support_client, workspace_name, slack_file, part_names, pending):
+        file_id = slack_file['id']
+        pending = set(pending)
+        response, position = self._open_download(
+            slack_file['url_private_download'], min(pending) * self.chunk_size)
+        slots = threading.BoundedSemaphore(self.max_in_flight)
+        futures = []
+
+        def upload(chunk, content):
+            try:
+                part, chunk_index = divmod(chunk, self.CHUNKS_PER_PART)
+                support_client.files.upload(
+                    workspace_name, part_names[part],
+                    upload_file=UploadFile(content=base64.b64encode(content).decode('ascii'),
+                                           chunk_index=chunk_index))
+                self.store.add_chunk(workspace_name, file_id, chunk)
+            finally:
+                slots.release()
+
+        with response:
+            while pending:
+                chunk = position // self.chunk_size
+                slots.acquire()
+                content = response.read(self.chunk_size)
+                if not content:
+                    slots.release()
+                    break
+                position += len(content)
+                if chunk in pending:
+                    pending.discard(chunk)
+                    futures.append(self.executor.submit(upload, chunk, content))
+                else:
+                    slots.release()
+
+        # Let in-flight chunks finish so their progress is recorded before a
+        # failure is raised.
+        wait(futures)
+        for future in futures:
+            future.result()
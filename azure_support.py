@@ -1,30 +1,67 @@
 import concurrent.futures
 import hashlib
+import itertools
 import json
+import os
 import time
 import re
 import urllib.parse
+import uuid
 import logging
 import threading
 
-from cachetools import cached, TTLCache
+from typing import TYPE_CHECKING
+from cachetools import cached
+from catalog import LiveServiceCatalog, ServiceCatalog, shorten_service_ids
 from collections import OrderedDict
-from azure.identity import ChainedTokenCredential
-from azure.mgmt.support import MicrosoftSupport
-from azure.mgmt.resource import ResourceManagementClient
-from azure.mgmt.resource import SubscriptionClient
 from concurrent.futures import ThreadPoolExecutor
-from azure.mgmt.support.models import (
-    SupportTicketDetails, ContactProfile, TechnicalTicketDetails
-)
+from lazy_imports import lazy_import
+from leader import SharedSnapshot
+from token_cache import ARM_SCOPE
+from structured_logging import log_event
+from tracing import submit_with_context, traced
+from inventory import ResourceInventory, get_cached_size
+from metrics import AZURE_CLIENT_KWARGS, CACHE_EVICTIONS, CACHE_REQUESTS, InstrumentedTTLCache, register_cache
+from workspaces import PartitionedCache, get_cache_quota, get_partition_name
+
+if TYPE_CHECKING:
+    from azure.identity import ChainedTokenCredential
+
+# The Azure SDKs take a large share of the startup time, import on first use
+MicrosoftSupport = lazy_import('azure.mgmt.support', 'MicrosoftSupport')
+ResourceManagementClient = lazy_import('azure.mgmt.resource', 'ResourceManagementClient')
+SubscriptionClient = lazy_import('azure.mgmt.resource', 'SubscriptionClient')
+SupportTicketDetails = lazy_import('azure.mgmt.support.models', 'SupportTicketDetails')
+ContactProfile = lazy_import('azure.mgmt.support.models', 'ContactProfile')
+TechnicalTicketDetails = lazy_import('azure.mgmt.support.models', 'TechnicalTicketDetails')
+PipelineClient = lazy_import('azure.core', 'PipelineClient')
+HttpRequest = lazy_import('azure.core.rest', 'HttpRequest')
+BearerTokenCredentialPolicy = lazy_import('azure.core.pipeline.policies', 'BearerTokenCredentialPolicy')
+RetryPolicy = lazy_import('azure.core.pipeline.policies', 'RetryPolicy')
 
-
-# Configure logging
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 dataset_services_mapped_path = 'data/dataset_services_mapped.json'
 
+# Memory for the cached resource inventories of each worker
+RESOURCE_CACHE_BYTES = int(os.environ.get('RESOURCE_CACHE_MB', 64)) * 1024 * 1024
+
+
+def _create_resource_cache(partition):
+    # One per workspace, so each gets its own memory budget
+    return InstrumentedTTLCache(
+        get_partition_name('resources_by_resource_type', partition),
+        maxsize=get_cache_quota(partition, RESOURCE_CACHE_BYTES), ttl=60 * 60, getsizeof=get_cached_size)
+
+
+# Support API version of the raw services list
+SUPPORT_API_VERSION = '2024-04-01'
+
+
+def load_dataset_services_mapped(filepath=dataset_services_mapped_path):
+    with open(filepath, "r") as f:
+        return shorten_service_ids(json.load(f))
+
 
 class AzureSupportHelper:
 
@@ -32,25 +69,58 @@ class AzureSupportHelper:
     SERVICE_ARN_TEMPLATE = '/providers/Microsoft.Support/services/{sid}'
     PROBLEM_CLASSIFICATIONS_ARN_TEMPLATE = '/providers/Microsoft.Support/services/{sid}/problemClassifications/{pcid}'
 
-    def __init__(self, credentials: ChainedTokenCredential):
+    def __init__(self, credentials: 'ChainedTokenCredential', dataset=None, cache_partition=None,
+                 service_catalog=None, subscriptions_snapshot: SharedSnapshot = None):
         self.credentials = credentials
-        self.subscription_client = SubscriptionClient(credentials)
-        self.dataset = self._load_dataset_services_mapped(dataset_services_mapped_path)
+        self.subscription_client = SubscriptionClient(credentials, **AZURE_CLIENT_KWARGS)
+        # Workspaces share one live catalog, refreshed in the background
+        self.service_catalog = service_catalog
+        if self.service_catalog is None:
+            self.service_catalog = LiveServiceCatalog(ServiceCatalog(
+                dataset if dataset is not None else self._load_dataset_services_mapped(dataset_services_mapped_path)))
         self.sub_list = []
         self.hash_cache = OrderedDict()
-
+        # Counted under the workspace's name, as diag and /metrics list it
+        self.hash_cache_name = get_partition_name('hash_cache', cache_partition)
+        register_cache(self.hash_cache_name, self.hash_cache)
+        self.subscriptions_loaded = threading.Event()
+        self.subscriptions_loaded_at = None
+        # Written by the process running the preloader, read by the others
+        self.subscriptions_snapshot = subscriptions_snapshot
+
+    def start(self):
+        # Kept out of __init__ so a pre-forking server can build the helper
+        # once and start the preloader in the worker elected to run it.
         threading.Thread(target=self._preload_get_subscription_list, daemon=True).start()
 
     def _load_dataset_services_mapped(self, filepath):
-        with open(filepath, "r") as f:
-            data = json.load(f)
+        return load_dataset_services_mapped(filepath)
 
-            for group, services in data.items():
-                # Optimize to reduce bite transfer over wire
-                for s in services:
-                    s['id'] = s['id'].split('/')[-1]
+    @property
+    def dataset(self):
+        return self.service_catalog.current.dataset
 
-            return data
+    @staticmethod
+    @traced
+    def get_support_services(credentials):
+        """Returns the raw Support services list. The SDK model drops the
+        service group metadata the catalog is grouped by."""
+        kwargs = dict(AZURE_CLIENT_KWARGS)
+        client = PipelineClient(
+            kwargs.pop('base_url', 'https://management.azure.com'),
+            policies=[*kwargs.pop('per_call_policies', []), RetryPolicy(),
+                      BearerTokenCredentialPolicy(credentials, ARM_SCOPE)],
+            **kwargs)
+        services = []
+        request = HttpRequest('GET', '/providers/Microsoft.Support/services',
+                              params={'api-version': SUPPORT_API_VERSION})
+        while request is not None:
+            response = client.send_request(request)
+            response.raise_for_status()
+            page = response.json()
+            services.extend(page.get('value', []))
+            request = HttpRequest('GET', page['nextLink']) if page.get('nextLink') else None
+        return services
 
     def string_to_hash(self, value):
         # Primary use: since slack select options are limited to 75 chars,
@@ -64,25 +134,30 @@ class AzureSupportHelper:
         self.hash_cache.move_to_end(hash)
         if len(self.hash_cache) > self.HASH_CACHE_SIZE:
             self.hash_cache.popitem(last=False)
+            CACHE_EVICTIONS.inc(self.hash_cache_name, 'size')
 
         return hash
 
     @staticmethod
-    @cached(cache=TTLCache(maxsize=1024, ttl=60 * 60 * 24))
+    @traced
+    @cached(cache=InstrumentedTTLCache('problem_classifications_list', maxsize=1024, ttl=60 * 60 * 24),
+            lock=threading.Lock())
     def get_problem_classifications_list(credentials, subscription_id, support_service_id):
         return list(
-            MicrosoftSupport(credentials, subscription_id)
+            MicrosoftSupport(credentials, subscription_id, **AZURE_CLIENT_KWARGS)
             .problem_classifications
             .list(support_service_id)
         )
 
     @staticmethod
-    @cached(cache=TTLCache(maxsize=1024, ttl=60 * 60 * 24))
+    @traced
+    @cached(cache=InstrumentedTTLCache('problem_classification', maxsize=1024, ttl=60 * 60 * 24), lock=threading.Lock())
     def get_problem_classification(credentials, subscription_id, service_id, problem_classification_id):
-        ms = MicrosoftSupport(credentials, subscription_id)
+        ms = MicrosoftSupport(credentials, subscription_id, **AZURE_CLIENT_KWARGS)
         return ms.problem_classifications.get(
             service_id, problem_classification_id)
 
+    @traced
     def get_problem_classification_details(self, subscription_id, support_service_id, problem_classification_id):
         # Try to find in cached list first
         for pc in self.get_problem_classifications_list(self.credentials, subscription_id, support_service_id):
@@ -97,89 +172,106 @@ class AzureSupportHelper:
             'display_name': pc.display_name
         }
 
+    @traced
     def slack_get_support_services_filter_by_prefix(self, prefix):
-        prefix_lower = prefix.lower()
-        filtered = {}
-
-        for group, services in self.dataset.items():
-            # If group name matches, include all services in this group
-            if group.lower().startswith(prefix_lower):
-                filtered[group] = services
-            else:
-                # Otherwise, filter services by displayName
-                matched_services = [s for s in services if s.get("displayName", "").lower().startswith(prefix_lower)]
-                if matched_services:
-                    filtered[group] = matched_services
-
-        return filtered
+        return self.service_catalog.current.filter_by_prefix(prefix)
+
+    def refresh_subscription_list(self):
+        sub_list = self.subscription_client.subscriptions.list()
+        subs = []
+        for group in list(sub_list):
+            subs.append({
+                'id': group.subscription_id,
+                'display_name': group.display_name
+            })
+
+        self.set_subscription_list(subs)
+        if self.subscriptions_snapshot is not None:
+            self.subscriptions_snapshot.publish(subs)
+
+    def load_subscription_snapshot(self):
+        """Takes the subscriptions the preloading process published, if they
+        changed."""
+        subs = self.subscriptions_snapshot.read_if_changed() if self.subscriptions_snapshot else None
+        if subs is not None:
+            self.set_subscription_list(subs)
+
+    def set_subscription_list(self, subs):
+        self.sub_list = subs
+        self.subscriptions_loaded_at = time.time()
+        self.subscriptions_loaded.set()
 
     def _preload_get_subscription_list(self):
         while True:
-            sub_list = self.subscription_client.subscriptions.list()
-            subs = []
-            for group in list(sub_list):
-                subs.append({
-                    'id': group.subscription_id,
-                    'display_name': group.display_name
-                })
-
-            self.sub_list = subs
-            logger.info('preloading subscriptions completed')
-
-            time.sleep(60 * 60)
+            try:
+                self.refresh_subscription_list()
+                logger.info('preloading subscriptions completed')
+                time.sleep(60 * 60)
+            except Exception as e:
+                logger.exception("Exception in preloading subscriptions: %s", e)
+                time.sleep(60)
 
     def get_subscription_list(self):
+        if not self.subscriptions_loaded.is_set():
+            # A worker may be asked before it followed the first published list
+            self.load_subscription_snapshot()
         return self.sub_list
 
     @staticmethod
-    @cached(cache=TTLCache(maxsize=1024, ttl=60 * 60))
+    @traced
+    # Filled at once by the options, prefetch and draft pools, cachetools'
+    # eviction is not thread safe
+    @cached(cache=PartitionedCache(_create_resource_cache), lock=threading.Lock())
+    def get_sub_resources_by_resource_type(credentials, subscription_id, resource_type):
+        # Built while paging, only the id and name of each resource are kept
+        resources = ResourceInventory.from_resources(
+            ResourceManagementClient(credentials, subscription_id, **AZURE_CLIENT_KWARGS)
+            .resources
+            .list(filter=f"resourceType eq '{resource_type.lower()}'")
+        )
+        log_event(logger, logging.DEBUG, 'azure.resources_fetched',
+                  resource_type=resource_type, count=len(resources), bytes=resources.nbytes)
+        return resources
+
+    @staticmethod
+    def group_by_resource_group(resources):
+        grouped = {}
+        for res in resources:
+            resource_group = res.get('resource_group')
+            if resource_group is None:
+                try:
+                    resource_group = res['id'].split('resourceGroups/')[1].split('/providers')[0]
+                except (ValueError, IndexError):
+                    # If resourceGroups not found or malformed id, skip
+                    continue
+            grouped.setdefault(resource_group, []).append({'id': res['id'], 'name': res['name']})
+        return grouped
+
+    @staticmethod
+    @traced
     def get_sub_resources_by_resource_type_concurrent(credentials, subscription_id, resource_type_list: tuple):
 
         def fetch_resources(resource_type):
-            logger.info(f'resource_typeresource_type: {resource_type}')
-            return list(
-                ResourceManagementClient(credentials, subscription_id)
-                .resources
-                .list(filter=f"resourceType eq '{resource_type.lower()}'")
-            )
+            return AzureSupportHelper.get_sub_resources_by_resource_type(credentials, subscription_id, resource_type)
 
-        results = []
+        inventories = []
         with ThreadPoolExecutor() as executor:
-            logger.info(f'resource_type_list: {resource_type_list}')
-            future_to_type = {executor.submit(fetch_resources, rt): rt for rt in resource_type_list}
+            log_event(logger, logging.DEBUG, 'azure.resources_fetch', resource_types=resource_type_list)
+            future_to_type = {submit_with_context(executor, fetch_resources, rt): rt for rt in resource_type_list}
             for future in concurrent.futures.as_completed(future_to_type):
                 rt = future_to_type[future]
                 try:
-                    resources = future.result()
-                    logger.info(f'resourcesresources: {resources}')
-                    results.extend(resources)
+                    inventories.append(future.result())
                 except Exception as exc:
-                    logger.info(f"Resource type {rt} generated an exception: {exc}")
+                    logger.info("Resource type %s generated an exception: %s", rt, exc)
 
-        # Group by resource group
-        grouped = {}
-        for res in results:
-            resource_group = res.id.split('resourceGroups/')[1].split('/providers')[0]
-            try:
-                grouped.setdefault(resource_group, []).append({
-                    'id': res.id,
-                    'name': res.name
-                })
-            except (ValueError, IndexError):
-                # If resourceGroups not found or malformed id, skip
-                continue
-
-        logger.info(f'grouped: {grouped}')
+        grouped = AzureSupportHelper.group_by_resource_group(itertools.chain.from_iterable(inventories))
+        log_event(logger, logging.DEBUG, 'azure.resources_grouped', resource_groups=len(grouped))
         return grouped
 
+    @traced
     def get_resource_types_by_service_id(self, service_id):
-        # Sub-optimum but simple
-        for d in self.dataset:
-            for r in self.dataset[d]:
-                if service_id == r['id']:
-                    return r['resourceTypes']
-
-        return []
+        return self.service_catalog.current.resource_types_by_service_id.get(service_id, [])
 
     def _get_name_strip_invalid_chars(self, st):
         return re.sub(r"[^A-Za-z\s\-']", "", st)
@@ -188,7 +280,10 @@ class AzureSupportHelper:
         encoded_id = urllib.parse.quote(ticket_id, safe='')
         return f"https://portal.azure.com/#view/Microsoft_Azure_Support/SupportRequestDetails.ReactView/id/{encoded_id}/portalJourney~/true"
 
-    def submit_support_ticket(self, data):
+    @traced
+    def build_support_ticket(self, data):
+        """Returns (subscription_id, service_id, SupportTicketDetails) for the
+        submitted data, with the resource id already resolved."""
         subscription_id = data['select_azure_subscription']
 
         service_id = data['select_azure_service']
@@ -219,8 +314,8 @@ class AzureSupportHelper:
         preferred_time_zone = data.get('preferred_time_zone', 'Eastern Standard Time')  # https://support.microsoft.com/help/973627/microsoft-time-zone-index-values
         preferred_support_language = data.get('preferred_support_language', 'en-us')
 
-        for d in data:
-            logger.info(f"{d}: {data[d]}")
+        # The form holds contact details and free text, only its fields are logged
+        log_event(logger, logging.DEBUG, 'azure.ticket_submit', fields=sorted(data))
 
         ticket_details = SupportTicketDetails(
             title=title,
@@ -242,50 +337,81 @@ class AzureSupportHelper:
             advanced_diagnostic_consent=advanced_diagnostic_consent,
             technical_ticket_details=TechnicalTicketDetails(resource_id=resource_id) if resource_id else None
         )
+        return subscription_id, service_id, ticket_details
+
+    @traced
+    def submit_support_ticket(self, data):
+        return self.create_support_ticket(*self.build_support_ticket(data))
 
+    @traced
+    def create_support_ticket(self, subscription_id, service_id, ticket_details, ticket_name=None):
         try:
-            support_client = MicrosoftSupport(self.credentials, subscription_id)
-            ticket_name = f"s{service_id}_{int(time.time())}"
-            logger.info(f"Creating support ticket: {ticket_name} ...")
+            support_client = MicrosoftSupport(self.credentials, subscription_id, **AZURE_CLIENT_KWARGS)
+            # Unique even for tickets filed in the same second, the ticket sync
+            # keys its threads on the name
+            ticket_name = ticket_name or f"s{service_id}_{uuid.uuid4().hex[:16]}"
+            logger.info("Creating support ticket: %s ...", ticket_name)
             support_ticket = support_client.support_tickets.begin_create(
                 support_ticket_name=ticket_name,
                 create_support_ticket_parameters=ticket_details
             )
             logger.info("Support ticket created successfully!")
             result = support_ticket.result()
-            logger.info(f"Ticket ID: {result.id}")
-            logger.info(f"Ticket Title: {result.title}")
-            logger.info(f"Ticket Status: {result.status}")
-
-            return {
-                'success': True,
-                'title': result.title,
-                'url': self._get_support_ticket_azure_portal_url(result.id),
-                'ticket_id': result.id,
-                'status': result.status,
-                'subscription_id': subscription_id
-            }
+            log_event(logger, logging.INFO, 'azure.ticket_created',
+                      ticket_id=result.id, title=result.title, status=result.status)
+            return self._get_ticket_result(result, ticket_name, subscription_id)
         except Exception as e:
-            logger.info(f"Failed to create support ticket: {str(e)}")
+            logger.info("Failed to create support ticket: %s", e)
             return {'success': False}
 
+    @traced
+    def get_support_ticket(self, subscription_id, ticket_name):
+        """Returns the ticket `ticket_name` like `create_support_ticket`, or
+        None if there is no such ticket."""
+        try:
+            result = (
+                MicrosoftSupport(self.credentials, subscription_id, **AZURE_CLIENT_KWARGS)
+                .support_tickets
+                .get(ticket_name)
+            )
+        except Exception as e:
+            if getattr(e, 'status_code', None) == 404:
+                return None
+            raise
+        return self._get_ticket_result(result, ticket_name, subscription_id)
+
+    def _get_ticket_result(self, result, ticket_name, subscription_id):
+        return {
+            'success': True,
+            'title': result.title,
+            'url': self._get_support_ticket_azure_portal_url(result.id),
+            'ticket_id': result.id,
+            'ticket_name': ticket_name,
+            'status': result.status,
+            'subscription_id': subscription_id
+        }
+
+    @traced
     def get_resource_id_by_resource_hash(self, subscription_id, azure_service_id, resource_hash):
+        if not resource_hash or resource_hash == 'none':
+            # "General question", no resource picked
+            return None
+
         # Optimize for second API call for same resource. LRU: move to end if accessed
         if resource_hash in self.hash_cache:
+            CACHE_REQUESTS.inc(self.hash_cache_name, 'hit')
             self.hash_cache.move_to_end(resource_hash)
             return self.hash_cache[resource_hash]
+        CACHE_REQUESTS.inc(self.hash_cache_name, 'miss')
 
         resource_types = self.get_resource_types_by_service_id(azure_service_id)
-        logger.info(resource_types)
         resources = self.get_sub_resources_by_resource_type_concurrent(
             self.credentials, subscription_id, tuple(resource_types))
 
-        logger.info(f'resources: {resources}')
-
         for rl in resources:
             for r in resources[rl]:
                 rid = r['id']
-                if AzureSupportHelper.string_to_hash(rid) == resource_hash:
+                if self.string_to_hash(rid) == resource_hash:
                     return rid
 
         return None
@@ -0,0 +1,340 @@
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from types import SimpleNamespace
+from unittest.mock import MagicMock
+
+logger = logging.getLogger(__name__)
+
+benchmark_baseline_path = 'data/benchmark_baseline.json'
+
+# A benchmark more than this much slower than its baseline is a regression,
+# unless it is also slower by less than the noise floor. Sub-microsecond paths
+# swing by more than the threshold from one run to the next on a busy machine.
+REGRESSION_THRESHOLD = 0.25
+NOISE_FLOOR_SECONDS = 2e-6
+REPEAT = 15
+
+SUBSCRIPTIONS = 5000
+RESOURCES = 20000
+RESOURCE_GROUPS = 500
+PROBLEM_CLASSIFICATIONS = 400
+CATALOG_SCALE = 20
+
+_benchmarks = {}
+
+
+def benchmark(name):
+    """Registers a benchmark. The decorated function does the setup and
+    returns the zero-argument callable to time."""
+    def decorator(setup):
+        _benchmarks[name] = setup
+        return setup
+    return decorator
+
+
+class SyntheticAzure:
+    """Offline stand-ins for the Azure SDK clients, serving a large synthetic
+    tenant."""
+
+    def __init__(self, resources=RESOURCES, resource_groups=RESOURCE_GROUPS,
+                 problem_classifications=PROBLEM_CLASSIFICATIONS):
+        self.resources = [
+            SimpleNamespace(
+                id=(f'/subscriptions/sub-0/resourceGroups/rg-{i % resource_groups:03d}'
+                    f'/providers/Microsoft.Compute/virtualMachines/vm-{i:05d}'),
+                name=f'vm-{i:05d}')
+            for i in range(resources)
+        ]
+        self.problem_classifications = [
+            SimpleNamespace(
+                id=f'/providers/Microsoft.Support/services/svc/problemClassifications/pc-{i}',
+                display_name=f'Group {i // 20} / Problem {i} with a long description of what went wrong')
+            for i in range(problem_classifications)
+        ]
+
+    def resource_management_client(self, credentials, subscription_id, **kwargs):
+        return SimpleNamespace(resources=SimpleNamespace(list=lambda filter=None: iter(self.resources)))
+
+    def microsoft_support(self, credentials, subscription_id, **kwargs):
+        return SimpleNamespace(problem_classifications=SimpleNamespace(
+            list=lambda service_id: iter(self.problem_classifications)))
+
+
+def get_scaled_catalog(dataset, scale=CATALOG_SCALE):
+    """The service catalog repeated `scale` times under distinct names."""
+    catalog = {}
+    for copy in range(scale):
+        for group, services in dataset.items():
+            name = group if copy == 0 else f'{group} {copy}'
+            catalog[name] = [
+                dict(s, id=f"{s['id']}-{copy}", displayName=f"{s['displayName']} {copy}" if copy else s['displayName'])
+                for s in services
+            ]
+    return catalog
+
+
+class Environment:
+    """The objects under test, wired to the synthetic Azure tenant. This
+    replaces the Azure SDK clients of azure_support for the whole process."""
+
+    SERVICE_ID = 'svc-bench'
+
+    def __init__(self):
+        import azure_support
+        from azure_support import AzureSupportHelper, load_dataset_services_mapped
+        from handlers import OptionsHandler
+
+        self.azure = SyntheticAzure()
+        azure_support.ResourceManagementClient = self.azure.resource_management_client
+        azure_support.MicrosoftSupport = self.azure.microsoft_support
+        azure_support.SubscriptionClient = MagicMock()
+
+        dataset = load_dataset_services_mapped()
+        self.catalog = get_scaled_catalog(dataset)
+        self.catalog['Benchmark'] = [{
+            'id': self.SERVICE_ID, 'displayName': 'Benchmark service',
+            'resourceTypes': ['Microsoft.Compute/virtualMachines']}]
+        self.credentials = object()
+        self.azure_support = AzureSupportHelper(self.credentials, self.catalog)
+        self.azure_support.sub_list = [
+            {'id': f'sub-{i}', 'display_name': f'Subscription {i}'} for i in range(SUBSCRIPTIONS)]
+        self.options_handler = OptionsHandler(self.credentials, self.azure_support)
+        self.private_metadata = {
+            'user_id': 'U0BENCH', 'real_name': 'Bench User', 'email': 'bench@example.com',
+            'select_azure_subscription': 'sub-0', 'select_azure_service': self.SERVICE_ID,
+        }
+
+
+_environment = None
+
+
+def get_environment():
+    global _environment
+    if _environment is None:
+        _environment = Environment()
+    return _environment
+
+
+@benchmark('services_filter_empty_prefix')
+def bench_services_filter_empty_prefix():
+    env = get_environment()
+    return lambda: env.azure_support.slack_get_support_services_filter_by_prefix('')
+
+
+@benchmark('services_filter_prefix')
+def bench_services_filter_prefix():
+    env = get_environment()
+    return lambda: env.azure_support.slack_get_support_services_filter_by_prefix('Vir')
+
+
+@benchmark('options_subscriptions')
+def bench_options_subscriptions():
+    env = get_environment()
+    return lambda: env.options_handler.get_select_azure_sub('')
+
+
+@benchmark('options_services')
+def bench_options_services():
+    env = get_environment()
+    return lambda: env.options_handler.get_select_azure_service('', env.private_metadata)
+
+
+@benchmark('options_resources')
+def bench_options_resources():
+    env = get_environment()
+    # Warm the resource cache, the benchmark covers rendering
+    env.options_handler.get_select_azure_subscription_resources_mapped(env.private_metadata)
+    return lambda: env.options_handler.get_select_azure_subscription_resources_mapped(env.private_metadata)
+
+
+@benchmark('options_problem_classifications')
+def bench_options_problem_classifications():
+    env = get_environment()
+    env.options_handler.get_select_azure_service_problem_classifications(env.private_metadata)
+    return lambda: env.options_handler.get_select_azure_service_problem_classifications(env.private_metadata)
+
+
+@benchmark('resource_id_by_hash_miss')
+def bench_resource_id_by_hash_miss():
+    env = get_environment()
+    resource_id = env.azure.resources[-1].id
+    resource_hash = env.azure_support.string_to_hash(resource_id)
+
+    def run():
+        env.azure_support.hash_cache.clear()
+        return env.azure_support.get_resource_id_by_resource_hash('sub-0', env.SERVICE_ID, resource_hash)
+    assert run() == resource_id
+    return run
+
+
+@benchmark('resource_id_by_hash_hit')
+def bench_resource_id_by_hash_hit():
+    env = get_environment()
+    resource_hash = env.azure_support.string_to_hash(env.azure.resources[-1].id)
+    return lambda: env.azure_support.get_resource_id_by_resource_hash('sub-0', env.SERVICE_ID, resource_hash)
+
+
+def _get_submitted_state():
+    def selected(value, text):
+        return {'type': 'external_select', 'selected_option': {'text': {'type': 'plain_text', 'text': text}, 'value': value}}
+    return {
+        'subject': {'subject': {'type': 'plain_text_input', 'value': 'VM does not start'}},
+        'problem_details': {'problem_details': {'type': 'plain_text_input', 'value': 'Details ' * 200}},
+        'select_azure_subscription': {'select_azure_subscription': selected('sub-0', 'Subscription 0')},
+        'select_azure_service': {'select_azure_service': selected('svc-bench', 'Benchmark service')},
+        'select_azure_service_problem_classifications': {
+            'select_azure_service_problem_classifications': selected('pc-1', 'Problem 1')},
+        'select_azure_resource': {'select_azure_resource': selected('a' * 64, 'vm-00001')},
+        'select_severity': {'select_severity': selected('minimal', 'C - Minimal impact')},
+        'select_preferred_contact_method': {'select_preferred_contact_method': selected('email', 'Email')},
+        'select_advanced_diagnostic_information': {
+            'select_advanced_diagnostic_information': selected('Yes', 'Yes')},
+        'section_contact_information_full_name': {
+            'section_contact_information_full_name': {'type': 'plain_text_input', 'value': 'Bench User'}},
+        'section_contact_information_email': {
+            'section_contact_information_email': {'type': 'plain_text_input', 'value': 'bench@example.com'}},
+        'section_contact_information_additional_emails': {
+            'section_contact_information_additional_emails': {
+                'type': 'plain_text_input', 'value': 'a@example.com, b@example.com'}},
+        'select_msg_post_destination': {
+            'select_msg_post_destination': {'type': 'conversations_select', 'selected_conversation': 'C0BENCH'}},
+    }
+
+
+@benchmark('map_submitted_data')
+def bench_map_submitted_data():
+    from app import map_submitted_data_to_flat_dict
+    logging.getLogger('app').setLevel(logging.INFO)
+    state = _get_submitted_state()
+    return lambda: map_submitted_data_to_flat_dict(state)
+
+
+@benchmark('block_loader_init_blocks')
+def bench_block_loader_init_blocks():
+    from app import get_init_blocks
+    env = get_environment()
+    return lambda: get_init_blocks(env.private_metadata)
+
+
+@benchmark('private_metadata_round_trip')
+def bench_private_metadata_round_trip():
+    from app import get_private_metadata
+    from serialization import encode_private_metadata
+    metadata = {
+        'user_id': 'U0BENCH', 'real_name': 'Bench User', 'email': 'bench@example.com',
+        'select_azure_subscription': 'sub-0', 'select_azure_service': 'svc-bench',
+        'select_azure_resource': 'a' * 64, 'select_azure_service_problem_classifications': 'pc-1',
+        'select_severity': 'minimal',
+    }
+    return lambda: get_private_metadata({'view': {'private_metadata': encode_private_metadata(metadata)}})
+
+
+def time_callable(fn, repeat=REPEAT, min_time=0.05):
+    """Returns the fastest seconds per call over `repeat` rounds, each round
+    running enough calls to last at least `min_time` seconds. The fastest
+    round is the least disturbed by other load on the machine."""
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        number *= 2 if elapsed == 0 else max(2, min(10, int(min_time / elapsed) + 1))
+    rounds = [elapsed / number]
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        rounds.append((time.perf_counter() - start) / number)
+    return min(rounds)
+
+
+def run_benchmarks(names=None, repeat=REPEAT, min_time=0.05):
+    results = {}
+    for name, setup in _benchmarks.items():
+        if names and name not in names:
+            continue
+        results[name] = time_callable(setup(), repeat, min_time)
+    return results
+
+
+def compare(results, baseline, threshold=REGRESSION_THRESHOLD, noise_floor=NOISE_FLOOR_SECONDS):
+    """Returns (name, seconds, baseline seconds or None, regressed) per result."""
+    rows = []
+    for name, seconds in results.items():
+        base = baseline.get(name)
+        regressed = base is not None and seconds > base * (1 + threshold) and seconds - base > noise_floor
+        rows.append((name, seconds, base, regressed))
+    return rows
+
+
+def confirm_regressions(results, baseline, threshold=REGRESSION_THRESHOLD, noise_floor=NOISE_FLOOR_SECONDS,
+                        repeat=REPEAT):
+    """Times the regressed benchmarks again and keeps their faster time, so
+    a burst of load on the machine during one run is not reported."""
+    regressed = [name for name, *_, r in compare(results, baseline, threshold, noise_floor) if r]
+    if not regressed:
+        return results
+    again = run_benchmarks(regressed, repeat)
+    return {name: min(seconds, again.get(name, seconds)) for name, seconds in results.items()}
+
+
+def format_report(rows):
+    lines = [f'{"benchmark":<34} {"time":>12} {"baseline":>12} {"change":>8}']
+    for name, seconds, base, regressed in rows:
+        change = f'{(seconds / base - 1) * 100:+.0f}%' if base else 'new'
+        lines.append(
+            f'{name:<34} {seconds * 1e6:>10.1f}us {base * 1e6 if base else 0:>10.1f}us {change:>8}'
+            f'{"  REGRESSION" if regressed else ""}')
+    return '\n'.join(lines)
+
+
+def load_baseline(path=benchmark_baseline_path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_baseline(results, path=benchmark_baseline_path):
+    with open(path, 'w') as f:
+        json.dump({name: round(seconds, 9) for name, seconds in sorted(results.items())}, f, indent=2)
+        f.write('\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time the options and submission hot paths offline')
+    parser.add_argument('names', nargs='*', help='benchmarks to run, all by default')
+    parser.add_argument('--baseline', default=benchmark_baseline_path)
+    parser.add_argument('--save', action='store_true', help='store the results as the new baseline')
+    parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD,
+                        help='slowdown over the baseline reported as a regression (default 0.25)')
+    parser.add_argument('--noise-floor', type=float, default=NOISE_FLOOR_SECONDS,
+                        help='slowdown in seconds per call always ignored as noise (default 2e-6)')
+    parser.add_argument('--repeat', type=int, default=REPEAT)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    baseline = load_baseline(args.baseline)
+    results = run_benchmarks(args.names, args.repeat)
+    if not args.save:
+        results = confirm_regressions(results, baseline, args.threshold, args.noise_floor, args.repeat)
+    rows = compare(results, baseline, args.threshold, args.noise_floor)
+    print(format_report(rows))
+    if args.save:
+        save_baseline(dict(baseline, **results), args.baseline)
+        print(f'Baseline saved to {args.baseline}')
+        return 0
+    return 1 if any(regressed for *_, regressed in rows) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,385 @@
+import argparse
+import json
+import logging
+import re
+import sys
+import threading
+import time
+from collections import defaultdict, deque
+from urllib.parse import urlparse
+
+from azure.core.exceptions import HttpResponseError
+from azure.core.pipeline.transport import HttpResponse as PipelineHttpResponse
+from azure.core.pipeline.transport import HttpTransport, RequestsTransport
+from azure.core.rest import HttpRequest, HttpResponse
+from azure.core.utils import CaseInsensitiveDict
+
+from metrics import AZURE_CLIENT_KWARGS, get_azure_operation
+
+logger = logging.getLogger(__name__)
+
+CASSETTE_VERSION = 1
+
+_GUID = r'[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}'
+_GUID_PATTERN = re.compile(_GUID)
+# Subscription and tenant ids are replaced, service and problem
+# classification ids are public and must stay as in the catalog.
+_ACCOUNT_ID_PATTERNS = (
+    re.compile(rf'/subscriptions/({_GUID})', re.IGNORECASE),
+    re.compile(rf'"(?:subscriptionId|tenantId|homeTenantId)"\s*:\s*"({_GUID})"'),
+)
+# Contact details of the ticket and communication bodies
+REDACTED_FIELDS = frozenset((
+    'firstName', 'lastName', 'primaryEmailAddress', 'additionalEmailAddresses', 'phoneNumber', 'sender',
+))
+# Response headers worth keeping, the rest identify the caller or request
+KEPT_HEADERS = frozenset((
+    'content-type', 'retry-after', 'location', 'azure-asyncoperation', 'x-ms-ratelimit-remaining-subscription-reads',
+))
+
+
+class CassetteMismatch(Exception):
+    pass
+
+
+class Sanitizer:
+    """Replaces subscription and tenant ids with stable placeholders and
+    redacts contact details. The same id gets the same placeholder in URLs,
+    bodies and next links, so a replay follows the recorded paging."""
+
+    def __init__(self):
+        self.placeholders = {}
+        self.lock = threading.Lock()
+
+    def _get_placeholder(self, account_id):
+        key = account_id.lower()
+        with self.lock:
+            placeholder = self.placeholders.get(key)
+            if placeholder is None:
+                placeholder = self.placeholders[key] = f'00000000-0000-0000-0000-{len(self.placeholders) + 1:012d}'
+            return placeholder
+
+    def sanitize_text(self, text):
+        for pattern in _ACCOUNT_ID_PATTERNS:
+            # In order of appearance, so placeholders follow the recording
+            for account_id in dict.fromkeys(pattern.findall(text)):
+                self._get_placeholder(account_id)
+        return _GUID_PATTERN.sub(lambda m: self.placeholders.get(m.group(0).lower(), m.group(0)), text)
+
+    def sanitize_body(self, body):
+        if not body:
+            return None
+        text = body.decode('utf-8', errors='replace') if isinstance(body, bytes) else str(body)
+        try:
+            data = json.loads(text)
+        except ValueError:
+            return self.sanitize_text(text)
+        return json.loads(self.sanitize_text(json.dumps(_redact(data))))
+
+
+def _redact(data):
+    if isinstance(data, dict):
+        return {k: ('redacted' if k in REDACTED_FIELDS and v else _redact(v)) for k, v in data.items()}
+    if isinstance(data, list):
+        return [_redact(v) for v in data]
+    return data
+
+
+def _get_request_body(request):
+    # azure.core.rest requests carry `content`, pipeline requests `data`
+    body = getattr(request, 'content', None)
+    if body is None:
+        body = getattr(request, 'data', None)
+    return body if isinstance(body, (bytes, str)) else None
+
+
+def _get_response_body(response):
+    if hasattr(response, 'read'):
+        return response.read()
+    return response.body()
+
+
+def _get_match_key(method, url):
+    parsed = urlparse(url)
+    query = '&'.join(sorted(p for p in parsed.query.split('&') if p and not p.startswith('api-version=')))
+    return f'{method} {parsed.path.lower()}?{query}'
+
+
+class Cassette:
+    """Recorded Azure HTTP interactions, stored as JSON lines: a header line
+    followed by one line per interaction. Recording appends, so a cassette
+    survives a crash of the recording process."""
+
+    def __init__(self, interactions=None, path=None):
+        self.interactions = list(interactions or [])
+        self.path = path
+        self.lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path):
+        interactions = []
+        with open(path) as f:
+            header = json.loads(f.readline() or '{}')
+            if header.get('version') != CASSETTE_VERSION:
+                raise ValueError(f'Unsupported cassette version in {path}: {header.get("version")}')
+            for line in f:
+                if line.strip():
+                    interactions.append(json.loads(line))
+        return cls(interactions, path)
+
+    @classmethod
+    def create(cls, path):
+        with open(path, 'w') as f:
+            f.write(json.dumps({'version': CASSETTE_VERSION, 'recorded_at': int(time.time())}) + '\n')
+        return cls(path=path)
+
+    def append(self, interaction):
+        with self.lock:
+            self.interactions.append(interaction)
+            if self.path:
+                with open(self.path, 'a') as f:
+                    f.write(json.dumps(interaction) + '\n')
+
+    def get_latency_profile(self):
+        """Returns {operation: {'count', 'p50', 'p90', 'max', 'bytes'}} with
+        seconds and average response bytes per operation."""
+        by_operation = defaultdict(list)
+        for interaction in self.interactions:
+            by_operation[get_azure_operation(interaction['method'], interaction['url'])].append(interaction)
+        profile = {}
+        for operation, interactions in sorted(by_operation.items()):
+            durations = sorted(i['duration'] for i in interactions)
+            profile[operation] = {
+                'count': len(durations),
+                'p50': durations[(len(durations) - 1) // 2],
+                'p90': durations[min(len(durations) - 1, int(len(durations) * 0.9))],
+                'max': durations[-1],
+                'bytes': sum(i.get('response_bytes', 0) for i in interactions) // len(interactions),
+            }
+        return profile
+
+
+class RecordingTransport(HttpTransport):
+    """Sends requests through `transport` and appends each sanitized
+    interaction with its duration to `cassette`."""
+
+    def __init__(self, cassette, transport=None, sanitizer=None):
+        self.cassette = cassette
+        self.transport = transport or RequestsTransport()
+        self.sanitizer = sanitizer or Sanitizer()
+
+    def __enter__(self):
+        self.transport.__enter__()
+        return self
+
+    def __exit__(self, *args):
+        self.transport.__exit__(*args)
+
+    def open(self):
+        self.transport.open()
+
+    def close(self):
+        self.transport.close()
+
+    def send(self, request, **kwargs):
+        start = time.perf_counter()
+        response = self.transport.send(request, **kwargs)
+        body = _get_response_body(response)
+        duration = time.perf_counter() - start
+        try:
+            self.cassette.append({
+                'method': request.method,
+                'url': self.sanitizer.sanitize_text(request.url),
+                'request_body': self.sanitizer.sanitize_body(_get_request_body(request)),
+                'status': response.status_code,
+                'headers': {k.lower(): self.sanitizer.sanitize_text(v)
+                            for k, v in response.headers.items() if k.lower() in KEPT_HEADERS},
+                'body': self.sanitizer.sanitize_body(body),
+                'response_bytes': len(body or b''),
+                'duration': round(duration, 6),
+            })
+        except Exception as e:
+            # Recording must not break the call being recorded
+            logger.warning('Failed to record %s %s: %s', request.method, request.url, e)
+        return response
+
+
+class ReplayResponse(HttpResponse):
+    """A recorded response to an `azure.core.rest` request, fully read."""
+
+    def __init__(self, request, status_code, headers, content):
+        self._request = request
+        self._status_code = status_code
+        self._headers = headers
+        self._content = content
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def request(self):
+        return self._request
+
+    @property
+    def status_code(self):
+        return self._status_code
+
+    @property
+    def headers(self):
+        return self._headers
+
+    @property
+    def reason(self):
+        return 'Replayed'
+
+    @property
+    def content_type(self):
+        return self._headers.get('content-type')
+
+    @property
+    def url(self):
+        return self._request.url
+
+    @property
+    def encoding(self):
+        return 'utf-8'
+
+    @property
+    def is_closed(self):
+        return self._closed
+
+    @property
+    def is_stream_consumed(self):
+        return True
+
+    @property
+    def content(self):
+        return self._content
+
+    def read(self):
+        return self._content
+
+    def text(self, encoding=None):
+        return self._content.decode(encoding or 'utf-8')
+
+    def json(self):
+        return json.loads(self._content) if self._content else None
+
+    def raise_for_status(self):
+        if self._status_code >= 400:
+            raise HttpResponseError(response=self)
+
+    def iter_raw(self, **kwargs):
+        yield self._content
+
+    def iter_bytes(self, **kwargs):
+        yield self._content
+
+    def close(self):
+        self._closed = True
+
+
+class ReplayPipelineResponse(PipelineHttpResponse):
+    """A recorded response to a legacy `azure.core.pipeline` request."""
+
+    def __init__(self, request, status_code, headers, content):
+        super().__init__(request, None)
+        self.status_code = status_code
+        self.headers = headers
+        self.reason = 'Replayed'
+        self.content_type = headers.get('content-type')
+        self._content = content
+
+    def body(self):
+        return self._content
+
+
+class ReplayTransport(HttpTransport):
+    """Serves the interactions of a cassette instead of calling Azure.
+
+    Requests are matched on method, path and query, api-version aside, and
+    served in recorded order. The last response for a request is repeated
+    once the recorded ones are used up, as for polled tickets. Each response
+    is delayed by its recorded duration times `time_scale`, 0 replays as
+    fast as possible.
+    """
+
+    def __init__(self, cassette, time_scale=0.0):
+        self.time_scale = time_scale
+        self.interactions = defaultdict(deque)
+        for interaction in cassette.interactions:
+            self.interactions[_get_match_key(interaction['method'], interaction['url'])].append(interaction)
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def _next_interaction(self, request):
+        key = _get_match_key(request.method, request.url)
+        with self.lock:
+            queue = self.interactions.get(key)
+            if not queue:
+                raise CassetteMismatch(f'No recorded response for {request.method} {request.url}')
+            return queue.popleft() if len(queue) > 1 else queue[0]
+
+    def send(self, request, **kwargs):
+        interaction = self._next_interaction(request)
+        if self.time_scale:
+            time.sleep(interaction['duration'] * self.time_scale)
+        body = interaction['body']
+        content = b'' if body is None else (body if isinstance(body, str) else json.dumps(body)).encode('utf-8')
+        headers = CaseInsensitiveDict(interaction['headers'])
+        headers.setdefault('content-type', 'application/json')
+        response_type = ReplayResponse if isinstance(request, HttpRequest) else ReplayPipelineResponse
+        return response_type(request, interaction['status'], headers, content)
+
+
+def record_azure_traffic(path):
+    """Records the Azure calls of every SDK client created from now on to
+    a new cassette at `path`."""
+    transport = RecordingTransport(Cassette.create(path))
+    AZURE_CLIENT_KWARGS['transport'] = transport
+    logger.warning('Recording Azure traffic to %s', path)
+    return transport
+
+
+def replay_azure_traffic(path, time_scale=0.0):
+    """Serves the Azure calls of every SDK client created from now on from
+    the cassette at `path`."""
+    transport = ReplayTransport(Cassette.load(path), time_scale)
+    AZURE_CLIENT_KWARGS['transport'] = transport
+    return transport
+
+
+def format_latency_profile(profile):
+    lines = [f'{"operation":<36} {"count":>6} {"p50 ms":>8} {"p90 ms":>8} {"max ms":>8} {"avg bytes":>10}']
+    for operation, stats in profile.items():
+        lines.append(
+            f'{operation:<36} {stats["count"]:>6} {stats["p50"] * 1000:>8.1f} {stats["p90"] * 1000:>8.1f} '
+            f'{stats["max"] * 1000:>8.1f} {stats["bytes"]:>10}')
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Show the latency profile of a recorded Azure cassette')
+    parser.add_argument('cassette')
+    args = parser.parse_args()
+    print(format_latency_profile(Cassette.load(args.cassette).get_latency_profile()))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
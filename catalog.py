@@ -0,0 +1,157 @@
+import json
+import logging
+import re
+import threading
+import time
+
+from structured_logging import log_event
+
+logger = logging.getLogger(__name__)
+
+
+def map_services(services):
+    """Groups the services of a Support `services` list response by service
+    group, without the Preview services, sorted by group and display name."""
+    grouped = {}
+    for service in services:
+        props = service.get("properties", {})
+        display_name = props.get("displayName")
+        service_id = service.get("id")
+        resourceTypes = props.get("resourceTypes", [])
+        metadata = props.get("metadata", {})
+        group_ids_str = metadata.get("groupIds", "").replace("ServiceGroup", "")
+
+        # For readability, add empty space before each upper Latter.
+        group_ids_str = re.sub(r'(?<!^)([A-Z])', r' \1', group_ids_str)
+
+        # groupIds can be comma-separated, so split and strip
+        group_ids = [gid.strip() for gid in group_ids_str.split(",") if gid.strip()]
+
+        for group_id in group_ids:
+            if ' - Preview' not in display_name:
+                grouped.setdefault(group_id, []).append({
+                    "id": service_id,
+                    "displayName": display_name,
+                    "resourceTypes": resourceTypes
+                })
+
+    # Sort groupIds and services within each group
+    sorted_grouped = {}
+    for group_id in sorted(grouped):
+        sorted_grouped[group_id] = sorted(grouped[group_id], key=lambda x: x["displayName"].lower())
+    return sorted_grouped
+
+
+def shorten_service_ids(dataset):
+    # Optimize to reduce bite transfer over wire
+    for group, services in dataset.items():
+        for s in services:
+            s['id'] = s['id'].split('/')[-1]
+    return dataset
+
+
+def load_support_services(path):
+    """Reads a saved Support `services` list response, the local stand-in
+    for the Azure call."""
+    with open(path) as f:
+        return json.load(f)['value']
+
+
+class ServiceCatalog:
+    """The grouped services and the indexes the options handlers search.
+
+    Never changed once built: a refresh builds a new catalog and swaps it
+    in, so a request reading `LiveServiceCatalog.current` once sees one
+    consistent catalog.
+    """
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+        self.resource_types_by_service_id = {
+            s['id']: s['resourceTypes'] for services in dataset.values() for s in services
+        }
+        # Lower cased once here instead of on every keystroke
+        self.search_index = tuple(
+            (group, group.lower(), services, tuple(s.get('displayName', '').lower() for s in services))
+            for group, services in dataset.items()
+        )
+
+    def __len__(self):
+        return len(self.resource_types_by_service_id)
+
+    def filter_by_prefix(self, prefix):
+        prefix_lower = prefix.lower()
+        filtered = {}
+        for group, group_lower, services, names in self.search_index:
+            # If group name matches, include all services in this group
+            if group_lower.startswith(prefix_lower):
+                filtered[group] = services
+            else:
+                # Otherwise, filter services by displayName
+                matched_services = [s for s, name in zip(services, names) if name.startswith(prefix_lower)]
+                if matched_services:
+                    filtered[group] = matched_services
+        return filtered
+
+    def _get_entries(self):
+        entries = {}
+        for group, services in self.dataset.items():
+            for s in services:
+                display_name, resource_types, groups = entries.get(s['id'], (s['displayName'], s['resourceTypes'], ()))
+                entries[s['id']] = (display_name, tuple(resource_types), groups + (group,))
+        return entries
+
+    def diff(self, other):
+        """Returns the ids of the services (added, removed, changed) in
+        `other` compared to this catalog."""
+        old, new = self._get_entries(), other._get_entries()
+        added = sorted(new.keys() - old.keys())
+        removed = sorted(old.keys() - new.keys())
+        changed = sorted(k for k in old.keys() & new.keys() if old[k] != new[k])
+        return added, removed, changed
+
+
+class LiveServiceCatalog:
+    """Holds the current service catalog and refreshes it from the Support
+    services list in the background.
+
+    The new catalog and its indexes are built on the refresh thread and
+    swapped in with a single assignment, options requests keep reading the
+    previous one until then and never wait for a refresh.
+    """
+
+    REFRESH_SECONDS = 12 * 60 * 60
+    RETRY_SECONDS = 5 * 60
+
+    def __init__(self, catalog):
+        self.current = catalog
+        self.refreshed_at = None
+
+    def refresh(self, services):
+        """Swaps in the catalog mapped from the raw `services` if it differs
+        from the current one. Returns the diff."""
+        catalog = ServiceCatalog(shorten_service_ids(map_services(services)))
+        if not len(catalog):
+            # A failed or truncated listing must not empty the service select
+            raise ValueError('Refusing to swap in an empty service catalog')
+        added, removed, changed = self.current.diff(catalog)
+        if added or removed or changed:
+            self.current = catalog
+        self.refreshed_at = time.time()
+        log_event(logger, logging.INFO, 'catalog.refreshed', services=len(catalog),
+                  added=added, removed=removed, changed=changed)
+        return added, removed, changed
+
+    def start(self, fetch, interval=REFRESH_SECONDS):
+        """Refreshes from `fetch()` every `interval` seconds on a daemon
+        thread, the bundled catalog serves until the first refresh."""
+        threading.Thread(target=self._refresh_periodically, args=(fetch, interval), daemon=True).start()
+
+    def _refresh_periodically(self, fetch, interval):
+        while True:
+            try:
+                self.refresh(fetch())
+                time.sleep(interval)
+            except Exception as e:
+                logger.exception("Exception in refreshing the service catalog: %s", e)
+                time.sleep(min(interval, self.RETRY_SECONDS))
@@ -0,0 +1,170 @@
+import logging
+import threading
+import time
+import tracemalloc
+
+from metrics import (
+    AZURE_CALLS, CACHE_REQUESTS, SLACK_CALLS, clear_cache, get_cache_reset_time, get_caches, get_executors
+)
+from token_cache import ARM_SCOPE
+
+logger = logging.getLogger(__name__)
+
+USAGE = (
+    "Diagnostics commands:\n"
+    "• diag - Caches, subscription preloader, executors and API call rates\n"
+    "• diag memory - Top memory consumers (starts tracing on first use)\n"
+    "• diag invalidate <cache>|all - Clear a cache\n"
+    "• diag warm subscriptions - Reload the subscription list\n"
+    "• diag warm resources <subscription id> <service id> - Load the resources and problem types of a service\n"
+    "• diag warm token - Get the Azure access token, a new one after `diag invalidate azure_token`"
+)
+
+
+def _format_age(seconds):
+    if seconds is None:
+        return 'never'
+    if seconds < 120:
+        return f'{seconds:.0f}s'
+    if seconds < 2 * 60 * 60:
+        return f'{seconds / 60:.0f}m'
+    return f'{seconds / 3600:.1f}h'
+
+
+def _format_bytes(nbytes):
+    for unit in ('B', 'KiB', 'MiB'):
+        if nbytes < 1024:
+            return f'{nbytes:.0f}{unit}'
+        nbytes /= 1024
+    return f'{nbytes:.1f}GiB'
+
+
+def _format_fill(cache):
+    """Fill level against the cache's limit, bytes for memory bounded caches."""
+    maxsize = getattr(cache, 'maxsize', None)
+    if maxsize is None:
+        return '-'
+    # cachetools sets getsizeof on the instance when one is passed in
+    if 'getsizeof' in vars(cache):
+        return f'{_format_bytes(cache.currsize)}/{_format_bytes(maxsize)}'
+    return f'{cache.currsize}/{maxsize}'
+
+
+def _sum_calls(counter):
+    with counter.lock:
+        return sum(counter.values.values())
+
+
+class Diagnostics:
+    """Runtime introspection behind the admin-only `diag` mention command.
+
+    Reads the caches and executors registered with the metrics module, so
+    new ones show up without changes here. Call rates are per minute since
+    the previous `diag`, the first one covers the time since startup.
+    """
+
+    MEMORY_TOP = 10
+
+    def __init__(self, services, admin_user_ids):
+        self.services = services
+        self.admin_user_ids = frozenset(admin_user_ids)
+        self.lock = threading.Lock()
+        self.last_sample = (time.monotonic(), _sum_calls(AZURE_CALLS), _sum_calls(SLACK_CALLS))
+
+    def is_admin(self, user_id):
+        return user_id in self.admin_user_ids
+
+    def handle(self, user_id, args):
+        """Returns the reply to `diag <args>` from `user_id`."""
+        if not self.is_admin(user_id):
+            logger.warning("Diagnostics requested by non-admin user %s", user_id)
+            return "Sorry, diagnostics are only available to the bot's admins."
+        if not args:
+            return self.get_report()
+        command, rest = args[0], args[1:]
+        if command == 'memory':
+            return self.get_memory_report()
+        if command == 'invalidate' and len(rest) == 1:
+            return self.invalidate(rest[0])
+        if command == 'warm' and rest:
+            return self.warm(rest[0], rest[1:])
+        return USAGE
+
+    def get_report(self):
+        return '\n\n'.join((
+            self.get_cache_report(), self.get_preloader_report(), self.get_executor_report(),
+            self.get_call_rate_report()))
+
+    def get_cache_report(self):
+        now = time.time()
+        lines = [f'{"cache":<32} {"entries":>8} {"fill":>17} {"hit ratio":>9} {"age":>6}']
+        for name, cache in sorted(get_caches().items()):
+            hits, misses = CACHE_REQUESTS.get(name, 'hit'), CACHE_REQUESTS.get(name, 'miss')
+            ratio = f'{hits / (hits + misses) * 100:.0f}%' if hits + misses else '-'
+            reset = get_cache_reset_time(name)
+            age = _format_age(now - reset if reset else None)
+            lines.append(f'{name:<32} {len(cache):>8} {_format_fill(cache):>17} {ratio:>9} {age:>6}')
+        return '*Caches* (age since created or invalidated)\n```' + '\n'.join(lines) + '\n```'
+
+    def get_preloader_report(self):
+        azure_support = self.services.azure_support
+        loaded_at = azure_support.subscriptions_loaded_at
+        loaded = f'last loaded {_format_age(time.time() - loaded_at)} ago' if loaded_at else 'not loaded yet'
+        return f'*Subscription preloader*\n{len(azure_support.sub_list)} subscriptions, {loaded}'
+
+    def get_executor_report(self):
+        lines = [f'{"executor":<20} {"queued":>7} {"running":>8} {"max":>5}']
+        for name, executor in sorted(get_executors().items()):
+            lines.append(f'{name:<20} {executor.queued:>7} {executor.running:>8} {executor.max_workers:>5}')
+        return '*Executors*\n```' + '\n'.join(lines) + '\n```'
+
+    def get_call_rate_report(self):
+        now, azure_calls, slack_calls = time.monotonic(), _sum_calls(AZURE_CALLS), _sum_calls(SLACK_CALLS)
+        with self.lock:
+            last_time, last_azure_calls, last_slack_calls = self.last_sample
+            self.last_sample = (now, azure_calls, slack_calls)
+        minutes = max(now - last_time, 1) / 60
+        return (
+            f'*API calls* (per minute over the last {_format_age(now - last_time)})\n'
+            f'Azure: {(azure_calls - last_azure_calls) / minutes:.1f}/min, {azure_calls} in total\n'
+            f'Slack: {(slack_calls - last_slack_calls) / minutes:.1f}/min, {slack_calls} in total')
+
+    def get_memory_report(self):
+        if not tracemalloc.is_tracing():
+            # Tracing slows allocations down, so it only runs once asked for
+            tracemalloc.start()
+            return ('Started memory tracing. Run `diag memory` again in a while to see what allocated '
+                    'since then.')
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        ))
+        current, peak = tracemalloc.get_traced_memory()
+        lines = [f'{_format_bytes(stat.size):>9} {stat.count:>8}  {stat.traceback[0]}'
+                 for stat in snapshot.statistics('lineno')[:self.MEMORY_TOP]]
+        return (f'*Memory* traced {_format_bytes(current)}, peak {_format_bytes(peak)}\n'
+                f'```{"size":>9} {"blocks":>8}  allocated at\n' + '\n'.join(lines) + '\n```')
+
+    def invalidate(self, name):
+        caches = get_caches()
+        names = sorted(caches) if name == 'all' else [name]
+        unknown = [n for n in names if n not in caches]
+        if unknown:
+            return f"Unknown cache `{unknown[0]}`. Known caches: {', '.join(sorted(caches))}"
+        for n in names:
+            clear_cache(n)
+        logger.warning("Caches invalidated from Slack: %s", ', '.join(names))
+        return f"Invalidated {', '.join(names)}."
+
+    def warm(self, target, args):
+        if target == 'subscriptions':
+            self.services.azure_support.refresh_subscription_list()
+            return f'Reloaded {len(self.services.azure_support.sub_list)} subscriptions.'
+        if target == 'resources' and len(args) == 2:
+            futures = self.services.options_handler.prefetch(*args)
+            return f'Loading {len(futures)} resource type(s) and the problem types in the background.'
+        if target == 'token':
+            # Fetches a new token when the cached one was invalidated
+            token = self.services.azure_credentials.get_token(ARM_SCOPE)
+            return f'Azure access token valid for {_format_age(token.expires_on - time.time())}.'
+        return USAGE
@@ -1,5 +1,6 @@
 import json
-import re
+
+from catalog import map_services
 
 dataset_services_file_path = "data/dataset_services.json"
 
@@ -8,34 +9,7 @@ def map_dataset_services(filepath):
     with open(filepath, "r") as f:
         data = json.load(f)["value"]
 
-    grouped = {}
-    for service in data:
-        props = service.get("properties", {})
-        display_name = props.get("displayName")
-        service_id = service.get("id")
-        resourceTypes = props.get("resourceTypes", [])
-        metadata = props.get("metadata", {})
-        group_ids_str = metadata.get("groupIds", "").replace("ServiceGroup", "")
-
-        # For readability, add empty space before each upper Latter.
-        group_ids_str = re.sub(r'(?<!^)([A-Z])', r' \1', group_ids_str)
-
-        # groupIds can be comma-separated, so split and strip
-        group_ids = [gid.strip() for gid in group_ids_str.split(",") if gid.strip()]
-
-        for group_id in group_ids:
-            if ' - Preview' not in display_name:
-                grouped.setdefault(group_id, []).append({
-                    "id": service_id,
-                    "displayName": display_name,
-                    "resourceTypes": resourceTypes
-                })
-
-    # Sort groupIds and services within each group
-    sorted_grouped = {}
-    for group_id in sorted(grouped):
-        sorted_grouped[group_id] = sorted(grouped[group_id], key=lambda x: x["displayName"].lower())
-
+    sorted_grouped = map_services(data)
     print(json.dumps(sorted_grouped, indent=2))
     return sorted_grouped
 
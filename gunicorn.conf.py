@@ -0,0 +1,64 @@
+import multiprocessing
+import os
+import shutil
+import signal
+import tempfile
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+timeout = 30
+graceful_timeout = int(os.environ.get('GRACEFUL_TIMEOUT', 30))
+keepalive = 5
+
+# Create the app (dataset, SDKs, credential, Slack auth) once in the master
+# and fork workers from it.
+preload_app = True
+
+# Workers write their metrics here so any of them can serve /metrics for all
+_metrics_dir_created = not os.environ.get('METRICS_DIR')
+if _metrics_dir_created:
+    os.environ['METRICS_DIR'] = tempfile.mkdtemp(prefix='slack-bot-metrics-')
+
+
+def pre_fork(server, worker):
+    # Initialization runs on background threads, which are not copied into
+    # the forked worker, so it has to be complete before forking.
+    import app
+    app.services.wait_until_initialized()
+
+
+def post_fork(server, worker):
+    # The ticket sync poller, the subscription preloader and the service
+    # catalog refresh run in one elected worker, see start_background_services
+    import app
+    app.start_background_services()
+
+
+def post_worker_init(worker):
+    # Readiness drops as soon as the worker is asked to stop, before it
+    # drains its requests and executors.
+    import app
+    handle_exit = signal.getsignal(signal.SIGTERM)
+
+    def handle_sigterm(signum, frame):
+        app.shutting_down.set()
+        if callable(handle_exit):
+            handle_exit(signum, frame)
+    signal.signal(signal.SIGTERM, handle_sigterm)
+
+
+def worker_int(worker):
+    import app
+    app.shutting_down.set()
+
+
+def worker_exit(server, worker):
+    import app
+    app.shutdown()
+
+
+def on_exit(server):
+    if _metrics_dir_created:
+        shutil.rmtree(os.environ['METRICS_DIR'], ignore_errors=True)
@@ -1,22 +1,103 @@
+import itertools
 import logging
+import threading
+from functools import partial
+from typing import TYPE_CHECKING
 
-from cachetools import cached, TTLCache
-from azure.identity import ChainedTokenCredential
+from cachetools import LRUCache
 from azure_support import AzureSupportHelper
 from slack_sdk import WebClient
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, wait
 from helpers import Blocks
+from inventory import get_cached_size
+from metrics import OPTIONS_RESULTS, get_shared_executor, register_cache
+from structured_logging import log_event
+from tracing import submit_with_context, traced
+from workspaces import get_partition_name
+from ticket_sync import TicketSyncEngine
+from ticket_drafts import TicketDrafts
+from attachments import AttachmentUploader
+from ticket_fanout import TicketFanOut, get_ticket_targets
+from ticket_index import TicketIndex
+if TYPE_CHECKING:
+    from azure.identity import ChainedTokenCredential
 
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
+# Memory for the last complete options of each select, served when Azure is slow
+SNAPSHOT_CACHE_BYTES = 32 * 1024 * 1024
+
+# Value of the placeholder option offered while a select's options load
+LOADING_VALUE = '__loading__'
+
+
+def _get_loading_option(what):
+    return {"text": {"type": "plain_text", "text": f"Still loading {what}, type to refresh"}, "value": LOADING_VALUE}
+
+
 class OptionsHandler:
+    """Builds the options of the modal's external selects.
 
-    def __init__(self, credentials: ChainedTokenCredential, azure_support: AzureSupportHelper):
+    Slack drops options responses after about three seconds, so the resource
+    and problem classification selects are answered against a deadline. The
+    Azure lookups run on a background pool and keep filling the caches after
+    it; until they finish, the response is built from the resource types
+    already fetched, the last complete result, or a placeholder asking the
+    user to type again.
+    """
+
+    DEADLINE_SECONDS = 2.0
+    FETCH_WORKERS = 8
+
+    def __init__(self, credentials: 'ChainedTokenCredential', azure_support: AzureSupportHelper,
+                 deadline_seconds=DEADLINE_SECONDS, fetch_workers=FETCH_WORKERS, executor=None,
+                 cache_partition=None, snapshot_cache_bytes=SNAPSHOT_CACHE_BYTES):
         self.credentials = credentials
         self.azure_support = azure_support
+        self.deadline_seconds = deadline_seconds
+        self.executor = get_shared_executor(executor, 'options_fetch', fetch_workers)
+        self.fetches = {}
+        self.snapshots = LRUCache(maxsize=snapshot_cache_bytes, getsizeof=get_cached_size)
+        register_cache(get_partition_name('options_snapshots', cache_partition), self.snapshots)
+        self.lock = threading.Lock()
+
+    def _fetch(self, key, fn, *args):
+        """Returns the running fetch of `key` or starts one."""
+        with self.lock:
+            future = self.fetches.get(key)
+            if future is not None:
+                return future
+            future = self.fetches[key] = submit_with_context(self.executor, fn, *args)
+        future.add_done_callback(partial(self._fetch_done, key))
+        return future
+
+    def _fetch_done(self, key, future):
+        with self.lock:
+            if self.fetches.get(key) is future:
+                del self.fetches[key]
+            if future.cancelled():
+                return
+            if future.exception() is None:
+                try:
+                    self.snapshots[key] = future.result()
+                except ValueError:
+                    # Larger than the whole snapshot cache
+                    pass
+        if future.exception() is not None:
+            logger.info("Background fetch of %s failed: %s", key, future.exception())
+
+    def _get_result_or_snapshot(self, key, future):
+        """Returns (result, state) with state 'fresh', 'stale' or 'missing'."""
+        if future.done() and not future.cancelled() and future.exception() is None:
+            return future.result(), 'fresh'
+        with self.lock:
+            snapshot = self.snapshots.get(key)
+        if snapshot is not None:
+            return snapshot, 'stale'
+        return None, 'missing'
 
+    @traced
     def get_select_azure_sub(self, user_input):
         input_list = self.azure_support.get_subscription_list()
         options = []
@@ -26,6 +107,7 @@ class OptionsHandler:
             )
         return options
 
+    @traced
     def get_select_azure_service(self, user_input, private_metadata):
         data_option_groups = self.azure_support.slack_get_support_services_filter_by_prefix(user_input)
         option_groups = []
@@ -44,21 +126,56 @@ class OptionsHandler:
             })
         return option_groups
 
-    @cached(cache=TTLCache(maxsize=1024, ttl=60 * 60))
-    def get_select_azure_subscription_resources(self, subscription_id, select_azure_service_id):
-        resource_types = self.azure_support.get_resource_types_by_service_id(select_azure_service_id)
-        logger.debug(f'Resource types for service {select_azure_service_id}: {resource_types}')
-        data_option_groups = self.azure_support.get_sub_resources_by_resource_type_concurrent(
-            self.credentials, subscription_id, tuple(resource_types)
-        )
+    def _fetch_resources(self, subscription_id, select_azure_service_id, resource_types=None):
+        if resource_types is None:
+            resource_types = self.azure_support.get_resource_types_by_service_id(select_azure_service_id)
+        log_event(logger, logging.DEBUG, 'options.resource_types',
+                  service_id=select_azure_service_id, resource_types=resource_types)
+        fetches = {}
+        for rt in resource_types:
+            key = ('resources', subscription_id, rt)
+            fetches[key] = self._fetch(
+                key, self.azure_support.get_sub_resources_by_resource_type, self.credentials, subscription_id, rt)
+        return fetches
+
+    def _fetch_problem_classifications(self, subscription_id, support_service_id):
+        key = ('problem_classifications', subscription_id, support_service_id)
+        return key, self._fetch(
+            key, self.azure_support.get_problem_classifications_list,
+            self.credentials, subscription_id, support_service_id)
+
+    @traced
+    def get_select_azure_subscription_resources(self, subscription_id, select_azure_service_id, timeout=None):
+        """Returns the resources grouped by resource group and 'complete',
+        'stale' (some resource types from the last snapshot) or 'partial'
+        (some still loading) once all resource types are fetched or after
+        `timeout` seconds."""
+        fetches = self._fetch_resources(subscription_id, select_azure_service_id)
+        wait(fetches.values(), timeout=timeout)
+
+        inventories = []
+        status = 'complete'
+        for key, future in fetches.items():
+            result, state = self._get_result_or_snapshot(key, future)
+            if state == 'missing':
+                # A failed resource type is left out, like before
+                if not future.done():
+                    status = 'partial'
+                continue
+            if state == 'stale' and status == 'complete':
+                status = 'stale'
+            inventories.append(result)
 
-        return data_option_groups
+        return AzureSupportHelper.group_by_resource_group(itertools.chain.from_iterable(inventories)), status
 
+    @traced
     def get_select_azure_subscription_resources_mapped(self, private_metadata):
         subscription_id = private_metadata['select_azure_subscription']
         select_azure_service_id = private_metadata['select_azure_service']
 
-        data_option_groups = self.get_select_azure_subscription_resources(subscription_id, select_azure_service_id)
+        data_option_groups, status = self.get_select_azure_subscription_resources(
+            subscription_id, select_azure_service_id, timeout=self.deadline_seconds)
+        OPTIONS_RESULTS.inc(Blocks.AZURE_RESOURCE, status)
         logger.debug('Fetched sub-resources for Azure subscription')
         option_groups = []
         for dog in data_option_groups:
@@ -83,12 +200,27 @@ class OptionsHandler:
             },
             "options": options
         })
-        logger.debug(f'Option groups for resources: {option_groups}')
+        if status == 'partial':
+            option_groups.append({
+                "label": {"type": "plain_text", "text": "Loading"},
+                "options": [_get_loading_option('resources')]
+            })
+        log_event(logger, logging.DEBUG, 'options.resources', option_groups=len(option_groups), status=status)
         return option_groups
 
-    def get_problem_classifications_options(self, subscription_id, support_service_id):
-        problem_classifications = self.azure_support.get_problem_classifications_list(
-            self.credentials, subscription_id, support_service_id)
+    @traced
+    def get_problem_classifications_options(self, subscription_id, support_service_id, timeout=None):
+        """Returns the problem classifications as options or option groups,
+        or None if they are not loaded after `timeout` seconds."""
+        key, future = self._fetch_problem_classifications(subscription_id, support_service_id)
+        wait([future], timeout=timeout)
+        if future.done():
+            # Raises when the lookup failed
+            problem_classifications, state = future.result(), 'fresh'
+        else:
+            problem_classifications, state = self._get_result_or_snapshot(key, future)
+            if state == 'missing':
+                return None
 
         option_groups = {}
         options = []
@@ -109,14 +241,24 @@ class OptionsHandler:
                 })
 
         if option_groups:
-            return {"type": "option_groups", "values": option_groups}
+            return {"type": "option_groups", "values": option_groups, "stale": state == 'stale'}
 
-        return {"type": "options", "values": options}
+        return {"type": "options", "values": options, "stale": state == 'stale'}
 
+    @traced
     def get_select_azure_service_problem_classifications(self, private_metadata):
         subscription_id = private_metadata['select_azure_subscription']
         select_azure_service_id = private_metadata['select_azure_service']
-        input_data = self.get_problem_classifications_options(subscription_id, select_azure_service_id)
+        input_data = self.get_problem_classifications_options(
+            subscription_id, select_azure_service_id, timeout=self.deadline_seconds)
+        if input_data is None:
+            OPTIONS_RESULTS.inc(Blocks.AZURE_SERVICE_PROBLEM_CLASSIFICATIONS, 'partial')
+            return {
+                'type': 'options',
+                'values': [_get_loading_option('problem types')],
+            }
+        OPTIONS_RESULTS.inc(Blocks.AZURE_SERVICE_PROBLEM_CLASSIFICATIONS,
+                            'stale' if input_data['stale'] else 'complete')
         option_type = input_data['type']
         input_list = input_data['values']
         response = None
@@ -145,42 +287,72 @@ class OptionsHandler:
                     "options": options
                 })
             response = option_groups
-        logger.debug(f'Problem classifications response: {response}')
+        log_event(logger, logging.DEBUG, 'options.problem_classifications',
+                  type=option_type, count=len(response))
         return {
             'type': option_type,
             'values': response,
         }
 
+    def prefetch(self, subscription_id, select_azure_service_id, resource_types=None):
+        """Starts loading the options of a subscription and service without
+        waiting for them, only of `resource_types` if given. Returns the
+        fetches."""
+        fetches = list(self._fetch_resources(subscription_id, select_azure_service_id, resource_types).values())
+        fetches.append(self._fetch_problem_classifications(subscription_id, select_azure_service_id)[1])
+        return fetches
+
 
 class SupportTicketSubmissionHandler:
 
     def __init__(self, submitted_data_as_dict, private_metadata,
-                 azure_support: AzureSupportHelper, client: WebClient, executor: ThreadPoolExecutor):
+                 azure_support: AzureSupportHelper, client: WebClient, executor: ThreadPoolExecutor,
+                 ticket_sync: TicketSyncEngine = None, attachment_uploader: AttachmentUploader = None,
+                 ticket_drafts: TicketDrafts = None, view_id=None, ticket_fanout: TicketFanOut = None,
+                 ticket_index: TicketIndex = None):
         self.data = submitted_data_as_dict
         self.private_metadata = private_metadata
         self.azure_support = azure_support
         self.client = client
         self.executor = executor
+        self.ticket_sync = ticket_sync
+        self.attachment_uploader = attachment_uploader
+        self.ticket_drafts = ticket_drafts
+        self.view_id = view_id
+        self.ticket_fanout = ticket_fanout
+        self.ticket_index = ticket_index
+        self.posted_channel = None
 
+    @traced
     def handle(self):
-        logger.debug(f'Flat data for support: {self.data}')
-        logger.debug(f'Private metadata: {self.private_metadata}')
+        log_event(logger, logging.DEBUG, 'ticket.submission',
+                  data=self.data, private_metadata=self.private_metadata)
 
-        # Prepare resource_id
+        targets = get_ticket_targets(self.data)
+        if len(targets) > 1 and self.ticket_fanout is not None:
+            submit_with_context(self.executor, self._submit_support_tickets, targets)
+            logger.info('Support ticket fan-out to %d targets submitted', len(targets))
+            return
+
+        # Usually resolved while the modal was filled in, otherwise the
+        # resource lookup runs with the submission job.
+        ticket = self.ticket_drafts.build_ticket(self.view_id, self.data) if self.ticket_drafts else None
+        submit_with_context(self.executor, self._submit_support_ticket, self.data, self.private_metadata, ticket)
+        logger.info('Support ticket submission task submitted')
+
+    def _build_support_ticket(self, data):
         try:
-            subscription_id = self.data[Blocks.AZURE_SUBSCRIPTION]
-            azure_service_id = self.data[Blocks.AZURE_SERVICE]
-            resource_hash = self.data[Blocks.AZURE_RESOURCE]
-            self.data['resource_id'] = self.azure_support.get_resource_id_by_resource_hash(
+            subscription_id = data[Blocks.AZURE_SUBSCRIPTION]
+            azure_service_id = data[Blocks.AZURE_SERVICE]
+            resource_hash = data.get(Blocks.AZURE_RESOURCE)
+            data['resource_id'] = self.azure_support.get_resource_id_by_resource_hash(
                 subscription_id, azure_service_id, resource_hash
             )
         except Exception as e:
-            logger.exception(f"Failed to get resource_id: {e}")
-            self._send_slack_error(self.private_metadata, "Failed to get resource ID.")
-            return
-
-        self.executor.submit(self._submit_support_ticket, self.data, self.private_metadata)
-        logger.info('Support ticket submission task submitted')
+            logger.exception("Failed to get resource_id: %s", e)
+            self._send_slack_error("Failed to get resource ID.")
+            return None
+        return self.azure_support.build_support_ticket(data)
 
     def _send_slack_error(self, text):
         channel_id = self.private_metadata.get('channel_select_block')
@@ -194,37 +366,54 @@ class SupportTicketSubmissionHandler:
         }
         self._handle_slack_post_msg('channel', slack_data)
 
-    def _submit_support_ticket(self, data, private_metadata):
+    def _submit_support_ticket(self, data, private_metadata, ticket=None):
         try:
+            if ticket is None:
+                ticket = self._build_support_ticket(data)
+                if ticket is None:
+                    return
             logger.info('Submitting Azure support ticket...')
-            res = self.azure_support.submit_support_ticket(data)
+            res = self.azure_support.create_support_ticket(*ticket)
             if res['success']:
-                self._notify_slack_success(res)
+                self._index_ticket(res, data.get(Blocks.AZURE_RESOURCE_TEXT))
+                thread_ts = self._notify_slack_success(res)
+                self._upload_attachments(res, thread_ts)
             else:
                 logger.warning('Azure support ticket creation failed')
-                self._send_slack_error(private_metadata, "Hello! We had some trouble creating the support ticket.")
+                self._send_slack_error("Hello! We had some trouble creating the support ticket.")
             logger.info('Support ticket submission finished')
         except Exception as e:
-            logger.exception(f"Exception in submit_support_ticket: {e}")
-            self._send_slack_error(private_metadata, "Hello! We had some trouble creating the support ticket.")
+            logger.exception("Exception in submit_support_ticket: %s", e)
+            self._send_slack_error("Hello! We had some trouble creating the support ticket.")
 
-    def _notify_slack_success(self, res):
-        channel_id = self.data.get('channel_select_block')
-        user_id = self.private_metadata.get('user_id')
-        channel = channel_id if channel_id else user_id
-        text = (
-            "Hello! Your support request has been successfully processed. "
-            "Additional information can be found in the thread."
-        )
-        if channel_id:
-            text = text.replace('Hello!', f'Hello <@{user_id}>!')
-        slack_data = {
-            'channel': channel,
-            'blocks': [{"type": "section", "text": {"type": "mrkdwn", "text": text}}]
-        }
-        thread_ts = self._handle_slack_post_msg('channel', slack_data)
+    def _submit_support_tickets(self, targets):
+        try:
+            channel_id = self.data.get('channel_select_block')
+            user_id = self.private_metadata.get('user_id')
+            self.ticket_fanout.file_tickets(
+                self.data, targets, channel_id or user_id, user_id, self._get_summary_text(), self.view_id,
+                mention=bool(channel_id))
+            for target in targets:
+                if (target.result or {}).get('success'):
+                    self._index_ticket(target.result, target.resource_text if target.resource_hash else None)
+        except Exception as e:
+            logger.exception("Exception in submit_support_tickets: %s", e)
+            self._send_slack_error("Hello! We had some trouble creating the support tickets.")
+
+    def _index_ticket(self, res, resource_text):
+        if self.ticket_index is None or not res.get('ticket_name'):
+            return
+        try:
+            self.ticket_index.add_ticket(
+                res['ticket_name'], self.data.get(Blocks.SUBJECT), self.data.get(Blocks.PROBLEM_DETAILS),
+                self.data.get(Blocks.AZURE_SERVICE), self.data.get(Blocks.AZURE_SERVICE_TEXT),
+                self.data.get(Blocks.AZURE_SERVICE_PROBLEM_CLASSIFICATIONS_TEXT), resource_text, res['url'])
+        except Exception as e:
+            # The ticket is filed, only the suggestions miss it
+            logger.exception("Exception in indexing the support ticket: %s", e)
 
-        msg_data = (
+    def _get_summary_text(self):
+        return (
             "Subject: {subject}\n"
             "Problem details: {problem_details}\n\n"
             "Subscription: {subscription_text} ({subscription})\n"
@@ -242,6 +431,24 @@ class SupportTicketSubmissionHandler:
             resource_text=self.data.get(Blocks.AZURE_RESOURCE_TEXT, 'N/A. General question'),
             severity_text=self.data.get(Blocks.SEVERITY_TEXT, '')
         )
+
+    def _notify_slack_success(self, res):
+        channel_id = self.data.get('channel_select_block')
+        user_id = self.private_metadata.get('user_id')
+        channel = channel_id if channel_id else user_id
+        text = (
+            "Hello! Your support request has been successfully processed. "
+            "Additional information can be found in the thread."
+        )
+        if channel_id:
+            text = text.replace('Hello!', f'Hello <@{user_id}>!')
+        slack_data = {
+            'channel': channel,
+            'blocks': [{"type": "section", "text": {"type": "mrkdwn", "text": text}}]
+        }
+        thread_ts = self._handle_slack_post_msg('channel', slack_data)
+
+        msg_data = self._get_summary_text()
         blocks = [
             {
                 "type": "section",
@@ -262,6 +469,28 @@ class SupportTicketSubmissionHandler:
         slack_data['blocks'] = blocks
         self._handle_slack_post_msg('thread', slack_data)
 
+        if self.ticket_sync and thread_ts and res.get('ticket_name'):
+            self.ticket_sync.register_ticket(
+                res['ticket_name'], res['subscription_id'], self.posted_channel, thread_ts)
+
+        return thread_ts
+
+    def _upload_attachments(self, res, thread_ts):
+        files = self.data.get(Blocks.FILE_ATTACHMENTS)
+        if not files or not self.attachment_uploader or not res.get('ticket_name'):
+            return
+
+        # The ticket name doubles as the file workspace of an existing ticket
+        uploaded = self.attachment_uploader.upload_slack_files(
+            res['subscription_id'], res['ticket_name'], files)
+        text = (f"Attached {len(uploaded)} file(s) to the support ticket."
+                if uploaded else "We had some trouble attaching the file(s) to the support ticket.")
+        self._handle_slack_post_msg('thread', {
+            'channel': self.posted_channel,
+            'thread_ts': thread_ts,
+            'blocks': [{"type": "section", "text": {"type": "mrkdwn", "text": text}}]
+        })
+
     def _handle_slack_post_msg(self, msg_type, slack_data):
         try:
             if msg_type == 'channel':
@@ -270,6 +499,9 @@ class SupportTicketSubmissionHandler:
                     channel=slack_data['channel'],
                     blocks=slack_data['blocks']
                 )
+                # A DM posted to a user id lands in the IM channel, which is
+                # what thread replies will report.
+                self.posted_channel = res.get('channel', slack_data['channel'])
                 return res['ts']
             elif msg_type == 'thread':
                 self.client.chat_postMessage(
@@ -279,4 +511,4 @@ class SupportTicketSubmissionHandler:
                     thread_ts=slack_data['thread_ts']
                 )
         except Exception as e:
-            logger.exception(f"Exception in _handle_slack_post_msg: {e}")
+            logger.exception("Exception in _handle_slack_post_msg: %s", e)
@@ -3,6 +3,8 @@ import time
 from functools import wraps
 import logging
 
+from metrics import FUNCTION_LATENCY
+
 logger = logging.getLogger(__name__)
 
 
@@ -13,11 +15,17 @@ def timeit(func):
         result = func(*args, **kwargs)
         end = time.time()
         elapsed_ms = (end - start) * 1000
-        logger.info(f"Function {func.__name__} took {elapsed_ms:.2f} ms")
+        FUNCTION_LATENCY.observe(end - start, func.__name__)
+        logger.info('Function %s took %.2f ms', func.__name__, elapsed_ms)
         return result
     return wrapper
 
 
+def escape_mrkdwn(text):
+    # Slack reads <...> as mentions and links, escaped they show as typed
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+
 class Shortcuts:
     OPEN_AZURE_SUPPORT_TICKET = 'open_azure_support_ticket'
 
@@ -37,6 +45,11 @@ class Blocks:
     CONTACT_INFO = 'section_contact_information'
     CHANNEL_TICKET_CONFIRMATION = 'select_msg_post_destination'
     PREFERRED_CONTACT_METHOD_PHONE = 'select_preferred_contact_method_phone'
+    FILE_ATTACHMENTS = 'file_attachments'
+    SIMILAR_TICKETS = 'similar_tickets'
+    ADDITIONAL_TARGETS = 'select_additional_targets'
+    ADDITIONAL_AZURE_SUBSCRIPTIONS = 'select_additional_azure_subscriptions'
+    ADDITIONAL_AZURE_RESOURCES = 'select_additional_azure_resources'
 
     CLOSING_VIEW = 'closing_view'
 
@@ -49,6 +62,8 @@ class Blocks:
     AZURE_SERVICE_PROBLEM_CLASSIFICATIONS_TEXT = 'select_azure_service_problem_classifications_text'
     AZURE_RESOURCE_TEXT = 'select_azure_resource_text'
     SEVERITY_TEXT = 'select_severity_text'
+    ADDITIONAL_AZURE_SUBSCRIPTIONS_TEXT = 'select_additional_azure_subscriptions_text'
+    ADDITIONAL_AZURE_RESOURCES_TEXT = 'select_additional_azure_resources_text'
 
 
 class BlockLoader:
@@ -80,6 +95,6 @@ class BlockLoader:
                 if block['type'] == 'input':
                     block['element']['action_id'] = action_id
                 else:
-                    logger.info(f'NOT MAPPED: {block["type"]}')
+                    logger.info('NOT MAPPED: %s', block["type"])
 
             return blocks['blocks']
@@ -0,0 +1,97 @@
+import sys
+from array import array
+
+_RESOURCE_GROUPS = '/resourceGroups/'
+
+
+class ResourceInventory:
+    """Compact list of the resources of one subscription and resource type.
+
+    Resource ids are split into the subscription head, the resource group,
+    the provider path and the resource's own segment. The first three repeat
+    across resources and are stored once in tables, so each resource keeps
+    three small indexes and the short trailing segment. The name is only
+    stored when it differs from that segment. Iterating yields
+    `{'id', 'name', 'resource_group'}` dicts built on the fly.
+    """
+
+    __slots__ = ('heads', 'groups', 'prefixes', 'head_index', 'group_index', 'prefix_index',
+                 'suffixes', 'names', 'nbytes', '_tables')
+
+    def __init__(self):
+        self.heads = []
+        self.groups = []
+        self.prefixes = []
+        self.head_index = array('I')
+        self.group_index = array('I')
+        self.prefix_index = array('I')
+        self.suffixes = []
+        self.names = {}
+        self.nbytes = 0
+        self._tables = ({}, {}, {})
+
+    @classmethod
+    def from_resources(cls, resources):
+        """Builds the inventory while consuming `resources`, an iterable of
+        objects with `id` and `name` such as an Azure SDK pager."""
+        inventory = cls()
+        for res in resources:
+            inventory.add(res.id, res.name)
+        inventory._seal()
+        return inventory
+
+    def _get_index(self, table, values, value):
+        index = table.get(value)
+        if index is None:
+            index = table[value] = len(values)
+            values.append(sys.intern(value))
+        return index
+
+    def add(self, resource_id, name):
+        start = resource_id.find(_RESOURCE_GROUPS)
+        if start < 0:
+            # Not in a resource group, such resources were never listed
+            return
+        head_end = start + len(_RESOURCE_GROUPS)
+        group, sep, tail = resource_id[head_end:].partition('/')
+        split = tail.rfind('/') + 1
+        suffix = tail[split:]
+        heads, groups, prefixes = self._tables
+        self.head_index.append(self._get_index(heads, self.heads, resource_id[:head_end]))
+        self.group_index.append(self._get_index(groups, self.groups, group))
+        self.prefix_index.append(self._get_index(prefixes, self.prefixes, f'{sep}{tail[:split]}'))
+        if name != suffix:
+            self.names[len(self.suffixes)] = name
+        self.suffixes.append(suffix)
+
+    def _seal(self):
+        # The lookup tables are only needed while adding
+        self._tables = None
+        self.nbytes = (
+            sum(sys.getsizeof(s) for s in self.heads + self.groups + self.prefixes + self.suffixes)
+            + sum(sys.getsizeof(n) for n in self.names.values())
+            + sum(a.buffer_info()[1] * a.itemsize for a in (self.head_index, self.group_index, self.prefix_index))
+            + sys.getsizeof(self.suffixes) + sys.getsizeof(self.names))
+
+    def __len__(self):
+        return len(self.suffixes)
+
+    def __iter__(self):
+        for i, suffix in enumerate(self.suffixes):
+            group = self.groups[self.group_index[i]]
+            yield {
+                'id': f'{self.heads[self.head_index[i]]}{group}{self.prefixes[self.prefix_index[i]]}{suffix}',
+                'name': self.names.get(i, suffix),
+                'resource_group': group,
+            }
+
+
+def get_cached_size(value):
+    """Size of a cache entry in bytes, for caches bounded by memory."""
+    nbytes = getattr(value, 'nbytes', None)
+    if nbytes is not None:
+        return nbytes
+    if isinstance(value, list):
+        # Lists of SDK models, a rough per-object estimate
+        return sys.getsizeof(value) + 512 * len(value)
+    return sys.getsizeof(value)
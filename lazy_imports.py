@@ -0,0 +1,46 @@
+import importlib
+import threading
+
+_lazy_imports = []
+
+
+class LazyImport:
+    """Stands in for a class of a slow-to-import package (the Azure SDKs) and
+    imports it on first call or attribute access."""
+
+    __slots__ = ('module_name', 'name', '_target', '_lock')
+
+    def __init__(self, module_name, name):
+        self.module_name = module_name
+        self.name = name
+        self._target = None
+        self._lock = threading.Lock()
+
+    def resolve(self):
+        if self._target is None:
+            with self._lock:
+                if self._target is None:
+                    self._target = getattr(importlib.import_module(self.module_name), self.name)
+        return self._target
+
+    def __call__(self, *args, **kwargs):
+        return self.resolve()(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.resolve(), name)
+
+    def __repr__(self):
+        return f'<LazyImport {self.module_name}.{self.name}>'
+
+
+def lazy_import(module_name, name):
+    obj = LazyImport(module_name, name)
+    _lazy_imports.append(obj)
+    return obj
+
+
+def resolve_lazy_imports():
+    """Import everything registered so far, e.g. from a background thread
+    while the app is starting."""
+    for obj in list(_lazy_imports):
+        obj.resolve()
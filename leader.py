@@ -0,0 +1,73 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+
+try:
+    import fcntl
+except ImportError:  # Windows, every process then counts as the leader
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+shared_state_dir = '.'
+
+
+class LeaderElection:
+    """Elects one process of a host to run the background jobs that should
+    run once, such as the ticket sync poller.
+
+    Every process waits for an exclusive lock on `path` on a daemon thread.
+    The one holding it runs the jobs and keeps the lock until it exits, then
+    one of the waiting processes takes over.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.is_leader = threading.Event()
+        self._fd = None
+
+    def start(self, on_elected):
+        threading.Thread(target=self._wait_for_lock, args=(on_elected,), daemon=True).start()
+
+    def _wait_for_lock(self, on_elected):
+        try:
+            if fcntl:
+                fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+                # Released by the OS when the process exits
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                self._fd = fd
+            logger.info('Process %s elected to run the background jobs', os.getpid())
+            self.is_leader.set()
+            on_elected()
+        except Exception as e:
+            logger.exception('Exception in leader election: %s', e)
+
+
+class SharedSnapshot:
+    """JSON data the leader publishes for the other processes of the host."""
+
+    def __init__(self, path):
+        self.path = path
+        self._mtime = None
+
+    def publish(self, data):
+        # os.replace swaps the file in atomically, readers never see half of it
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)), prefix='.snapshot')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.path)
+
+    def read_if_changed(self):
+        """Returns the data if it changed since the last call, else None."""
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+            if mtime == self._mtime:
+                return None
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        self._mtime = mtime
+        return data
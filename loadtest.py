@@ -0,0 +1,671 @@
+import abc
+import argparse
+import hashlib
+import hmac
+import itertools
+import json
+import logging
+import math
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlparse
+
+logger = logging.getLogger(__name__)
+
+SIGNING_SECRET = 'load-test-signing-secret'
+BOT_TOKEN = 'xoxb-load-test'
+TEAM_ID = 'TLOADTEST'
+BOT_USER_ID = 'ULOADBOT'
+
+# Slack drops an ack slower than this
+ACK_DEADLINE = 3.0
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def _handle(self):
+        backend = self.server.backend
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        status, headers, payload = backend.dispatch(self.command, self.path, self.headers, body)
+        data = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = _handle
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubServer(abc.ABC):
+    """Local HTTP stand-in for a remote API, with injected latency and 429s."""
+
+    def __init__(self, latency=0.0, rate_limit_ratio=0.0, retry_after=1):
+        self.latency = latency
+        self.rate_limit_ratio = rate_limit_ratio
+        self.retry_after = retry_after
+        self.calls = Counter()
+        self.rate_limited = Counter()
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), _StubHandler)
+        self.server.daemon_threads = True
+        self.server.backend = self
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server.server_address[1]}'
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+
+    def dispatch(self, method, path, headers, body):
+        operation = self.get_operation(method, urlparse(path).path)
+        with self.lock:
+            self.calls[operation] += 1
+        if self.latency:
+            time.sleep(random.uniform(0.8, 1.2) * self.latency)
+        if self.rate_limit_ratio and random.random() < self.rate_limit_ratio:
+            with self.lock:
+                self.rate_limited[operation] += 1
+            return 429, {'Retry-After': str(self.retry_after)}, self.rate_limited_body()
+        return self.handle(method, path, headers, body)
+
+    @abc.abstractmethod
+    def get_operation(self, method, path):
+        """Name the calls are counted under."""
+
+    @abc.abstractmethod
+    def rate_limited_body(self):
+        """Payload of an injected 429."""
+
+    @abc.abstractmethod
+    def handle(self, method, path, headers, body):
+        """Returns (status, headers, payload) of a call."""
+
+    def total_calls(self):
+        with self.lock:
+            return sum(self.calls.values())
+
+
+class FakeSlack(StubServer):
+    """Slack Web API stand-in keeping the modal views the app opens, so a
+    simulated user can act on them."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.views = {}
+        self.views_by_trigger = {}
+        self.view_changed = threading.Condition(self.lock)
+        self.ids = itertools.count(1)
+
+    def get_operation(self, method, path):
+        return path.rsplit('/', 1)[-1]
+
+    def rate_limited_body(self):
+        return {'ok': False, 'error': 'ratelimited'}
+
+    def _get_args(self, path, headers, body):
+        args = {k: v[0] for k, v in parse_qs(urlparse(path).query).items()}
+        if body:
+            if headers.get('Content-Type', '').startswith('application/json'):
+                args.update(json.loads(body))
+            else:
+                args.update({k: v[0] for k, v in parse_qs(body.decode('utf-8')).items()})
+        for key in ('view',):
+            if isinstance(args.get(key), str):
+                args[key] = json.loads(args[key])
+        return args
+
+    def handle(self, method, path, headers, body):
+        api_method = self.get_operation(method, urlparse(path).path)
+        args = self._get_args(path, headers, body)
+        handler = getattr(self, f"_{api_method.replace('.', '_')}", None)
+        response = handler(args) if handler else {}
+        response.setdefault('ok', True)
+        return 200, {}, response
+
+    def _auth_test(self, args):
+        return {'url': 'https://load-test.slack.com/', 'team': 'Load test', 'user': 'bot',
+                'team_id': TEAM_ID, 'user_id': BOT_USER_ID, 'bot_id': 'BLOADBOT'}
+
+    def _users_info(self, args):
+        user_id = args.get('user')
+        return {'user': {'id': user_id, 'profile': {
+            'real_name': f'Load {user_id}', 'email': f'{user_id.lower()}@example.com', 'phone': ''}}}
+
+    def _store_view(self, view_id, view):
+        view = dict(view, id=view_id, hash=f'{time.time():.6f}.{next(self.ids)}', team_id=TEAM_ID)
+        view.setdefault('state', {'values': {}})
+        self.views[view_id] = view
+        self.view_changed.notify_all()
+        return view
+
+    def _views_open(self, args):
+        with self.lock:
+            view_id = f'VLOAD{next(self.ids)}'
+            view = self._store_view(view_id, args['view'])
+            self.views_by_trigger[args.get('trigger_id')] = view_id
+        return {'view': view}
+
+    def _views_update(self, args):
+        with self.lock:
+            view_id = args.get('view_id')
+            current = self.views.get(view_id)
+            if current is None:
+                return {'ok': False, 'error': 'not_found'}
+            if args.get('hash') and args['hash'] != current['hash']:
+                return {'ok': False, 'error': 'hash_conflict'}
+            view = self._store_view(view_id, dict(args['view'], state=current['state']))
+        return {'view': view}
+
+    def _chat_postMessage(self, args):
+        return {'channel': args.get('channel'), 'ts': f'{time.time():.6f}'}
+
+    def _conversations_info(self, args):
+        return {'channel': {'id': args.get('channel'), 'is_member': True}}
+
+    def wait_for_view(self, trigger_id=None, view_id=None, after_hash=None, timeout=5):
+        """Returns the view opened for `trigger_id` or the view `view_id` once
+        its hash differs from `after_hash`, or None after `timeout`."""
+        deadline = time.monotonic() + timeout
+        with self.lock:
+            while True:
+                if trigger_id is not None:
+                    view_id = self.views_by_trigger.get(trigger_id)
+                view = self.views.get(view_id) if view_id else None
+                if view is not None and view['hash'] != after_hash:
+                    return json.loads(json.dumps(view))
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self.view_changed.wait(remaining)
+
+
+class FakeArm(StubServer):
+    """Azure Resource Manager and Microsoft.Support stand-in serving a
+    synthetic tenant."""
+
+    def __init__(self, subscriptions=3, resources=200, resource_groups=20, problem_classifications=60, **kwargs):
+        super().__init__(**kwargs)
+        self.subscriptions = [f'00000000-0000-0000-0000-{i:012d}' for i in range(subscriptions)]
+        self.resources = resources
+        self.resource_groups = resource_groups
+        self.problem_classifications = problem_classifications
+        self.tickets = {}
+
+    def get_operation(self, method, path):
+        parts = [p for p in path.split('/') if p]
+        if path.endswith('/communications'):
+            return f'{method} communications'
+        if 'supportTickets' in parts:
+            return f'{method} supportTickets'
+        if 'problemClassifications' in parts:
+            return f'{method} problemClassifications' + ('' if parts[-1] == 'problemClassifications' else '/get')
+        if parts[-1] == 'resources':
+            return f'{method} resources'
+        if parts == ['subscriptions']:
+            return f'{method} subscriptions'
+        return f'{method} other'
+
+    def rate_limited_body(self):
+        return {'error': {'code': 'TooManyRequests', 'message': 'Injected by the load test'}}
+
+    def _get_problem_classification(self, service_path, i):
+        return {
+            'id': f'{service_path}/problemClassifications/pc-{i}',
+            'name': f'pc-{i}',
+            'type': 'Microsoft.Support/services/problemClassifications',
+            'properties': {'displayName': f'Group {i // 10} / Problem {i}'},
+        }
+
+    def handle(self, method, path, headers, body):
+        parsed = urlparse(path)
+        operation = self.get_operation(method, parsed.path)
+        if operation == 'GET subscriptions':
+            return 200, {}, {'value': [
+                {'id': f'/subscriptions/{s}', 'subscriptionId': s, 'displayName': f'Load test {i}', 'state': 'Enabled'}
+                for i, s in enumerate(self.subscriptions)]}
+        if operation == 'GET resources':
+            subscription_path = parsed.path.rsplit('/resources', 1)[0]
+            query = parse_qs(parsed.query).get('$filter', [''])[0]
+            resource_type = query.split("'")[1] if "'" in query else 'microsoft.compute/virtualmachines'
+            return 200, {}, {'value': [{
+                'id': (f'{subscription_path}/resourceGroups/rg-{i % self.resource_groups}'
+                       f'/providers/{resource_type}/res-{i}'),
+                'name': f'res-{i}', 'type': resource_type, 'location': 'westeurope',
+            } for i in range(self.resources)]}
+        if operation == 'GET problemClassifications':
+            service_path = parsed.path.rsplit('/problemClassifications', 1)[0]
+            return 200, {}, {'value': [
+                self._get_problem_classification(service_path, i) for i in range(self.problem_classifications)]}
+        if operation == 'GET problemClassifications/get':
+            service_path, _, name = parsed.path.rpartition('/problemClassifications/')
+            return 200, {}, self._get_problem_classification(service_path, int(name.split('-')[-1]))
+        if operation == 'PUT supportTickets':
+            ticket = json.loads(body or b'{}')
+            ticket.update(id=parsed.path, name=parsed.path.rsplit('/', 1)[-1],
+                          type='Microsoft.Support/supportTickets')
+            ticket.setdefault('properties', {})['status'] = 'Open'
+            with self.lock:
+                self.tickets[parsed.path] = ticket
+            return 200, {}, ticket
+        if operation == 'GET supportTickets':
+            with self.lock:
+                ticket = self.tickets.get(parsed.path)
+            if ticket is not None:
+                return 200, {}, ticket
+        if operation == 'GET communications':
+            return 200, {}, {'value': []}
+        return 404, {}, {'error': {'code': 'NotFound', 'message': f'{method} {parsed.path}'}}
+
+
+def sign_request(body, timestamp=None, secret=SIGNING_SECRET):
+    """Returns the headers Slack signs a request to the app with."""
+    timestamp = str(int(timestamp or time.time()))
+    base = f'v0:{timestamp}:{body}'.encode('utf-8')
+    signature = 'v0=' + hmac.new(secret.encode('utf-8'), base, hashlib.sha256).hexdigest()
+    return {'X-Slack-Request-Timestamp': timestamp, 'X-Slack-Signature': signature}
+
+
+class LoadStats:
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.requests = Counter()
+        self.errors = Counter()
+        self.sessions = 0
+        self.failed_sessions = 0
+        self.lock = threading.Lock()
+
+    def record(self, kind, seconds, error=None):
+        with self.lock:
+            self.requests[kind] += 1
+            self.latencies[kind].append(seconds)
+            if error:
+                self.errors[(kind, error)] += 1
+
+    def record_error(self, kind, error):
+        with self.lock:
+            self.errors[(kind, error)] += 1
+
+    def record_session(self, ok):
+        with self.lock:
+            self.sessions += 1
+            if not ok:
+                self.failed_sessions += 1
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    # Nearest rank
+    ordered = sorted(values)
+    return ordered[min(len(ordered), max(1, math.ceil(p / 100 * len(ordered)))) - 1]
+
+
+class SessionFailed(Exception):
+    pass
+
+
+class ModalSession:
+    """One simulated user filing a ticket through the modal: the shortcut,
+    a search and a pick in each external select, then the submission."""
+
+    SELECTS = (
+        ('select_azure_subscription', ''),
+        ('select_azure_service', 'Virtual'),
+        ('select_azure_service_problem_classifications', ''),
+        ('select_azure_resource', ''),
+    )
+
+    def __init__(self, app_url, fake_slack: FakeSlack, stats: LoadStats, user_id, view_timeout=10):
+        self.app_url = app_url
+        self.fake_slack = fake_slack
+        self.stats = stats
+        self.user = {'id': user_id, 'username': user_id.lower(), 'name': user_id.lower(), 'team_id': TEAM_ID}
+        self.team = {'id': TEAM_ID, 'domain': 'load-test'}
+        self.view_timeout = view_timeout
+        self.view = None
+        self.state = {}
+
+    def _post(self, kind, payload):
+        body = urlencode({'payload': json.dumps(payload)})
+        headers = dict(sign_request(body), **{'Content-Type': 'application/x-www-form-urlencoded'})
+        request = urllib.request.Request(f'{self.app_url}/slack/events', body.encode('utf-8'), headers)
+        start = time.perf_counter()
+        try:
+            with urllib.request.urlopen(request, timeout=30) as response:
+                data = response.read()
+            seconds = time.perf_counter() - start
+        except urllib.error.HTTPError as e:
+            self.stats.record(kind, time.perf_counter() - start, f'http_{e.code}')
+            raise SessionFailed(f'{kind} answered {e.code}')
+        except OSError as e:
+            self.stats.record(kind, time.perf_counter() - start, type(e).__name__)
+            raise SessionFailed(f'{kind} failed: {e}')
+        self.stats.record(kind, seconds, 'late_ack' if seconds > ACK_DEADLINE else None)
+        return json.loads(data) if data else {}
+
+    def _base(self, kind):
+        return {'type': kind, 'team': self.team, 'user': self.user, 'api_app_id': 'ALOADTEST',
+                'token': 'legacy', 'is_enterprise_install': False, 'enterprise': None}
+
+    def _view_payload(self):
+        return dict(self.view, state={'values': self.state})
+
+    def open(self):
+        trigger_id = f'{time.time():.6f}.{self.user["id"]}'
+        self._post('shortcut', dict(
+            self._base('shortcut'), callback_id='open_azure_support_ticket',
+            trigger_id=trigger_id, action_ts=f'{time.time():.6f}'))
+        self.view = self.fake_slack.wait_for_view(trigger_id=trigger_id, timeout=self.view_timeout)
+        if self.view is None:
+            self.stats.record_error('shortcut', 'view_not_opened')
+            raise SessionFailed('no modal opened')
+
+    def search(self, action_id, value):
+        response = self._post('block_suggestion', dict(
+            self._base('block_suggestion'), action_id=action_id, block_id=action_id, value=value,
+            container={'type': 'view', 'view_id': self.view['id']}, view=self._view_payload()))
+        options = list(response.get('options') or [])
+        for group in response.get('option_groups') or []:
+            options.extend(group.get('options', []))
+        picks = [o for o in options if o.get('value') != '__loading__']
+        if not picks:
+            self.stats.record_error('block_suggestion', f'no_options:{action_id}')
+            raise SessionFailed(f'no options for {action_id}')
+        return picks[0]
+
+    def pick(self, action_id, option):
+        self.state[action_id] = {action_id: {'type': 'external_select', 'selected_option': option}}
+        previous_hash = self.view['hash']
+        self._post('block_actions', dict(
+            self._base('block_actions'), trigger_id=f'{time.time():.6f}.{self.user["id"]}',
+            container={'type': 'view', 'view_id': self.view['id']}, view=self._view_payload(),
+            actions=[{'type': 'external_select', 'action_id': action_id, 'block_id': action_id,
+                      'selected_option': option, 'action_ts': f'{time.time():.6f}'}]))
+        view = self.fake_slack.wait_for_view(view_id=self.view['id'], after_hash=previous_hash,
+                                             timeout=self.view_timeout)
+        if view is None:
+            self.stats.record_error('block_actions', f'view_not_updated:{action_id}')
+            raise SessionFailed(f'view not updated after {action_id}')
+        self.view = view
+
+    def submit(self):
+        def text(value):
+            return {'type': 'plain_text_input', 'value': value}
+
+        def option(value, label):
+            return {'type': 'static_select', 'selected_option': {
+                'text': {'type': 'plain_text', 'text': label}, 'value': value}}
+
+        for block_id, element in (
+                ('subject', text('Load test ticket')),
+                ('problem_details', text('Generated by the load test.')),
+                ('select_severity', option('minimal', 'C - Minimal impact')),
+                ('select_advanced_diagnostic_information', option('Yes', 'Yes')),
+                ('select_preferred_contact_method', option('email', 'Email')),
+                ('section_contact_information_full_name', text(f'Load {self.user["id"]}')),
+                ('section_contact_information_email', text(f'{self.user["id"].lower()}@example.com')),
+                ('section_contact_information_additional_emails', {'type': 'plain_text_input'}),
+                ('select_msg_post_destination', {'type': 'conversations_select', 'selected_conversation': None})):
+            self.state[block_id] = {block_id: element}
+        response = self._post('view_submission', dict(
+            self._base('view_submission'), trigger_id=f'{time.time():.6f}.{self.user["id"]}',
+            view=self._view_payload()))
+        if response.get('response_action') == 'errors':
+            self.stats.record_error('view_submission', 'validation_errors')
+            raise SessionFailed(f'submission rejected: {response.get("errors")}')
+
+    def run(self):
+        self.open()
+        for action_id, typed in self.SELECTS:
+            self.pick(action_id, self.search(action_id, typed))
+        self.submit()
+
+
+def run_sessions(app_url, fake_slack, sessions, concurrency, think_time=0.0):
+    stats = LoadStats()
+
+    def run_one(n):
+        session = ModalSession(app_url, fake_slack, stats, f'ULOAD{n:05d}')
+        try:
+            session.run()
+            stats.record_session(True)
+        except SessionFailed as e:
+            logger.info('Session %s failed: %s', n, e)
+            stats.record_session(False)
+        if think_time:
+            time.sleep(think_time)
+
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='session') as executor:
+        list(executor.map(run_one, range(sessions)))
+    return stats
+
+
+def wait_until_idle(*servers, idle=1.0, timeout=15.0):
+    """Waits for the app's background work (ticket creation, thread posts)
+    to stop calling the stand-ins."""
+    deadline = time.monotonic() + timeout
+    last = None
+    quiet_since = time.monotonic()
+    while time.monotonic() < deadline:
+        total = sum(s.total_calls() for s in servers)
+        if total != last:
+            last, quiet_since = total, time.monotonic()
+        elif time.monotonic() - quiet_since >= idle:
+            return
+        time.sleep(0.1)
+
+
+def format_report(stats, fake_slack, fake_arm, seconds):
+    total_requests = sum(stats.requests.values())
+    total_errors = sum(stats.errors.values())
+    lines = [
+        f'Sessions: {stats.sessions} ({stats.failed_sessions} failed) in {seconds:.1f}s',
+        f'Requests: {total_requests}, errors: {total_errors} '
+        f'({total_errors / total_requests * 100 if total_requests else 0:.1f}%)',
+        '',
+        f'{"ack latency":<18} {"count":>6} {"p50 ms":>8} {"p90 ms":>8} {"p99 ms":>8} {"max ms":>8}',
+    ]
+    for kind in ('shortcut', 'block_suggestion', 'block_actions', 'view_submission'):
+        values = stats.latencies.get(kind, [])
+        lines.append(
+            f'{kind:<18} {len(values):>6} {percentile(values, 50) * 1000:>8.1f} {percentile(values, 90) * 1000:>8.1f} '
+            f'{percentile(values, 99) * 1000:>8.1f} {max(values, default=0) * 1000:>8.1f}')
+    if stats.errors:
+        lines += ['', 'Errors:']
+        lines += [f'  {kind} {error}: {count}' for (kind, error), count in sorted(stats.errors.items())]
+    sessions = max(stats.sessions, 1)
+    lines += [
+        '',
+        f'Azure calls: {fake_arm.total_calls()} ({fake_arm.total_calls() / sessions:.1f} per session, '
+        f'{sum(fake_arm.rate_limited.values())} answered 429)',
+    ]
+    lines += [f'  {op}: {count}' for op, count in sorted(fake_arm.calls.items())]
+    lines.append(
+        f'Slack calls: {fake_slack.total_calls()} ({fake_slack.total_calls() / sessions:.1f} per session, '
+        f'{sum(fake_slack.rate_limited.values())} answered 429)')
+    lines += [f'  {method}: {count}' for method, count in sorted(fake_slack.calls.items())]
+    return '\n'.join(lines)
+
+
+class _AllowHttpPolicy:
+    """Lets the Azure SDK send its bearer token to the plain HTTP stand-in."""
+
+    def on_request(self, request):
+        request.context.options['enforce_https'] = False
+
+    def on_response(self, request, response):
+        pass
+
+    def on_exception(self, request):
+        pass
+
+
+class _StaticCredential:
+
+    def get_token(self, *scopes, **kwargs):
+        from azure.core.credentials import AccessToken
+        return AccessToken('load-test-token', int(time.time()) + 3600)
+
+
+def _configure_app(slack_url, arm_url):
+    """Points the app at the stand-ins and returns its WSGI application."""
+    workdir = tempfile.mkdtemp(prefix='loadtest-')
+    os.environ.update({
+        'SLACK_BOT_TOKEN': BOT_TOKEN,
+        'SLACK_SIGNING_SECRET': SIGNING_SECRET,
+        'SLACK_API_URL': f'{slack_url}/api/',
+        'TICKET_SYNC_DB': os.path.join(workdir, 'ticket_sync.db'),
+        'ATTACHMENT_UPLOADS_DB': os.path.join(workdir, 'attachment_uploads.db'),
+        'PREFETCH_HISTORY_DB': os.path.join(workdir, 'prefetch_history.db'),
+        'TICKET_INDEX_DB': os.path.join(workdir, 'ticket_index.db'),
+        'SHARED_STATE_DIR': workdir,
+        'SERVICE_CATALOG_FILE': 'data/dataset_services.json',
+    })
+
+    import app as bot
+    import metrics
+    from azure.core.pipeline.policies import SansIOHTTPPolicy
+
+    bot.DefaultAzureCredential = _StaticCredential
+    metrics.AZURE_CLIENT_KWARGS['base_url'] = arm_url
+    metrics.AZURE_CLIENT_KWARGS['per_call_policies'].append(
+        type('AllowHttpPolicy', (_AllowHttpPolicy, SansIOHTTPPolicy), {})())
+
+    import wsgi
+    return wsgi.application
+
+
+def gunicorn_application():
+    """WSGI application gunicorn loads in its master, with gunicorn.conf.py
+    starting the background services in the workers as in production."""
+    return _configure_app(os.environ['LOADTEST_SLACK_URL'], os.environ['LOADTEST_ARM_URL'])
+
+
+def serve(port, slack_url, arm_url):
+    """Runs the app in this process on a threaded wsgiref server."""
+    from socketserver import ThreadingMixIn
+    from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
+
+    application = _configure_app(slack_url, arm_url)
+    import app as bot
+    bot.start_background_services()
+
+    class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+        daemon_threads = True
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+    httpd = make_server('127.0.0.1', port, application, ThreadingWSGIServer, QuietHandler)
+    httpd.serve_forever()
+
+
+def start_app(server, port, slack_url, arm_url, workers):
+    """Starts the app under test in a subprocess: under gunicorn with
+    gunicorn.conf.py, or in one process on wsgiref."""
+    if server == 'wsgiref':
+        return subprocess.Popen([
+            sys.executable, os.path.abspath(__file__), 'serve', '--port', str(port),
+            '--slack-url', slack_url, '--arm-url', arm_url])
+    env = dict(os.environ, LOADTEST_SLACK_URL=slack_url, LOADTEST_ARM_URL=arm_url, WEB_CONCURRENCY=str(workers))
+    return subprocess.Popen([
+        sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', '--bind', f'127.0.0.1:{port}',
+        '--log-level', 'warning', 'loadtest:gunicorn_application()'], env=env)
+
+
+def wait_until_ready(app_url, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with urllib.request.urlopen(f'{app_url}/readyz', timeout=2) as response:
+                if response.status == 200:
+                    return True
+        except OSError:
+            pass
+        time.sleep(0.2)
+    return False
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the app against local Slack and Azure stand-ins')
+    subparsers = parser.add_subparsers(dest='command')
+
+    run_parser = subparsers.add_parser('run', help='start the stand-ins and the app, then simulate modal sessions')
+    run_parser.add_argument('--sessions', type=int, default=50)
+    run_parser.add_argument('--concurrency', type=int, default=10)
+    run_parser.add_argument('--port', type=int, default=5055, help='port of the app under test')
+    run_parser.add_argument('--slack-latency-ms', type=float, default=50)
+    run_parser.add_argument('--slack-429-ratio', type=float, default=0.0)
+    run_parser.add_argument('--azure-latency-ms', type=float, default=300)
+    run_parser.add_argument('--azure-429-ratio', type=float, default=0.0)
+    run_parser.add_argument('--resources', type=int, default=200, help='resources per resource type')
+    run_parser.add_argument('--think-time-ms', type=float, default=0)
+    run_parser.add_argument('--server', choices=('gunicorn', 'wsgiref'), default='gunicorn',
+                            help='gunicorn with gunicorn.conf.py as deployed, or one wsgiref process')
+    run_parser.add_argument('--workers', type=int, default=2, help='gunicorn workers')
+
+    serve_parser = subparsers.add_parser('serve', help='run the app against running stand-ins')
+    serve_parser.add_argument('--port', type=int, required=True)
+    serve_parser.add_argument('--slack-url', required=True)
+    serve_parser.add_argument('--arm-url', required=True)
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+    if args.command == 'serve':
+        serve(args.port, args.slack_url, args.arm_url)
+        return 0
+    if args.command != 'run':
+        parser.print_help()
+        return 2
+
+    fake_slack = FakeSlack(latency=args.slack_latency_ms / 1000, rate_limit_ratio=args.slack_429_ratio).start()
+    fake_arm = FakeArm(resources=args.resources, latency=args.azure_latency_ms / 1000,
+                       rate_limit_ratio=args.azure_429_ratio).start()
+    app_url = f'http://127.0.0.1:{args.port}'
+    app_process = start_app(args.server, args.port, fake_slack.url, fake_arm.url, args.workers)
+    try:
+        if not wait_until_ready(app_url):
+            print('The app did not become ready', file=sys.stderr)
+            return 1
+        start = time.monotonic()
+        stats = run_sessions(app_url, fake_slack, args.sessions, args.concurrency, args.think_time_ms / 1000)
+        seconds = time.monotonic() - start
+        wait_until_idle(fake_slack, fake_arm)
+        print(format_report(stats, fake_slack, fake_arm, seconds))
+        return 1 if stats.failed_sessions else 0
+    finally:
+        app_process.terminate()
+        app_process.wait(timeout=10)
+        fake_slack.stop()
+        fake_arm.stop()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
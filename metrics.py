@@ -0,0 +1,551 @@
+import bisect
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+from azure.core.pipeline.policies import SansIOHTTPPolicy
+from cachetools import TTLCache
+from slack_bolt.context.ack import Ack
+from slack_sdk import WebClient
+from tracing import (
+    AzureTracingPolicy, get_current_request, get_request_kind_and_id, run_listener, start_span, submit_with_context
+)
+
+logger = logging.getLogger(__name__)
+
+# Slack expects an ack within 3 seconds, keep resolution around that budget.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 3.0, 5.0, 10.0)
+
+
+def _format_labels(label_names, label_values):
+    if not label_names:
+        return ''
+    pairs = []
+    for name, value in zip(label_names, label_values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+def _render_family(name, documentation, kind, samples):
+    lines = [f'# HELP {name} {documentation}', f'# TYPE {name} {kind}']
+    for sample_name, label_names, label_values, value in samples:
+        lines.append(f'{sample_name}{_format_labels(label_names, label_values)} {value}')
+    return lines
+
+
+class Counter:
+
+    kind = 'counter'
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def get(self, *label_values):
+        return self.values.get(label_values, 0)
+
+    def collect(self):
+        with self.lock:
+            return [(self.name, self.label_names, label_values, value)
+                    for label_values, value in sorted(self.values.items())]
+
+    def render(self):
+        return _render_family(self.name, self.documentation, self.kind, self.collect())
+
+
+class Histogram:
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, label_names=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.values.get(label_values)
+            if series is None:
+                series = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, *label_values):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *label_values)
+
+    def get_count(self, *label_values):
+        series = self.values.get(label_values)
+        return series[2] if series else 0
+
+    def collect(self):
+        samples = []
+        names = self.label_names + ('le',)
+        with self.lock:
+            for label_values, (counts, total, count) in sorted(self.values.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                    cumulative += bucket_count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    samples.append((f'{self.name}_bucket', names, label_values + (le,), cumulative))
+                samples.append((f'{self.name}_sum', self.label_names, label_values, total))
+                samples.append((f'{self.name}_count', self.label_names, label_values, count))
+        return samples
+
+    def render(self):
+        return _render_family(self.name, self.documentation, self.kind, self.collect())
+
+
+class Gauge:
+    """Gauge read at scrape time from a callback returning either a number or
+    a dict of label value tuples to numbers."""
+
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, label_names, callback):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.callback = callback
+
+    def collect(self):
+        try:
+            values = self.callback()
+        except Exception as e:
+            logger.info('Gauge %s callback failed: %s', self.name, e)
+            return []
+        if not isinstance(values, dict):
+            values = {(): values}
+        return [(self.name, self.label_names, label_values, value) for label_values, value in sorted(values.items())]
+
+    def render(self):
+        return _render_family(self.name, self.documentation, self.kind, self.collect())
+
+
+class MetricsRegistry:
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def _register(self, metric):
+        with self.lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, documentation, label_names=()):
+        return self._register(Counter(name, documentation, label_names))
+
+    def histogram(self, name, documentation, label_names=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, documentation, label_names, buckets))
+
+    def gauge(self, name, documentation, callback, label_names=()):
+        # Gauges are replaced so a re-created object can rebind its callback.
+        with self.lock:
+            self.metrics[name] = Gauge(name, documentation, label_names, callback)
+            return self.metrics[name]
+
+    def collect(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return [(m.name, m.documentation, m.kind, m.collect()) for m in metrics]
+
+    def render(self):
+        lines = []
+        for family in self.collect():
+            lines.extend(_render_family(*family))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+
+
+class MultiProcessMetrics:
+    """Metrics of all the workers of a pre-forking server, any of which may
+    serve a scrape.
+
+    Each worker writes its registry to `directory` every `WRITE_SECONDS`,
+    and a scrape renders the files of all of them with a `worker` label
+    holding the pid. Sum over `worker` for the host. Files of workers that
+    stopped writing are left out after `STALE_SECONDS`, the counters of a
+    restarted worker start over as new series.
+    """
+
+    WRITE_SECONDS = 5
+    STALE_SECONDS = 60
+
+    def __init__(self, directory, registry=None):
+        self.directory = directory
+        self.registry = registry if registry is not None else REGISTRY
+        self.path = os.path.join(directory, f'metrics-{os.getpid()}.json')
+
+    def start(self):
+        threading.Thread(target=self._write_forever, daemon=True).start()
+
+    def _write_forever(self):
+        while True:
+            try:
+                self.write()
+            except Exception as e:
+                logger.info('Could not write the worker metrics: %s', e)
+            time.sleep(self.WRITE_SECONDS)
+
+    def write(self):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix='.metrics')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.registry.collect(), f)
+        os.replace(tmp_path, self.path)
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+    def render(self):
+        self.write()
+        families = {}
+        now = time.time()
+        for file_name in sorted(os.listdir(self.directory)):
+            if not (file_name.startswith('metrics-') and file_name.endswith('.json')):
+                continue
+            path = os.path.join(self.directory, file_name)
+            try:
+                if now - os.stat(path).st_mtime > self.STALE_SECONDS:
+                    continue
+                with open(path) as f:
+                    collected = json.load(f)
+            except (OSError, ValueError):
+                continue
+            worker = file_name[len('metrics-'):-len('.json')]
+            for name, documentation, kind, samples in collected:
+                family = families.setdefault(name, (documentation, kind, []))
+                family[2].extend((sample_name, ('worker', *label_names), (worker, *label_values), value)
+                                 for sample_name, label_names, label_values, value in samples)
+        lines = []
+        for name, (documentation, kind, samples) in families.items():
+            lines.extend(_render_family(name, documentation, kind, samples))
+        return '\n'.join(lines) + '\n'
+
+
+_multiprocess_metrics = None
+
+
+def configure_multiprocess_metrics(directory):
+    """Makes `render_metrics` report all the workers writing to
+    `directory`."""
+    global _multiprocess_metrics
+    os.makedirs(directory, exist_ok=True)
+    _multiprocess_metrics = MultiProcessMetrics(directory)
+    _multiprocess_metrics.start()
+    return _multiprocess_metrics
+
+
+def close_multiprocess_metrics():
+    if _multiprocess_metrics is not None:
+        _multiprocess_metrics.remove()
+
+
+def render_metrics():
+    if _multiprocess_metrics is not None:
+        return _multiprocess_metrics.render()
+    return REGISTRY.render()
+
+
+ACK_LATENCY = REGISTRY.histogram(
+    'slack_ack_latency_seconds', 'Time from request dispatch to ack()', ('kind', 'id'))
+HANDLER_LATENCY = REGISTRY.histogram(
+    'slack_handler_duration_seconds', 'Time spent in the Bolt listener', ('kind', 'id'))
+SLACK_CALLS = REGISTRY.counter(
+    'slack_api_calls_total', 'Slack Web API calls', ('method', 'status'))
+SLACK_LATENCY = REGISTRY.histogram(
+    'slack_api_call_duration_seconds', 'Slack Web API call latency', ('method',))
+SLACK_RATE_LIMITED = REGISTRY.counter(
+    'slack_api_rate_limited_total', 'Slack Web API calls answered with 429', ('method',))
+SLACK_QUEUE_WAIT = REGISTRY.histogram(
+    'slack_api_queue_wait_seconds', 'Time a Slack Web API call waited for its rate limit', ('method',))
+OPTIONS_REQUESTS = REGISTRY.counter(
+    'slack_options_requests_total', 'Options requests by admission result', ('action', 'result'))
+OPTIONS_RESULTS = REGISTRY.counter(
+    'slack_options_results_total', 'Options responses by completeness at the deadline', ('action', 'result'))
+AZURE_CALLS = REGISTRY.counter(
+    'azure_api_calls_total', 'Azure management API calls', ('operation', 'status'))
+AZURE_LATENCY = REGISTRY.histogram(
+    'azure_api_call_duration_seconds', 'Azure management API call latency', ('operation',))
+CACHE_REQUESTS = REGISTRY.counter(
+    'cache_requests_total', 'Cache lookups by result', ('cache', 'result'))
+CACHE_EVICTIONS = REGISTRY.counter(
+    'cache_evictions_total', 'Cache entries removed before being read again', ('cache', 'reason'))
+FUNCTION_LATENCY = REGISTRY.histogram(
+    'function_duration_seconds', 'Duration of functions decorated with timeit', ('function',))
+
+_caches = {}
+# When each cache was registered or last cleared, for the diagnostics
+_cache_reset_times = {}
+_executors = {}
+
+
+def _cache_sizes():
+    return {(name,): len(cache) for name, cache in list(_caches.items())}
+
+
+def _cache_currsizes():
+    return {(name,): cache.currsize for name, cache in list(_caches.items()) if hasattr(cache, 'currsize')}
+
+
+REGISTRY.gauge('cache_entries', 'Current number of cache entries', _cache_sizes, ('cache',))
+REGISTRY.gauge(
+    'cache_size', 'Current size of each cachetools cache, in bytes for the memory bounded ones',
+    _cache_currsizes, ('cache',))
+
+
+def register_cache(name, cache):
+    _caches[name] = cache
+    _cache_reset_times[name] = time.time()
+
+
+def get_caches():
+    return dict(_caches)
+
+
+def get_cache_reset_time(name):
+    return _cache_reset_times.get(name)
+
+
+def clear_cache(name):
+    _caches[name].clear()
+    _cache_reset_times[name] = time.time()
+
+
+def get_executors():
+    return dict(_executors)
+
+
+class InstrumentedExecutor(ThreadPoolExecutor):
+    """ThreadPoolExecutor counting its queued and running work items for
+    the metrics and the diag report."""
+
+    def __init__(self, max_workers=None, **kwargs):
+        super().__init__(max_workers, **kwargs)
+        # ThreadPoolExecutor's default
+        self.max_workers = max_workers or min(32, (os.cpu_count() or 1) + 4)
+        self.queued = 0
+        self.running = 0
+        self.counts_lock = threading.Lock()
+
+    def submit(self, fn, /, *args, **kwargs):
+        with self.counts_lock:
+            self.queued += 1
+        try:
+            future = super().submit(self._run_counted, fn, *args, **kwargs)
+        except BaseException:
+            with self.counts_lock:
+                self.queued -= 1
+            raise
+        future.add_done_callback(self._count_cancelled)
+        return future
+
+    def _run_counted(self, fn, *args, **kwargs):
+        with self.counts_lock:
+            self.queued -= 1
+            self.running += 1
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with self.counts_lock:
+                self.running -= 1
+
+    def _count_cancelled(self, future):
+        # A cancelled work item never ran, it leaves the queue here
+        if future.cancelled():
+            with self.counts_lock:
+                self.queued -= 1
+
+
+def get_shared_executor(executor, name, max_workers):
+    """Returns `executor`, the pool of the first workspace that the others
+    share, or for the first workspace a new pool registered as `name`."""
+    if executor is None:
+        executor = InstrumentedExecutor(max_workers=max_workers, thread_name_prefix=name.replace('_', '-'))
+        register_executor(name, executor)
+    return executor
+
+
+def register_executor(name, executor: InstrumentedExecutor):
+    _executors[name] = executor
+    REGISTRY.gauge(
+        f'{name}_queue_depth', f'Work items waiting in the {name} executor',
+        lambda: executor.queued)
+    REGISTRY.gauge(
+        f'{name}_running', f'Work items running in the {name} executor',
+        lambda: executor.running)
+
+
+class InstrumentedTTLCache(TTLCache):
+    """TTLCache reporting hits, misses, evictions and size to the registry."""
+
+    # popitem() reads the evicted value through __getitem__, which must not
+    # count as a hit.
+    _evicting = False
+
+    def __init__(self, name, maxsize, ttl, **kwargs):
+        super().__init__(maxsize, ttl, **kwargs)
+        self.name = name
+        register_cache(name, self)
+
+    def __getitem__(self, key):
+        if self._evicting:
+            return super().__getitem__(key)
+        try:
+            value = super().__getitem__(key)
+        except KeyError:
+            CACHE_REQUESTS.inc(self.name, 'miss')
+            raise
+        CACHE_REQUESTS.inc(self.name, 'hit')
+        return value
+
+    def popitem(self):
+        self._evicting = True
+        try:
+            item = super().popitem()
+        finally:
+            self._evicting = False
+        CACHE_EVICTIONS.inc(self.name, 'size')
+        return item
+
+    def expire(self, time=None):
+        expired = super().expire(time)
+        if expired:
+            CACHE_EVICTIONS.inc(self.name, 'ttl', amount=len(expired))
+        return expired
+
+
+class TimedAck(Ack):
+
+    def __init__(self, start, labels):
+        super().__init__()
+        self.start = start
+        self.labels = labels
+
+    def __call__(self, *args, **kwargs):
+        if self.response is None:
+            ACK_LATENCY.observe(time.perf_counter() - self.start, *self.labels)
+        return super().__call__(*args, **kwargs)
+
+
+def bolt_metrics_middleware(context, body, next):
+    context['ack'] = TimedAck(time.perf_counter(), get_request_kind_and_id(body))
+    return next()
+
+
+def _run_timed_listener(fn, *args, **kwargs):
+    labels = get_current_request()
+    if labels is None:
+        return run_listener(fn, *args, **kwargs)
+    with HANDLER_LATENCY.time(*labels):
+        return run_listener(fn, *args, **kwargs)
+
+
+class ListenerExecutor(InstrumentedExecutor):
+    """Executor for Bolt's listener_executor.
+
+    Bolt runs listeners here after the middleware chain returned. Each one
+    runs in the context of the request that dispatched it, inside its span
+    and timed as handler latency.
+    """
+
+    def submit(self, fn, *args, **kwargs):
+        return submit_with_context(super(), _run_timed_listener, fn, *args, **kwargs)
+
+
+class InstrumentedWebClient(WebClient):
+
+    def api_call(self, api_method, **kwargs):
+        status = 'error'
+        try:
+            with start_span(f'slack.{api_method}'), SLACK_LATENCY.time(api_method):
+                response = super().api_call(api_method, **kwargs)
+            status = 'ok'
+            return response
+        finally:
+            SLACK_CALLS.inc(api_method, status)
+
+
+def get_azure_operation(method, url):
+    # ARM paths alternate collection/name, an odd number of segments ends on
+    # a collection (list/create) and an even one on an item in a collection.
+    segments = [s for s in urlparse(url).path.split('/') if s]
+    if not segments:
+        return method
+    collection = segments[-1] if len(segments) % 2 else segments[-2]
+    return f'{method} {collection}'
+
+
+class AzureCallMetricsPolicy(SansIOHTTPPolicy):
+
+    def on_request(self, request):
+        request.context['metrics_start'] = time.perf_counter()
+
+    def _record(self, request, status):
+        start = request.context.get('metrics_start')
+        operation = get_azure_operation(request.http_request.method, request.http_request.url)
+        if start is not None:
+            AZURE_LATENCY.observe(time.perf_counter() - start, operation)
+        AZURE_CALLS.inc(operation, status)
+
+    def on_response(self, request, response):
+        self._record(request, str(response.http_response.status_code))
+
+    def on_exception(self, request):
+        self._record(request, 'error')
+
+
+# Pass to Azure management clients so their calls are counted and timed
+AZURE_CLIENT_KWARGS = {'per_call_policies': [AzureCallMetricsPolicy(), AzureTracingPolicy()]}
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        payload = render_metrics().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port):
+    server = ThreadingHTTPServer(('0.0.0.0', port), MetricsRequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info('Metrics endpoint listening on :%s/metrics', port)
+    return server
@@ -0,0 +1,130 @@
+import hashlib
+import logging
+import threading
+import time
+from functools import wraps
+
+from cachetools import TTLCache
+
+from handlers import LOADING_VALUE
+from metrics import OPTIONS_REQUESTS
+from slack_client import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+
+def _get_request_keys(body):
+    team_id = (body.get('team') or {}).get('id', '')
+    user_id = (body.get('user') or {}).get('id', '')
+    action_id = body.get('action_id', '')
+    # Options of the resource and problem classification selects depend on
+    # the selections stored in the view, not only on the typed value.
+    metadata = (body.get('view') or {}).get('private_metadata', '')
+    fingerprint = hashlib.sha256(metadata.encode('utf-8')).hexdigest()[:16]
+    return (team_id, user_id, action_id), (team_id, user_id, action_id, fingerprint, body.get('value', ''))
+
+
+def _is_placeholder(ack_kwargs):
+    options = list(ack_kwargs.get('options') or [])
+    for group in ack_kwargs.get('option_groups') or []:
+        options.extend(group.get('options', []))
+    return all(o.get('value') == LOADING_VALUE for o in options)
+
+
+class OptionsThrottle:
+    """Admission control in front of the options listeners.
+
+    Slack sends an options request per typed character. The first request
+    after a pause is run at once. One following it within the debounce
+    window, while the user is still typing, is held for the window and
+    dropped if a newer one for the same user and select arrives meanwhile.
+    The survivors then need a token from the user's and the workspace's
+    budget. Dropped and throttled requests are answered with the last good
+    result for the same select and typed value, if any.
+
+    Only wrap listeners that call Azure; those answering from memory are
+    cheaper to run than to hold.
+    """
+
+    DEBOUNCE_SECONDS = 0.25
+    USER_RATE = (60, 5)
+    WORKSPACE_RATE = (600, 30)
+
+    def __init__(self, debounce_seconds=DEBOUNCE_SECONDS, user_rate=USER_RATE, workspace_rate=WORKSPACE_RATE):
+        self.debounce_seconds = debounce_seconds
+        self.user_rate = user_rate
+        self.workspace_rate = workspace_rate
+        self.pending = {}
+        self.arrivals = TTLCache(maxsize=4096, ttl=60)
+        self.last_results = TTLCache(maxsize=4096, ttl=60 * 30)
+        self.user_buckets = TTLCache(maxsize=4096, ttl=60 * 60)
+        self.workspace_buckets = TTLCache(maxsize=64, ttl=60 * 60)
+        self.lock = threading.Lock()
+
+    def _debounce(self, key):
+        """Holds a request that follows the previous one for the same key
+        within the debounce window. Returns False when a newer request for
+        the same key arrived meanwhile."""
+        event = threading.Event()
+        now = time.monotonic()
+        with self.lock:
+            last_arrival = self.arrivals.get(key)
+            self.arrivals[key] = now
+            if last_arrival is None or now - last_arrival >= self.debounce_seconds:
+                # Nothing is pending, held requests wait less than the window
+                return True
+            previous = self.pending.get(key)
+            self.pending[key] = event
+        if previous is not None:
+            previous.set()
+        superseded = event.wait(self.debounce_seconds)
+        with self.lock:
+            if self.pending.get(key) is event:
+                del self.pending[key]
+        return not superseded
+
+    def _get_bucket(self, buckets, key, rate):
+        with self.lock:
+            bucket = buckets.get(key)
+            if bucket is None:
+                bucket = buckets[key] = TokenBucket(*rate)
+            return bucket
+
+    def admit(self, body):
+        """Returns 'admitted' or the reason the request is shed."""
+        debounce_key, _ = _get_request_keys(body)
+        team_id, user_id, _ = debounce_key
+        if self.debounce_seconds and not self._debounce(debounce_key):
+            return 'superseded'
+        if not self._get_bucket(self.user_buckets, (team_id, user_id), self.user_rate).try_acquire():
+            return 'user_throttled'
+        if not self._get_bucket(self.workspace_buckets, team_id, self.workspace_rate).try_acquire():
+            return 'workspace_throttled'
+        return 'admitted'
+
+    def wrap(self, listener):
+        """Wraps an options listener taking `ack` and `body`."""
+        @wraps(listener)
+        def wrapper(**kwargs):
+            ack, body = kwargs['ack'], kwargs['body']
+            _, result_key = _get_request_keys(body)
+            action_id = body.get('action_id', '')
+            result = self.admit(body)
+            OPTIONS_REQUESTS.inc(action_id, result)
+            if result != 'admitted':
+                logger.debug('Shed options request for %s: %s', action_id, result)
+                with self.lock:
+                    last_result = self.last_results.get(result_key, {'options': []})
+                ack(**last_result)
+                return
+
+            def recording_ack(**ack_kwargs):
+                # A placeholder asking to type again is no result to repeat
+                if not _is_placeholder(ack_kwargs):
+                    with self.lock:
+                        self.last_results[result_key] = ack_kwargs
+                return ack(**ack_kwargs)
+
+            kwargs['ack'] = recording_ack
+            return listener(**kwargs)
+        return wrapper
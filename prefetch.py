@@ -0,0 +1,179 @@
+import logging
+import sqlite3
+import threading
+import time
+from concurrent.futures import wait
+
+from cachetools import TTLCache
+
+from handlers import OptionsHandler
+from metrics import get_shared_executor
+from slack_client import TokenBucket
+from sqlite_store import SQLiteStore
+from tracing import submit_with_context
+
+logger = logging.getLogger(__name__)
+
+prefetch_history_db_path = 'prefetch_history.db'
+
+PREFETCH_HISTORY_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS selections (
+        user_id TEXT NOT NULL,
+        subscription_id TEXT NOT NULL,
+        service_id TEXT NOT NULL,
+        uses INTEGER NOT NULL,
+        last_used REAL NOT NULL,
+        PRIMARY KEY (user_id, subscription_id, service_id)
+    );
+"""
+
+
+class PrefetchHistoryStore(SQLiteStore):
+    """SQLite backed history of the subscription and service each user filed
+    tickets for."""
+
+    SCHEMA = PREFETCH_HISTORY_SCHEMA
+    MAX_ROWS_PER_USER = 50
+
+    def __init__(self, path=prefetch_history_db_path):
+        super().__init__(path)
+
+    def record(self, user_id, subscription_id, service_id, used_at):
+        with self.lock, self.conn:
+            self.conn.execute(
+                'INSERT INTO selections VALUES (?, ?, ?, 1, ?) '
+                'ON CONFLICT (user_id, subscription_id, service_id) '
+                'DO UPDATE SET uses = uses + 1, last_used = excluded.last_used',
+                (user_id, subscription_id, service_id, used_at))
+            # Forget the combinations unused for longest
+            self.conn.execute(
+                'DELETE FROM selections WHERE user_id = ? AND rowid NOT IN ('
+                'SELECT rowid FROM selections WHERE user_id = ? ORDER BY last_used DESC LIMIT ?)',
+                (user_id, user_id, self.MAX_ROWS_PER_USER))
+
+    def get_selections(self, user_id):
+        with self.lock:
+            rows = self.conn.execute(
+                'SELECT subscription_id, service_id, uses, last_used FROM selections WHERE user_id = ?',
+                (user_id,)).fetchall()
+        return rows
+
+
+def _matches(combination, subscription_id, service_id):
+    return bool(subscription_id) and combination[0] == subscription_id and (
+        not service_id or combination[1] == service_id)
+
+
+class PredictivePrefetcher:
+    """Warms the dropdowns a user is likely to open.
+
+    When a user opens the support modal, the resources and problem
+    classifications of their most likely subscription and service
+    combinations are fetched speculatively, ranked by how often and how
+    recently they filed tickets for them. The history is read on the
+    prefetch pool, not on the listener thread. Each user has a budget of
+    Azure lookups for this; a combination needing more lookups than the
+    budget holds is warmed in part. Queued warm-ups are cancelled as soon as
+    the user picks a different subscription or service.
+    """
+
+    TOP_COMBINATIONS = 3
+    HALF_LIFE_DAYS = 14
+    # Azure lookups per minute and burst, per user
+    USER_BUDGET = (30, 10)
+    WORKERS = 2
+
+    def __init__(self, store: PrefetchHistoryStore, options_handler: OptionsHandler,
+                 top_combinations=TOP_COMBINATIONS, user_budget=USER_BUDGET, workers=WORKERS, executor=None):
+        self.store = store
+        self.options_handler = options_handler
+        self.top_combinations = top_combinations
+        self.user_budget = user_budget
+        self.executor = get_shared_executor(executor, 'prefetch', workers)
+        # Per user, (combination, future) of the queued warm-ups, and
+        # (None, future) while the history is read
+        self.pending = {}
+        # Picks made before the history was read
+        self.picks = {}
+        self.budgets = TTLCache(maxsize=4096, ttl=60 * 60)
+        self.lock = threading.Lock()
+
+    def record(self, user_id, subscription_id, service_id):
+        if not (user_id and subscription_id and service_id):
+            return
+        try:
+            self.store.record(user_id, subscription_id, service_id, time.time())
+        except sqlite3.Error as e:
+            logger.warning('Failed to record the prefetch history of %s: %s', user_id, e)
+
+    def get_likely_combinations(self, user_id, now=None):
+        now = now or time.time()
+        scored = []
+        for subscription_id, service_id, uses, last_used in self.store.get_selections(user_id):
+            age_days = max(0, now - last_used) / 86400
+            scored.append((uses * 0.5 ** (age_days / self.HALF_LIFE_DAYS), subscription_id, service_id))
+        scored.sort(reverse=True)
+        return [(subscription_id, service_id) for _, subscription_id, service_id in scored[:self.top_combinations]]
+
+    def prefetch_for_user(self, user_id):
+        if not self.top_combinations:
+            return
+        self.cancel(user_id)
+        with self.lock:
+            self.picks.pop(user_id, None)
+            self.pending[user_id] = [(None, submit_with_context(self.executor, self._plan, user_id))]
+
+    def _plan(self, user_id):
+        try:
+            combinations = self.get_likely_combinations(user_id)
+        except sqlite3.Error as e:
+            logger.warning('Failed to read the prefetch history of %s: %s', user_id, e)
+            return
+        with self.lock:
+            futures = self.pending.get(user_id, [])
+            if not any(combination is None for combination, _ in futures):
+                # Cancelled while the history was read
+                return
+            picks = self.picks.pop(user_id, None)
+            if picks is not None:
+                combinations = [c for c in combinations if _matches(c, *picks)]
+            self.pending[user_id] = [(c, f) for c, f in futures if c is not None] + [
+                (c, submit_with_context(self.executor, self._warm, user_id, *c)) for c in combinations]
+
+    def cancel(self, user_id, subscription_id=None, service_id=None):
+        """Cancels the queued warm-ups of a user not matching the picks."""
+        with self.lock:
+            futures = self.pending.pop(user_id, [])
+            keep = []
+            for combination, future in futures:
+                if combination is None:
+                    # Still reading the history, warm the picks only
+                    if subscription_id:
+                        self.picks[user_id] = (subscription_id, service_id)
+                        keep.append((combination, future))
+                    else:
+                        future.cancel()
+                elif _matches(combination, subscription_id, service_id):
+                    keep.append((combination, future))
+                elif future.cancel():
+                    logger.debug('Cancelled prefetch of %s for %s', combination, user_id)
+            if keep:
+                self.pending[user_id] = keep
+
+    def _get_budget(self, user_id):
+        with self.lock:
+            bucket = self.budgets.get(user_id)
+            if bucket is None:
+                bucket = self.budgets[user_id] = TokenBucket(*self.user_budget)
+            return bucket
+
+    def _warm(self, user_id, subscription_id, service_id):
+        # One lookup per resource type plus the problem classifications. The
+        # budget never holds more than its burst, the resource types past it
+        # are left to load when the user opens the select.
+        resource_types = list(self.options_handler.azure_support.get_resource_types_by_service_id(service_id))
+        resource_types = resource_types[:max(0, self.user_budget[1] - 1)]
+        if not self._get_budget(user_id).try_acquire(len(resource_types) + 1):
+            logger.debug('Prefetch budget of %s exhausted, skipping %s', user_id, (subscription_id, service_id))
+            return
+        wait(self.options_handler.prefetch(subscription_id, service_id, resource_types))
@@ -0,0 +1,104 @@
+import base64
+import json
+import logging
+import zlib
+
+try:
+    import orjson
+except ImportError:  # Optional, the stdlib json module is used without it
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+# Slack rejects views with longer private_metadata
+PRIVATE_METADATA_MAX_CHARS = 3000
+
+PRIVATE_METADATA_VERSION = 1
+
+# Encoded metadata over this length is compressed, when that makes it shorter
+COMPRESS_OVER_CHARS = 512
+
+# Short keys of the metadata stored in the modal. Encoded views can be
+# reopened after a deploy, so entries are never changed or reused; a new
+# version gets a new table.
+PRIVATE_METADATA_KEYS_V1 = {
+    'user_id': 'u',
+    'real_name': 'n',
+    'email': 'e',
+    'phone': 'p',
+    'select_azure_subscription': 's',
+    'select_azure_service': 'v',
+    'select_azure_service_problem_classifications': 'c',
+    'select_azure_resource': 'r',
+    'select_severity': 'y',
+    'select_advanced_diagnostic_information': 'a',
+    'select_preferred_contact_method': 'm',
+    'select_msg_post_destination': 'd',
+}
+_EXPANDED_KEYS_V1 = {short: key for key, short in PRIVATE_METADATA_KEYS_V1.items()}
+
+
+if orjson is not None:
+    def dumps(data):
+        """Compact JSON as str."""
+        return orjson.dumps(data).decode('utf-8')
+
+    def loads(data):
+        return orjson.loads(data)
+else:
+    def dumps(data):
+        """Compact JSON as str."""
+        return json.dumps(data, separators=(',', ':'), ensure_ascii=False)
+
+    def loads(data):
+        return json.loads(data)
+
+
+def _shorten_key(key):
+    # A key that looks like a short one is escaped, so it survives decoding
+    short = PRIVATE_METADATA_KEYS_V1.get(key)
+    if short is not None:
+        return short
+    return f'_{key}' if key in _EXPANDED_KEYS_V1 or key.startswith('_') else key
+
+
+def _expand_key(key):
+    if key.startswith('_'):
+        return key[1:]
+    return _EXPANDED_KEYS_V1.get(key, key)
+
+
+def encode_private_metadata(data):
+    """Encodes the modal's state for its private_metadata.
+
+    `1.<json>` with the keys shortened, or `1z.<base64 zlib json>` when that
+    is shorter. Raises ValueError when the result exceeds Slack's limit.
+    """
+    encoded = dumps({_shorten_key(k): v for k, v in data.items()})
+    if len(encoded) > COMPRESS_OVER_CHARS:
+        compressed = base64.b85encode(zlib.compress(encoded.encode('utf-8'), 9)).decode('ascii')
+        if len(compressed) + 1 < len(encoded):
+            encoded = f'{PRIVATE_METADATA_VERSION}z.{compressed}'
+        else:
+            encoded = f'{PRIVATE_METADATA_VERSION}.{encoded}'
+    else:
+        encoded = f'{PRIVATE_METADATA_VERSION}.{encoded}'
+    if len(encoded) > PRIVATE_METADATA_MAX_CHARS:
+        raise ValueError(f'private_metadata of {len(encoded)} characters exceeds the limit of '
+                         f'{PRIVATE_METADATA_MAX_CHARS}')
+    return encoded
+
+
+def decode_private_metadata(encoded):
+    """Decodes `encode_private_metadata` output, and the plain JSON of views
+    opened before it."""
+    if not encoded:
+        return {}
+    if encoded.startswith('{'):
+        return loads(encoded)
+    version, _, payload = encoded.partition('.')
+    if version == f'{PRIVATE_METADATA_VERSION}z':
+        payload = zlib.decompress(base64.b85decode(payload)).decode('utf-8')
+    elif version != str(PRIVATE_METADATA_VERSION):
+        raise ValueError(f'Unsupported private_metadata version {version!r}')
+    return {_expand_key(k): v for k, v in loads(payload).items()}
@@ -0,0 +1,202 @@
+import abc
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+from cachetools import LRUCache
+from slack_sdk.errors import SlackApiError
+from slack_sdk.http_retry import ConnectionErrorRetryHandler
+
+from metrics import SLACK_QUEUE_WAIT, SLACK_RATE_LIMITED, InstrumentedWebClient
+
+logger = logging.getLogger(__name__)
+
+# Lower runs first: views must be opened or updated while the trigger or view
+# is still valid, thread posts can wait.
+PRIORITY_INTERACTIVE = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BULK = 2
+
+# Requests per minute of Slack's rate limit tiers
+TIER_2 = 20
+TIER_3 = 50
+TIER_4 = 100
+
+# (requests per minute, burst) of the methods the bot calls
+METHOD_LIMITS = {
+    'views.open': (TIER_4, 10),
+    'views.update': (TIER_4, 10),
+    'views.push': (TIER_4, 10),
+    'users.info': (TIER_4, 10),
+    'reactions.add': (TIER_3, 5),
+    'conversations.info': (TIER_3, 5),
+    # Special tier: about one message per second per channel
+    'chat.postMessage': (60, 3),
+}
+PER_CHANNEL_METHODS = {'chat.postMessage'}
+
+METHOD_PRIORITIES = {
+    'views.open': PRIORITY_INTERACTIVE,
+    'views.update': PRIORITY_INTERACTIVE,
+    'views.push': PRIORITY_INTERACTIVE,
+    'users.info': PRIORITY_INTERACTIVE,
+    'chat.postMessage': PRIORITY_BULK,
+}
+
+
+class PriorityLimiter(abc.ABC):
+    """Hands out permits in priority order, then in arrival order."""
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.waiters = []
+        self.sequence = itertools.count()
+
+    @abc.abstractmethod
+    def _try_take(self, now):
+        """Takes a permit if one is available. Returns (taken, seconds until
+        one may be available or None to wait for a release)."""
+
+    def acquire(self, priority=PRIORITY_NORMAL):
+        with self.condition:
+            entry = (priority, next(self.sequence))
+            heapq.heappush(self.waiters, entry)
+            self.condition.notify_all()
+            try:
+                while True:
+                    timeout = None
+                    if self.waiters[0] == entry:
+                        taken, timeout = self._try_take(time.monotonic())
+                        if taken:
+                            return
+                    self.condition.wait(timeout)
+            finally:
+                self.waiters.remove(entry)
+                heapq.heapify(self.waiters)
+                self.condition.notify_all()
+
+
+class TokenBucket(PriorityLimiter):
+
+    def __init__(self, rate_per_minute, burst):
+        super().__init__()
+        self.rate = rate_per_minute / 60
+        self.capacity = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def _try_take(self, now):
+        self._refill(now)
+        if now < self.paused_until:
+            return False, self.paused_until - now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True, None
+        return False, (1 - self.tokens) / self.rate
+
+    def try_acquire(self, tokens=1):
+        """Takes tokens without waiting, if nobody is queued for one."""
+        with self.condition:
+            now = time.monotonic()
+            self._refill(now)
+            if self.waiters or now < self.paused_until or self.tokens < tokens:
+                return False
+            self.tokens -= tokens
+            return True
+
+    def pause(self, seconds):
+        """Holds every caller back after Slack answered with Retry-After."""
+        with self.condition:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+            self.condition.notify_all()
+
+
+class ConcurrencyLimiter(PriorityLimiter):
+
+    def __init__(self, limit):
+        super().__init__()
+        self.available = limit
+
+    def _try_take(self, now):
+        if self.available > 0:
+            self.available -= 1
+            return True, None
+        return False, None
+
+    def release(self):
+        with self.condition:
+            self.available += 1
+            self.condition.notify_all()
+
+
+def _get_channel(kwargs):
+    for key in ('json', 'params', 'data'):
+        if kwargs.get(key) and 'channel' in kwargs[key]:
+            return kwargs[key]['channel']
+    return None
+
+
+class RateLimitedWebClient(InstrumentedWebClient):
+    """WebClient pacing calls to Slack's per-method rate limits.
+
+    Each method (and channel, for chat.postMessage) has a token bucket sized
+    to its tier. A 429 pauses the bucket for Retry-After and the call is
+    retried, so messages are delayed rather than lost. At most
+    `max_connections` calls are in flight, handed out by priority. A call
+    whose connection was reset is retried once by slack_sdk.
+    """
+
+    MAX_CONNECTIONS = 8
+    MAX_RATE_LIMIT_RETRIES = 5
+
+    def __init__(self, token=None, max_connections=MAX_CONNECTIONS, **kwargs):
+        # 429s are retried by api_call, which pauses the method's bucket for
+        # every caller rather than sleeping in the one that got it
+        kwargs.setdefault('retry_handlers', [ConnectionErrorRetryHandler(max_retry_count=1)])
+        super().__init__(token, **kwargs)
+        self.buckets = LRUCache(maxsize=1024)
+        self.buckets_lock = threading.Lock()
+        self.slots = ConcurrencyLimiter(max_connections)
+
+    def _get_bucket(self, api_method, kwargs):
+        limit = METHOD_LIMITS.get(api_method)
+        if limit is None:
+            return None
+        key = (api_method, _get_channel(kwargs)) if api_method in PER_CHANNEL_METHODS else (api_method, None)
+        with self.buckets_lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = TokenBucket(*limit)
+            return bucket
+
+    def api_call(self, api_method, **kwargs):
+        priority = METHOD_PRIORITIES.get(api_method, PRIORITY_NORMAL)
+        bucket = self._get_bucket(api_method, kwargs)
+        for attempt in itertools.count():
+            with SLACK_QUEUE_WAIT.time(api_method):
+                if bucket is not None:
+                    bucket.acquire(priority)
+                self.slots.acquire(priority)
+            try:
+                return super().api_call(api_method, **kwargs)
+            except SlackApiError as e:
+                if e.response.status_code != 429 or attempt >= self.MAX_RATE_LIMIT_RETRIES:
+                    raise
+                delay = float(e.response.headers.get('Retry-After', 1))
+            finally:
+                self.slots.release()
+
+            SLACK_RATE_LIMITED.inc(api_method)
+            logger.info('Slack rate limited %s, retrying in %ss', api_method, delay)
+            if bucket is not None:
+                bucket.pause(delay)
+            else:
+                time.sleep(delay)
@@ -0,0 +1,123 @@
+import logging
+import os
+import random
+import signal
+import threading
+import time
+
+from slack_bolt.adapter.socket_mode.internals import run_bolt_app, send_response
+from slack_sdk.socket_mode import SocketModeClient
+
+from metrics import InstrumentedExecutor, register_executor
+
+logger = logging.getLogger(__name__)
+
+
+def get_backoff_delay(attempt, base=1.0, cap=60.0):
+    """Exponential backoff with jitter, so connections dropped together do not
+    reconnect in lockstep."""
+    delay = min(cap, base * 2 ** (attempt - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+class SocketModeRunner:
+    """Serves the Bolt app over several Socket Mode connections.
+
+    Slack spreads requests across all open connections of an app. Each
+    connection only hands requests over to one shared, bounded dispatch pool,
+    so a slow Azure lookup holds a single worker instead of the connection
+    that received it. Reconnects are driven here with backoff instead of the
+    client's fixed-interval retry.
+    """
+
+    CONNECTIONS = 2
+    CONCURRENCY = 16
+    CHECK_INTERVAL = 1
+    MAX_BACKOFF = 60
+
+    def __init__(self, app, app_token, connections=CONNECTIONS, concurrency=CONCURRENCY):
+        self.app = app
+        self.app_token = app_token
+        self.connections = connections
+        self.executor = InstrumentedExecutor(max_workers=concurrency, thread_name_prefix='socket-mode')
+        register_executor('socket_mode', self.executor)
+        self.clients = []
+        self.stopped = threading.Event()
+
+    def _create_client(self):
+        client = SocketModeClient(
+            app_token=self.app_token,
+            logger=self.app.logger,
+            web_client=self.app.client,
+            auto_reconnect_enabled=False,
+            concurrency=1)
+        client.socket_mode_request_listeners.append(self._on_request)
+        return client
+
+    def _on_request(self, client, req):
+        # Runs on the connection's own worker; only hand the request over
+        self.executor.submit(self._dispatch, client, req)
+
+    def _dispatch(self, client, req):
+        start = time.time()
+        try:
+            send_response(client, req, run_bolt_app(self.app, req), start)
+        except Exception as e:
+            logger.exception('Failed to process Socket Mode request %s: %s', req.envelope_id, e)
+
+    def _supervise(self, client, index):
+        failures = 0
+        while not self.stopped.is_set():
+            if client.is_connected():
+                failures = 0
+                self.stopped.wait(self.CHECK_INTERVAL)
+                continue
+            try:
+                client.connect_to_new_endpoint()
+                logger.info('Socket Mode connection %s established', index)
+            except Exception as e:
+                failures += 1
+                delay = get_backoff_delay(failures, cap=self.MAX_BACKOFF)
+                logger.warning('Socket Mode connection %s failed (%s), retrying in %.1fs', index, e, delay)
+                self.stopped.wait(delay)
+
+    def start(self):
+        for i in range(self.connections):
+            client = self._create_client()
+            self.clients.append(client)
+            threading.Thread(target=self._supervise, args=(client, i), daemon=True).start()
+
+    def stop(self):
+        self.stopped.set()
+        for client in self.clients:
+            try:
+                client.close()
+            except Exception as e:
+                logger.info('Failed to close Socket Mode connection: %s', e)
+        self.executor.shutdown(wait=True)
+
+
+def main():
+    import app as bot
+    from metrics import start_metrics_server
+
+    runner = SocketModeRunner(
+        bot.create_app(),
+        os.environ['SLACK_APP_TOKEN'],
+        connections=int(os.environ.get('SOCKET_MODE_CONNECTIONS', SocketModeRunner.CONNECTIONS)),
+        concurrency=int(os.environ.get('SOCKET_MODE_CONCURRENCY', SocketModeRunner.CONCURRENCY)))
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    signal.signal(signal.SIGINT, lambda *_: stop.set())
+
+    bot.start_background_services()
+    start_metrics_server(int(os.environ.get('METRICS_PORT', 9090)))
+    runner.start()
+    stop.wait()
+
+    runner.stop()
+    bot.shutdown()
+
+
+if __name__ == '__main__':
+    main()
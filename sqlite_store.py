@@ -0,0 +1,26 @@
+import sqlite3
+import threading
+
+
+class SQLiteStore:
+    """Base of the stores keeping their state in a SQLite file.
+
+    Subclasses set `SCHEMA`, the script creating their tables, and hold
+    `lock` around each use of `conn`, which is shared by all threads.
+    """
+
+    SCHEMA = ''
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self._conn = None
+
+    @property
+    def conn(self):
+        # Opened on first use so a store created before a worker fork is not
+        # shared with the parent process.
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.executescript(self.SCHEMA)
+        return self._conn
@@ -0,0 +1,96 @@
+import argparse
+import logging
+import re
+import subprocess
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+from metrics import REGISTRY
+from structured_logging import log_event
+
+logger = logging.getLogger(__name__)
+
+# Close enough to the process start, this module is imported first by app.py
+STARTED_AT = time.monotonic()
+
+_IMPORT_TIME_LINE = re.compile(r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)')
+
+
+class StartupProfile:
+    """Durations of the startup phases and the time from process start until
+    the app first reports ready."""
+
+    def __init__(self, started_at=STARTED_AT):
+        self.started_at = started_at
+        self.phases = {}
+        self.ready_seconds = None
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            seconds = time.monotonic() - start
+            with self.lock:
+                self.phases[name] = seconds
+            log_event(logger, logging.INFO, 'app.startup_phase', phase=name, seconds=round(seconds, 3))
+
+    def mark_ready(self):
+        with self.lock:
+            if self.ready_seconds is not None:
+                return
+            self.ready_seconds = time.monotonic() - self.started_at
+        log_event(logger, logging.INFO, 'app.ready', seconds=round(self.ready_seconds, 3))
+
+
+startup_profile = StartupProfile()
+
+REGISTRY.gauge(
+    'startup_phase_seconds', 'Duration of each startup phase',
+    lambda: {(name,): seconds for name, seconds in startup_profile.phases.items()}, ('phase',))
+REGISTRY.gauge(
+    'time_to_ready_seconds', 'Seconds from process start until the app was first ready',
+    lambda: {(): startup_profile.ready_seconds} if startup_profile.ready_seconds is not None else {})
+
+
+def parse_import_times(output):
+    """Parses `python -X importtime` output into (module, self_us,
+    cumulative_us, depth) tuples."""
+    entries = []
+    for line in output.splitlines():
+        match = _IMPORT_TIME_LINE.match(line)
+        if match:
+            self_us, cumulative_us, indent, module = match.groups()
+            entries.append((module, int(self_us), int(cumulative_us), (len(indent) - 1) // 2))
+    return entries
+
+
+def profile_imports(module='app'):
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        capture_output=True, text=True)
+    return parse_import_times(result.stderr)
+
+
+def format_import_report(entries, top=20):
+    total = max((cumulative for _, _, cumulative, depth in entries if depth == 0), default=0)
+    lines = [f'Total import time: {total / 1000:.1f} ms', '', f'{"cumulative ms":>14} {"self ms":>8}  module']
+    for module, self_us, cumulative_us, depth in sorted(entries, key=lambda e: e[2], reverse=True)[:top]:
+        lines.append(f'{cumulative_us / 1000:>14.1f} {self_us / 1000:>8.1f}  {"  " * depth}{module}')
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Report the slowest imports of a module')
+    parser.add_argument('module', nargs='?', default='app')
+    parser.add_argument('--top', type=int, default=20)
+    args = parser.parse_args()
+    print(format_import_report(profile_imports(args.module), args.top))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+import json
+import logging
+import os
+import random
+
+REDACTED = '[redacted]'
+
+# Keys holding contact details or secrets, matched case-insensitively at any
+# depth of a logged payload.
+DEFAULT_REDACT_FIELDS = (
+    'email', 'phone', 'real_name', 'first_name', 'last_name',
+    'section_contact_information_email', 'section_contact_information_full_name',
+    'section_contact_information_additional_emails', 'select_preferred_contact_method_phone',
+    'primary_email_address', 'phone_number', 'additional_email_addresses',
+    'token', 'authorization',
+)
+
+
+class LogSettings:
+
+    MAX_PAYLOAD_CHARS = 512
+    MAX_ITEMS = 5
+    MAX_DEPTH = 6
+
+    def __init__(self):
+        self.max_payload_chars = self.MAX_PAYLOAD_CHARS
+        self.max_items = self.MAX_ITEMS
+        self.max_depth = self.MAX_DEPTH
+        self.redact_fields = set(DEFAULT_REDACT_FIELDS)
+        self.sample_rates = {}
+
+
+settings = LogSettings()
+
+
+def summarize(value, depth=0):
+    """Size-capped, redacted copy of a payload, safe to serialize."""
+    if depth >= settings.max_depth and isinstance(value, (dict, list, tuple, set)):
+        return f'{type(value).__name__} of {len(value)} items'
+    if isinstance(value, dict):
+        result = {}
+        for i, (k, v) in enumerate(value.items()):
+            if i == settings.max_items:
+                result['...'] = f'{len(value) - i} more keys'
+                break
+            result[k] = REDACTED if str(k).lower() in settings.redact_fields else summarize(v, depth + 1)
+        return result
+    if isinstance(value, (list, tuple, set)):
+        items = list(value)
+        if len(items) <= settings.max_items:
+            return [summarize(v, depth + 1) for v in items]
+        return {'count': len(items), 'head': [summarize(v, depth + 1) for v in items[:settings.max_items]]}
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    text = str(value)
+    if len(text) > settings.max_payload_chars:
+        return f'{text[:settings.max_payload_chars]}...(+{len(text) - settings.max_payload_chars} chars)'
+    return text
+
+
+def log_event(logger, level, event, **fields):
+    """Log a named event with payload fields.
+
+    Nothing is built unless the level is enabled and the event passes its
+    sample rate; fields are summarized and redacted only when formatted.
+    """
+    if not logger.isEnabledFor(level):
+        return
+    rate = settings.sample_rates.get(event)
+    if rate is not None and random.random() >= rate:
+        return
+    logger.log(level, event, extra={'event': event, 'event_fields': fields})
+
+
+class StructuredFormatter(logging.Formatter):
+
+    def __init__(self, json_output=False):
+        super().__init__('%(asctime)s %(levelname)s %(name)s %(message)s')
+        self.json_output = json_output
+
+    def _get_fields(self, record):
+        fields = getattr(record, 'event_fields', None) or {}
+        summarized = {}
+        for k, v in fields.items():
+            summarized[k] = REDACTED if k.lower() in settings.redact_fields else summarize(v)
+        return summarized
+
+    def format(self, record):
+        fields = self._get_fields(record)
+        if not self.json_output:
+            message = super().format(record)
+            if fields:
+                message += ' ' + ' '.join(f'{k}={json.dumps(v, default=str)}' for k, v in fields.items())
+            return message
+
+        payload = {
+            'ts': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        payload.update(fields)
+        if record.exc_info:
+            payload['exc'] = self.formatException(record.exc_info)
+        return json.dumps(payload, default=str)
+
+
+def _parse_sample_rates(value):
+    rates = {}
+    for item in value.split(','):
+        if '=' in item:
+            event, rate = item.split('=', 1)
+            rates[event.strip()] = float(rate)
+    return rates
+
+
+def configure_logging_from_env():
+    settings.max_payload_chars = int(os.environ.get('LOG_MAX_PAYLOAD_CHARS', LogSettings.MAX_PAYLOAD_CHARS))
+    settings.sample_rates = _parse_sample_rates(os.environ.get('LOG_SAMPLE_RATES', ''))
+    extra_fields = os.environ.get('LOG_REDACT_FIELDS', '')
+    settings.redact_fields = set(DEFAULT_REDACT_FIELDS) | {
+        f.strip().lower() for f in extra_fields.split(',') if f.strip()}
+
+    handler = logging.StreamHandler()
+    handler.setFormatter(StructuredFormatter(os.environ.get('LOG_FORMAT', 'text') == 'json'))
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(os.environ.get('LOG_LEVEL', 'INFO').upper())
+    logging.getLogger('azure').setLevel(logging.WARNING)
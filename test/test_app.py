@@ -3,12 +3,14 @@ import sys
 import os
 import pytest
 from unittest.mock import patch, MagicMock
+from serialization import encode_private_metadata
 
 # Ensure the parent directory is in sys.path so app can be imported
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 
-def test_handle_contact_information_sets_initial_values():
+def test_handle_contact_information_sets_initial_values(caplog):
+    caplog.set_level('DEBUG', logger='app')
     blocks = [
         {'block_id': app.Blocks.BLOCK_ID_CONTACT_INFO_FULL_NAME, 'element': {}},
         {'block_id': app.Blocks.BLOCK_ID_CONTACT_INFO_EMAIL, 'element': {}}
@@ -17,11 +19,13 @@ def test_handle_contact_information_sets_initial_values():
     result = app.handle_contact_information(blocks, private_metadata)
     assert result[0]['element']['initial_value'] == 'John Doe'
     assert result[1]['element']['initial_value'] == 'john@example.com'
+    assert all('john@example.com' not in repr(getattr(r, 'event_fields', '')) for r in caplog.records)
 
 
-def test_get_as_json():
-    data = {'a': 1}
-    assert app.get_as_json(data) == '{"a": 1}'
+def test_private_metadata_round_trip():
+    data = {'user_id': 'U1', 'select_azure_service': 'svc1', 'a': 1}
+    body = {"view": {"private_metadata": encode_private_metadata(data)}}
+    assert app.get_private_metadata(body) == data
 
 
 def test_get_private_metadata():
@@ -48,3 +52,209 @@ def test_map_submitted_data_to_flat_dict_handles_full_name_and_emails():
     assert result['first_name'] == 'John'
     assert result['last_name'] == 'Doe'
     assert result[app.Blocks.BLOCK_ID_CONTACT_INFO_ADDITIONAL_EMAILS] == ['a@b.com', 'c@d.com']
+
+
+@patch('app.AzureSupportHelper')
+@patch('app.DefaultAzureCredential')
+@patch('app.load_dataset_services_mapped', return_value={'Compute': []})
+def test_app_services_initialize_in_background(mock_load, mock_credential, mock_helper, tmp_path, monkeypatch):
+    monkeypatch.setenv('TICKET_SYNC_DB', str(tmp_path / 'sync.db'))
+    monkeypatch.setenv('ATTACHMENT_UPLOADS_DB', str(tmp_path / 'uploads.db'))
+    client = MagicMock()
+    client.auth_test.return_value = {'user_id': 'UBOT', 'bot_id': 'B1', 'team_id': 'T1'}
+
+    services = app.AppServices(client, 'xoxb-test')
+    services.wait_until_initialized()
+
+    assert services.is_initialized()
+    assert services.bot_id == 'UBOT'
+    assert services.azure_support is mock_helper.return_value
+    mock_helper.assert_called_once_with(
+        services.azure_credentials, cache_partition=None, service_catalog=services.service_catalog,
+        subscriptions_snapshot=services.subscriptions_snapshot)
+    assert services.service_catalog.current.dataset == {'Compute': []}
+    client.auth_test.assert_called_once()
+
+
+@patch('app.AzureSupportHelper')
+@patch('app.ClientSecretCredential')
+@patch('app.DefaultAzureCredential')
+@patch('app.load_dataset_services_mapped', return_value={'Compute': []})
+def test_workspaces_share_pools_and_dataset(mock_load, mock_default, mock_secret, mock_helper, tmp_path, monkeypatch):
+    from workspaces import WorkspaceConfig, _current_team_id
+    monkeypatch.setenv('TICKET_SYNC_DB', str(tmp_path / 'sync.db'))
+    monkeypatch.setenv('ATTACHMENT_UPLOADS_DB', str(tmp_path / 'uploads.db'))
+    monkeypatch.setenv('PREFETCH_HISTORY_DB', str(tmp_path / 'prefetch.db'))
+    primary_client, other_client = MagicMock(), MagicMock()
+    primary_client.auth_test.return_value = {'user_id': 'UBOT', 'bot_id': 'B1', 'team_id': 'T1'}
+    other_client.auth_test.return_value = {'user_id': 'UBOT2', 'bot_id': 'B2', 'team_id': 'T2'}
+    workspace = WorkspaceConfig('T2', 'xoxb-2', azure_tenant_id='tenant-2', azure_client_id='app-2',
+                                azure_client_secret='secret', cache_quota_mb=8)
+
+    primary = app.AppServices(primary_client, 'xoxb-1')
+    other = app.AppServices(other_client, 'xoxb-2', workspace, shared=primary)
+    router = app.WorkspaceRouter(primary, [other])
+    router.wait_until_initialized()
+
+    mock_load.assert_called_once()
+    mock_secret.assert_called_once_with('tenant-2', 'app-2', 'secret')
+    assert other.azure_credentials.cache_partition == 'T2'
+    assert other.executor is primary.executor
+    assert other.options_handler.executor is primary.options_handler.executor
+    assert other.options_handler is not primary.options_handler
+    assert other.ticket_sync_store.path == str(tmp_path / 'sync.T2.db')
+    assert other.service_catalog is primary.service_catalog
+
+    assert router.authorize('T2').bot_user_id == 'UBOT2'
+    assert router.authorize('T1').bot_user_id == 'UBOT'
+    assert router.authorize('T3') is None
+    assert router.bot_id == 'UBOT'
+    token = _current_team_id.set('T2')
+    try:
+        assert router.bot_id == 'UBOT2'
+    finally:
+        _current_team_id.reset(token)
+
+
+def test_authorize_is_callable_by_bolt(monkeypatch):
+    from slack_bolt.authorization.authorize import CallableAuthorize
+    services = MagicMock()
+    services.authorize.return_value = app.AuthorizeResult(
+        enterprise_id=None, team_id='T1', bot_token='xoxb-test', bot_user_id='UBOT')
+    monkeypatch.setattr(app, 'services', services)
+
+    authorize = CallableAuthorize(logger=MagicMock(), func=app.authorize)
+    result = authorize(context=MagicMock(), enterprise_id=None, team_id='T1', user_id='U1')
+
+    assert result is services.authorize.return_value
+
+
+def test_app_mention_routes_diag_to_diagnostics(monkeypatch):
+    services = MagicMock()
+    services.bot_id = 'UBOT'
+    services.diagnostics.handle.return_value = 'report'
+    monkeypatch.setattr(app, 'services', services)
+    say = MagicMock()
+    app.handle_app_mention({'user': 'UADMIN', 'text': '<@UBOT> diag invalidate all', 'channel': 'C1', 'ts': '1'}, say)
+    services.diagnostics.handle.assert_called_once_with('UADMIN', ['invalidate', 'all'])
+    say.assert_called_once_with('report')
+
+
+def _contact_method_body(value, *block_ids):
+    blocks = [{'type': 'section', 'block_id': b} for b in block_ids]
+    return {
+        'actions': [{'action_id': app.Blocks.PREFERRED_CONTACT_METHOD, 'selected_option': {'value': value}}],
+        'view': {'id': 'V1', 'hash': 'h1', 'type': 'modal', 'callback_id': 'cb', 'blocks': blocks,
+                 'private_metadata': encode_private_metadata({'phone': '555'})},
+    }
+
+
+def test_phone_contact_method_adds_one_phone_block(monkeypatch):
+    services = MagicMock()
+    monkeypatch.setattr(app, 'services', services)
+
+    app.handle_select_preferred_contact_method(
+        MagicMock(), _contact_method_body('phone', app.Blocks.PREFERRED_CONTACT_METHOD, 'contact'), None, None)
+
+    view = services.client.views_update.call_args.kwargs['view']
+    assert [b['block_id'] for b in view['blocks']] == [
+        app.Blocks.PREFERRED_CONTACT_METHOD, app.Blocks.PREFERRED_CONTACT_METHOD_PHONE, 'contact']
+    assert view['blocks'][1]['element']['initial_value'] == '555'
+
+    # Picking phone again leaves the view as it is
+    services.client.views_update.reset_mock()
+    app.handle_select_preferred_contact_method(MagicMock(), _contact_method_body(
+        'phone', app.Blocks.PREFERRED_CONTACT_METHOD, app.Blocks.PREFERRED_CONTACT_METHOD_PHONE), None, None)
+    services.client.views_update.assert_not_called()
+
+
+def test_email_contact_method_removes_phone_block(monkeypatch):
+    services = MagicMock()
+    monkeypatch.setattr(app, 'services', services)
+
+    app.handle_select_preferred_contact_method(MagicMock(), _contact_method_body(
+        'email', 'contact', app.Blocks.PREFERRED_CONTACT_METHOD, app.Blocks.PREFERRED_CONTACT_METHOD_PHONE), None, None)
+
+    view = services.client.views_update.call_args.kwargs['view']
+    assert [b['block_id'] for b in view['blocks']] == ['contact', app.Blocks.PREFERRED_CONTACT_METHOD]
+
+
+def test_map_submitted_data_to_flat_dict_handles_multi_selects():
+    submitted_data = {
+        app.Blocks.ADDITIONAL_AZURE_SUBSCRIPTIONS: {app.Blocks.ADDITIONAL_AZURE_SUBSCRIPTIONS: {'selected_options': [
+            {'value': 'sub2', 'text': {'type': 'plain_text', 'text': 'Sub 2'}}]}},
+    }
+    result = app.map_submitted_data_to_flat_dict(submitted_data)
+    assert result[app.Blocks.ADDITIONAL_AZURE_SUBSCRIPTIONS] == ['sub2']
+    assert result[app.Blocks.ADDITIONAL_AZURE_SUBSCRIPTIONS_TEXT] == ['Sub 2']
+
+
+def _subject_body(subject, *block_ids):
+    body = _contact_method_body('email', *block_ids)
+    body['actions'] = [{'action_id': app.Blocks.SUBJECT, 'value': subject}]
+    return body
+
+
+def test_subject_shows_similar_tickets_below_problem_details(monkeypatch):
+    services = MagicMock()
+    services.ticket_index.find_similar.return_value = [
+        {'subject': 'VM <down>', 'service': 'Virtual Machines', 'url': 'https://portal/t1', 'filed_at': 0}]
+    monkeypatch.setattr(app, 'services', services)
+
+    app.handle_subject(MagicMock(), _subject_body(
+        'vm down', app.Blocks.SUBJECT, app.Blocks.PROBLEM_DETAILS, 'contact'), None, None)
+
+    view = services.client.views_update.call_args.kwargs['view']
+    assert [b['block_id'] for b in view['blocks']] == [
+        app.Blocks.SUBJECT, app.Blocks.PROBLEM_DETAILS, app.Blocks.SIMILAR_TICKETS, 'contact']
+    assert '<https://portal/t1|VM &lt;down&gt;>' in view['blocks'][2]['text']['text']
+
+    # No matches left, the list goes away
+    services.ticket_index.find_similar.return_value = []
+    app.handle_subject(MagicMock(), _subject_body(
+        'vm down x', app.Blocks.SUBJECT, app.Blocks.PROBLEM_DETAILS, app.Blocks.SIMILAR_TICKETS), None, None)
+    view = services.client.views_update.call_args.kwargs['view']
+    assert app.Blocks.SIMILAR_TICKETS not in [b['block_id'] for b in view['blocks']]
+
+
+def test_listeners_and_say_use_the_rate_limited_client(monkeypatch):
+    from slack_bolt import BoltContext
+    services = MagicMock()
+    monkeypatch.setattr(app, 'services', services)
+    context = BoltContext({'client': MagicMock(), 'channel_id': 'C1'})
+
+    app.shared_client_middleware(context, MagicMock())
+
+    assert context.client is services.client
+    context.say('hi')
+    services.client.chat_postMessage.assert_called_once()
+
+
+@patch('app.SupportTicketSubmissionHandler')
+def test_view_submission_posts_through_the_rate_limited_client(mock_handler, monkeypatch):
+    services = MagicMock()
+    monkeypatch.setattr(app, 'services', services)
+    body = {'user': {'id': 'U1'}, 'view': {
+        'id': 'V1', 'private_metadata': encode_private_metadata({'user_id': 'U1'}),
+        'state': {'values': {app.Blocks.SUBJECT: {app.Blocks.SUBJECT: {'type': 'plain_text_input', 'value': 'x'}}}}}}
+
+    app.handle_view_submission(MagicMock(), body, MagicMock(), MagicMock())
+
+    assert mock_handler.call_args.args[3] is services.client
+
+
+def test_follower_polls_often_until_the_subscriptions_arrive(monkeypatch):
+    workspace = MagicMock()
+    workspace.azure_support.subscriptions_loaded.is_set.side_effect = [False, True]
+    services = MagicMock()
+    services.all.return_value = [workspace]
+    monkeypatch.setattr(app, 'services', services)
+    monkeypatch.setenv('SERVICE_CATALOG_REFRESH_HOURS', '0')
+    election = MagicMock()
+    election.is_leader.is_set.side_effect = [False, False, True]
+    monkeypatch.setattr(app, 'election', election)
+
+    app._follow_elected_process()
+
+    assert [c.args[0] for c in election.is_leader.wait.call_args_list] == [
+        app.FOLLOW_SECONDS_UNTIL_LOADED, app.FOLLOW_SECONDS]
@@ -0,0 +1,121 @@
+import base64
+import io
+import time
+import pytest
+from unittest.mock import MagicMock, patch
+from attachments import AttachmentUploader, UploadProgressStore
+
+
+class FakeResponse(io.BytesIO):
+    status = 200
+
+
+@pytest.fixture
+def store():
+    return UploadProgressStore(':memory:')
+
+
+@pytest.fixture
+def uploader(store):
+    return AttachmentUploader(MagicMock(), 'xoxb-test', store, chunk_size=4, max_in_flight=2)
+
+
+def uploaded_content(support_client):
+    chunks = {}
+    for call in support_client.files.upload.call_args_list:
+        upload_file = call.kwargs['upload_file']
+        chunks[(call.args[1], upload_file.chunk_index)] = base64.b64decode(upload_file.content)
+    return chunks
+
+
+def test_get_part_name():
+    assert AttachmentUploader._get_part_name('dump file.log', 0, 1) == 'dump_file.log'
+    assert AttachmentUploader._get_part_name('dump.log', 1, 3) == 'dump.part002.log'
+
+
+def test_upload_slack_file_splits_into_parts_and_chunks(uploader):
+    support_client = MagicMock()
+    data = b'0123456789abc'
+    slack_file = {'id': 'F1', 'name': 'dump.log', 'size': len(data), 'url_private_download': 'https://files'}
+
+    with patch.object(uploader, '_open_download', return_value=(FakeResponse(data), 0)):
+        names = uploader.upload_slack_file(support_client, 'ws', slack_file)
+
+    assert names == ['dump.part001.log', 'dump.part002.log']
+    sizes = [c.kwargs['create_file'].file_size for c in support_client.files.create.call_args_list]
+    assert sizes == [8, 5]
+    chunks = uploaded_content(support_client)
+    assert chunks[('dump.part001.log', 0)] == b'0123'
+    assert chunks[('dump.part001.log', 1)] == b'4567'
+    assert chunks[('dump.part002.log', 0)] == b'89ab'
+    assert chunks[('dump.part002.log', 1)] == b'c'
+
+
+def test_upload_slack_file_resumes_after_failure(uploader, store):
+    support_client = MagicMock()
+    data = b'0123456789abc'
+    slack_file = {'id': 'F1', 'name': 'dump.log', 'size': len(data), 'url_private_download': 'https://files'}
+
+    def fail_on_third_chunk(workspace, name, upload_file):
+        if name == 'dump.part002.log' and upload_file.chunk_index == 0:
+            raise RuntimeError('boom')
+    support_client.files.upload.side_effect = fail_on_third_chunk
+
+    with patch.object(uploader, '_open_download', return_value=(FakeResponse(data), 0)):
+        with pytest.raises(RuntimeError):
+            uploader.upload_slack_file(support_client, 'ws', slack_file)
+
+    assert store.get_uploaded_chunks('ws', 'F1') == {0, 1, 3}
+
+    retry_client = MagicMock()
+    with patch.object(uploader, '_open_download', return_value=(FakeResponse(data[8:]), 8)) as mock_open:
+        uploader.upload_slack_file(retry_client, 'ws', slack_file)
+
+    mock_open.assert_called_once_with('https://files', 8)
+    retry_client.files.create.assert_not_called()
+    assert uploaded_content(retry_client) == {('dump.part002.log', 0): b'89ab'}
+    assert store.get_uploaded_chunks('ws', 'F1') == set()
+
+
+@patch('attachments.MicrosoftSupport')
+def test_stalled_upload_is_resumed_and_given_up_after_max_attempts(mock_ms, uploader, store):
+    data = b'0123456789abc'
+    slack_file = {'id': 'F1', 'name': 'dump.log', 'size': len(data), 'url_private_download': 'https://files',
+                  'permalink': 'not kept'}
+    mock_ms.return_value.files.upload.side_effect = RuntimeError('boom')
+    with patch.object(uploader, '_open_download', return_value=(FakeResponse(data), 0)):
+        assert uploader.upload_slack_files('sub1', 'ws', [slack_file]) == []
+
+    # Still running as far as the store knows
+    assert uploader.resume_uploads() == []
+
+    mock_ms.return_value.files.upload.side_effect = None
+    with patch.object(uploader, '_open_download', return_value=(FakeResponse(data), 0)):
+        resumed = uploader.resume_uploads(now=time.time() + uploader.STALL_SECONDS + 1)
+    assert resumed == ['dump.part001.log', 'dump.part002.log']
+    assert store.get_stalled_uploads(time.time() + 3600) == []
+
+    store.add_upload('ws', 'sub1', slack_file, attempted_at=0)
+    for _ in range(uploader.MAX_ATTEMPTS - 1):
+        store.add_upload('ws', 'sub1', slack_file, attempted_at=0)
+    with patch.object(uploader, 'upload_slack_files') as mock_upload:
+        uploader.resume_uploads()
+    mock_upload.assert_not_called()
+    assert store.get_stalled_uploads(time.time()) == []
+
+
+def test_upload_making_progress_is_not_stalled(store):
+    slack_file = {'id': 'F1', 'name': 'dump.log', 'size': 10, 'url_private_download': 'https://files'}
+    store.add_upload('ws', 'sub1', slack_file, attempted_at=0)
+    assert len(store.get_stalled_uploads(1)) == 1
+
+    store.add_chunk('ws', 'F1', 0)
+
+    assert store.get_stalled_uploads(time.time() - 60) == []
+
+
+@patch('attachments.urllib.request.urlopen')
+def test_download_has_a_timeout(mock_urlopen, uploader):
+    mock_urlopen.return_value.status = 206
+    assert uploader._open_download('https://files', 8) == (mock_urlopen.return_value, 8)
+    assert mock_urlopen.call_args.kwargs['timeout'] == AttachmentUploader.DOWNLOAD_TIMEOUT
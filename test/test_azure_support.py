@@ -79,8 +79,99 @@ def test_get_problem_classification_details(mock_ms, mock_credentials, mock_data
             assert details["display_name"] == "Problem 1"
 
 
+@patch("azure_support.MicrosoftSupport")
+def test_ticket_names_filed_in_the_same_second_differ(mock_ms, mock_credentials, mock_dataset):
+    mock_ms.return_value.support_tickets.begin_create.return_value.result.return_value.id = "/tickets/t1"
+    with patch("azure_support.AzureSupportHelper._load_dataset_services_mapped", return_value=mock_dataset):
+        helper = AzureSupportHelper(mock_credentials)
+        names = {helper.create_support_ticket("subid", "service1", {})['ticket_name'] for _ in range(2)}
+        assert len(names) == 2
+
+
+@patch("azure_support.SubscriptionClient")
+def test_subscriptions_are_published_to_the_other_workers(mock_sub_client, mock_credentials, mock_dataset, tmp_path):
+    from leader import SharedSnapshot
+    sub = MagicMock(subscription_id="sub1", display_name="Sub 1")
+    with patch("azure_support.AzureSupportHelper._load_dataset_services_mapped", return_value=mock_dataset):
+        preloading = AzureSupportHelper(mock_credentials, subscriptions_snapshot=SharedSnapshot(str(tmp_path / "s.json")))
+        other = AzureSupportHelper(mock_credentials, subscriptions_snapshot=SharedSnapshot(str(tmp_path / "s.json")))
+    mock_sub_client.return_value.subscriptions.list.return_value = [sub]
+
+    preloading.refresh_subscription_list()
+    other.load_subscription_snapshot()
+
+    assert other.subscriptions_loaded.is_set()
+    assert other.get_subscription_list() == [{"id": "sub1", "display_name": "Sub 1"}]
+
+
+@patch("azure_support.SubscriptionClient")
+def test_subscriptions_not_loaded_yet_are_read_from_the_snapshot(mock_sub_client, mock_credentials, mock_dataset,
+                                                                 tmp_path):
+    from leader import SharedSnapshot
+    SharedSnapshot(str(tmp_path / "s.json")).publish([{"id": "sub1", "display_name": "Sub 1"}])
+    with patch("azure_support.AzureSupportHelper._load_dataset_services_mapped", return_value=mock_dataset):
+        helper = AzureSupportHelper(mock_credentials, subscriptions_snapshot=SharedSnapshot(str(tmp_path / "s.json")))
+
+    assert helper.get_subscription_list() == [{"id": "sub1", "display_name": "Sub 1"}]
+
+
 def test_get_support_ticket_azure_portal_url(mock_credentials, mock_dataset):
     with patch("azure_support.AzureSupportHelper._load_dataset_services_mapped", return_value=mock_dataset):
         helper = AzureSupportHelper(mock_credentials)
         url = helper._get_support_ticket_azure_portal_url("ticket/with/slash")
         assert "ticket%2Fwith%2Fslash" in url
+
+
+@patch("azure_support.time.sleep", side_effect=StopIteration)
+def test_preload_subscription_list_sets_loaded(mock_sleep, mock_credentials, mock_dataset):
+    with patch("azure_support.AzureSupportHelper._load_dataset_services_mapped", return_value=mock_dataset):
+        helper = AzureSupportHelper(mock_credentials)
+    sub = MagicMock(subscription_id="sub1", display_name="Subscription 1")
+    helper.subscription_client = MagicMock()
+    helper.subscription_client.subscriptions.list.return_value = [sub]
+    assert not helper.subscriptions_loaded.is_set()
+    with pytest.raises(StopIteration):
+        helper._preload_get_subscription_list()
+    assert helper.subscriptions_loaded.is_set()
+    assert helper.get_subscription_list() == [{'id': 'sub1', 'display_name': 'Subscription 1'}]
+
+
+@patch("azure_support.PipelineClient")
+def test_get_support_services_follows_next_links(mock_pipeline_client, mock_credentials):
+    first, second = MagicMock(), MagicMock()
+    first.json.return_value = {'value': [{'id': 'a'}], 'nextLink': 'https://management.azure.com/next'}
+    second.json.return_value = {'value': [{'id': 'b'}]}
+    client = mock_pipeline_client.return_value
+    client.send_request.side_effect = [first, second]
+
+    assert AzureSupportHelper.get_support_services(mock_credentials) == [{'id': 'a'}, {'id': 'b'}]
+    requests = [call.args[0] for call in client.send_request.call_args_list]
+    assert 'api-version=' in requests[0].url
+    assert requests[1].url == 'https://management.azure.com/next'
+
+
+@patch("azure_support.ResourceManagementClient")
+def test_resource_cache_is_filled_from_many_threads(mock_rm_client, monkeypatch):
+    from concurrent.futures import ThreadPoolExecutor
+    from types import SimpleNamespace
+    import workspaces
+    # Room for a few inventories only, so the threads keep evicting
+    monkeypatch.setitem(workspaces._cache_quotas, 'TSTRESS', 4096)
+    # Switch threads often enough to interleave the evictions
+    switch_interval = sys.getswitchinterval()
+    resources = [SimpleNamespace(id=f"/subscriptions/s/resourceGroups/rg/providers/t/r{i}", name=f"r{i}")
+                 for i in range(5)]
+    mock_rm_client.return_value.resources.list.side_effect = lambda filter: resources
+    credentials = MagicMock(cache_partition='TSTRESS')
+
+    def fill(thread):
+        for i in range(300):
+            AzureSupportHelper.get_sub_resources_by_resource_type(credentials, 's', f'type{thread}.{i}')
+
+    sys.setswitchinterval(1e-6)
+    try:
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            for future in [executor.submit(fill, t) for t in range(8)]:
+                future.result()
+    finally:
+        sys.setswitchinterval(switch_interval)
@@ -0,0 +1,47 @@
+import benchmark
+
+
+def test_time_callable_returns_seconds_per_call():
+    calls = []
+    seconds = benchmark.time_callable(lambda: calls.append(1), repeat=3, min_time=0.001)
+    assert 0 < seconds < 0.001
+    assert len(calls) > 3
+
+
+def test_compare_flags_regressions_over_threshold():
+    rows = benchmark.compare({'fast': 1.0, 'slow': 1.5, 'new': 2.0}, {'fast': 1.0, 'slow': 1.0}, threshold=0.25)
+    assert rows == [('fast', 1.0, 1.0, False), ('slow', 1.5, 1.0, True), ('new', 2.0, None, False)]
+    report = benchmark.format_report(rows)
+    assert 'REGRESSION' in report.splitlines()[2]
+    assert 'new' in report.splitlines()[3]
+
+
+def test_compare_ignores_slowdowns_under_the_noise_floor():
+    rows = benchmark.compare({'tiny': 2e-7, 'big': 2e-5}, {'tiny': 1e-7, 'big': 1e-5}, noise_floor=2e-6)
+    assert [r[-1] for r in rows] == [False, True]
+
+
+def test_confirm_regressions_keeps_the_faster_run(monkeypatch):
+    monkeypatch.setattr(benchmark, 'run_benchmarks', lambda names, repeat: {name: 1e-5 for name in names})
+    results = benchmark.confirm_regressions({'slow': 5e-5, 'ok': 1e-5}, {'slow': 1e-5, 'ok': 1e-5})
+    assert results == {'slow': 1e-5, 'ok': 1e-5}
+
+
+def test_baseline_round_trip(tmp_path):
+    path = str(tmp_path / 'baseline.json')
+    assert benchmark.load_baseline(path) == {}
+    benchmark.save_baseline({'a': 0.5}, path)
+    assert benchmark.load_baseline(path) == {'a': 0.5}
+
+
+def test_run_benchmarks_offline():
+    # Both run without the synthetic Azure environment
+    results = benchmark.run_benchmarks(['map_submitted_data', 'private_metadata_round_trip'], repeat=1, min_time=0)
+    assert set(results) == {'map_submitted_data', 'private_metadata_round_trip'}
+
+
+def test_scaled_catalog_has_distinct_services():
+    dataset = {'Compute': [{'id': 'vm', 'displayName': 'VM', 'resourceTypes': []}]}
+    catalog = benchmark.get_scaled_catalog(dataset, scale=3)
+    assert list(catalog) == ['Compute', 'Compute 1', 'Compute 2']
+    assert len({s['id'] for services in catalog.values() for s in services}) == 3
@@ -0,0 +1,111 @@
+import json
+
+import pytest
+from azure.core.pipeline.policies import SansIOHTTPPolicy
+
+import loadtest
+import metrics
+from azure_support import AzureSupportHelper, SubscriptionClient
+from cassettes import Cassette, CassetteMismatch, RecordingTransport, ReplayTransport, Sanitizer
+
+SUBSCRIPTION_ID = '12345678-aaaa-bbbb-cccc-1234567890ab'
+RESOURCE_TYPE = 'Microsoft.Compute/virtualMachines'
+SERVICE_ID = '722ccc66-c988-d2ac-1ec6-b7aebc857f2d'
+
+
+class AllowHttpPolicy(loadtest._AllowHttpPolicy, SansIOHTTPPolicy):
+    pass
+
+
+@pytest.fixture
+def azure_client_kwargs(monkeypatch):
+    monkeypatch.setitem(metrics.AZURE_CLIENT_KWARGS, 'per_call_policies',
+                        metrics.AZURE_CLIENT_KWARGS['per_call_policies'] + [AllowHttpPolicy()])
+    return metrics.AZURE_CLIENT_KWARGS
+
+
+def _list_tenant(credentials, subscription_id):
+    subscriptions = [s.subscription_id for s in SubscriptionClient(
+        credentials, **metrics.AZURE_CLIENT_KWARGS).subscriptions.list()]
+    resources = list(AzureSupportHelper.get_sub_resources_by_resource_type(credentials, subscription_id, RESOURCE_TYPE))
+    problem_classifications = [
+        p.display_name for p in AzureSupportHelper.get_problem_classifications_list(
+            credentials, subscription_id, SERVICE_ID)]
+    return subscriptions, resources, problem_classifications
+
+
+def test_sanitizer_replaces_account_ids_and_redacts_contacts():
+    sanitizer = Sanitizer()
+    url = sanitizer.sanitize_text(f'https://management.azure.com/subscriptions/{SUBSCRIPTION_ID.upper()}/resources')
+    assert url == 'https://management.azure.com/subscriptions/00000000-0000-0000-0000-000000000001/resources'
+    body = sanitizer.sanitize_body(json.dumps({
+        'id': f'/subscriptions/{SUBSCRIPTION_ID}/providers/Microsoft.Support/supportTickets/t1',
+        'properties': {'contactDetails': {'firstName': 'Ada', 'primaryEmailAddress': 'ada@example.com',
+                                          'preferredContactMethod': 'email'}},
+    }).encode())
+    assert body['id'] == '/subscriptions/00000000-0000-0000-0000-000000000001/providers/Microsoft.Support/supportTickets/t1'
+    assert body['properties']['contactDetails'] == {
+        'firstName': 'redacted', 'primaryEmailAddress': 'redacted', 'preferredContactMethod': 'email'}
+
+
+def test_record_then_replay_offline(tmp_path, azure_client_kwargs, monkeypatch):
+    path = str(tmp_path / 'tenant.jsonl')
+    fake_arm = loadtest.FakeArm(subscriptions=2, resources=30, resource_groups=4).start()
+    try:
+        monkeypatch.setitem(azure_client_kwargs, 'base_url', fake_arm.url)
+        monkeypatch.setitem(azure_client_kwargs, 'transport', RecordingTransport(Cassette.create(path)))
+        recorded = _list_tenant(loadtest._StaticCredential(), fake_arm.subscriptions[1])
+    finally:
+        fake_arm.stop()
+
+    cassette = Cassette.load(path)
+    assert len(cassette.interactions) == 3
+    assert all(i['duration'] > 0 for i in cassette.interactions)
+    assert set(cassette.get_latency_profile()) == {'GET subscriptions', 'GET resources', 'GET problemClassifications'}
+
+    # The recorded ids are replaced by placeholders, in order of appearance
+    subscriptions, resources, problem_classifications = recorded
+    placeholder = '00000000-0000-0000-0000-000000000002'
+    monkeypatch.setitem(azure_client_kwargs, 'base_url', 'https://management.azure.com')
+    monkeypatch.setitem(azure_client_kwargs, 'transport', ReplayTransport(cassette))
+    replayed = _list_tenant(loadtest._StaticCredential(), placeholder)
+    assert replayed[0] == ['00000000-0000-0000-0000-000000000001', placeholder]
+    assert [r['id'] for r in replayed[1]] == [r['id'].replace(subscriptions[1], placeholder) for r in resources]
+    assert replayed[2] == problem_classifications
+
+    with pytest.raises(CassetteMismatch):
+        list(AzureSupportHelper.get_sub_resources_by_resource_type(
+            loadtest._StaticCredential(), placeholder, 'Microsoft.Web/sites'))
+
+
+def test_replay_repeats_last_response_and_scales_time(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr('cassettes.time.sleep', sleeps.append)
+    cassette = Cassette([
+        {'method': 'GET', 'url': 'https://h/t?api-version=1', 'status': 200, 'headers': {}, 'body': {'n': 1},
+         'duration': 0.2},
+        {'method': 'GET', 'url': 'https://h/t?api-version=1', 'status': 200, 'headers': {}, 'body': {'n': 2},
+         'duration': 0.4},
+    ])
+    transport = ReplayTransport(cassette, time_scale=0.5)
+    from azure.core.rest import HttpRequest
+    bodies = [transport.send(HttpRequest('GET', 'https://h/t?api-version=2')).json()['n'] for _ in range(3)]
+    assert bodies == [1, 2, 2]
+    assert sleeps == [0.1, 0.2, 0.2]
+
+
+def test_replay_serves_legacy_pipeline_requests_and_errors():
+    from azure.core.exceptions import HttpResponseError
+    from azure.core.pipeline.transport import HttpRequest as PipelineHttpRequest
+    from azure.core.rest import HttpRequest
+    cassette = Cassette([
+        {'method': 'GET', 'url': 'https://h/a', 'status': 200, 'headers': {}, 'body': {'ok': True}, 'duration': 0},
+        {'method': 'GET', 'url': 'https://h/missing', 'status': 404, 'headers': {},
+         'body': {'error': {'code': 'NotFound'}}, 'duration': 0},
+    ])
+    transport = ReplayTransport(cassette)
+    assert json.loads(transport.send(PipelineHttpRequest('GET', 'https://h/a')).body()) == {'ok': True}
+    response = transport.send(HttpRequest('GET', 'https://h/missing'))
+    assert response.headers['Content-Type'] == 'application/json'
+    with pytest.raises(HttpResponseError):
+        response.raise_for_status()
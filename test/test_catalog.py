@@ -0,0 +1,93 @@
+import threading
+
+import pytest
+
+from catalog import LiveServiceCatalog, ServiceCatalog, map_services
+
+
+def _service(service_id, display_name, group_ids, resource_types=()):
+    return {
+        'id': f'/providers/Microsoft.Support/services/{service_id}',
+        'properties': {
+            'displayName': display_name,
+            'resourceTypes': list(resource_types),
+            'metadata': {'groupIds': group_ids},
+        },
+    }
+
+
+@pytest.fixture
+def catalog():
+    return ServiceCatalog({
+        'Compute': [{'id': 'vm', 'displayName': 'Virtual Machine', 'resourceTypes': ['Microsoft.Compute/vm']}],
+        'Storage': [{'id': 'blob', 'displayName': 'Blob Storage', 'resourceTypes': []}],
+    })
+
+
+def test_map_services_groups_and_skips_previews():
+    grouped = map_services([
+        _service('vm', 'Virtual Machine', 'ServiceGroupCompute,ServiceGroupAppServices'),
+        _service('new', 'New Thing - Preview', 'ServiceGroupCompute'),
+        _service('avd', 'Azure Virtual Desktop', 'ServiceGroupCompute'),
+    ])
+
+    assert list(grouped) == ['App Services', 'Compute']
+    assert [s['displayName'] for s in grouped['Compute']] == ['Azure Virtual Desktop', 'Virtual Machine']
+
+
+def test_filter_by_prefix_matches_groups_and_names(catalog):
+    assert catalog.filter_by_prefix('comp') == {'Compute': catalog.dataset['Compute']}
+    assert list(catalog.filter_by_prefix('BLOB')) == ['Storage']
+    assert catalog.filter_by_prefix('nothing') == {}
+
+
+def test_refresh_swaps_in_new_services(catalog):
+    live = LiveServiceCatalog(catalog)
+    services = [
+        _service('vm', 'Virtual Machine', 'ServiceGroupCompute', ['Microsoft.Compute/vm', 'Microsoft.Compute/vmss']),
+        _service('blob', 'Blob Storage', 'ServiceGroupStorage'),
+        _service('files', 'Azure Files', 'ServiceGroupStorage'),
+    ]
+
+    added, removed, changed = live.refresh(services)
+
+    assert (added, removed, changed) == (['files'], [], ['vm'])
+    assert live.current is not catalog
+    assert [s['id'] for s in live.current.filter_by_prefix('azure f')['Storage']] == ['files']
+    assert live.current.resource_types_by_service_id['vm'] == ['Microsoft.Compute/vm', 'Microsoft.Compute/vmss']
+    # The old catalog is left intact for requests still reading it
+    assert 'files' not in catalog.resource_types_by_service_id
+
+
+def test_refresh_keeps_catalog_when_unchanged_or_empty(catalog):
+    live = LiveServiceCatalog(catalog)
+
+    assert live.refresh([
+        _service('vm', 'Virtual Machine', 'ServiceGroupCompute', ['Microsoft.Compute/vm']),
+        _service('blob', 'Blob Storage', 'ServiceGroupStorage'),
+    ]) == ([], [], [])
+    assert live.current is catalog
+    with pytest.raises(ValueError):
+        live.refresh([])
+    assert live.current is catalog
+
+
+def test_refresh_thread_keeps_running_after_a_failed_fetch(catalog, monkeypatch):
+    live = LiveServiceCatalog(catalog)
+    monkeypatch.setattr(LiveServiceCatalog, 'RETRY_SECONDS', 0)
+    refreshed = threading.Event()
+    results = [RuntimeError('throttled'), [_service('files', 'Azure Files', 'ServiceGroupStorage')]]
+
+    def fetch():
+        result = results.pop(0) if results else None
+        if isinstance(result, Exception):
+            raise result
+        if result is None:
+            refreshed.set()
+            threading.Event().wait()
+        return result
+
+    live.start(fetch, interval=0)
+
+    assert refreshed.wait(5)
+    assert list(live.current.dataset) == ['Storage']
@@ -0,0 +1,87 @@
+from unittest.mock import MagicMock
+
+import pytest
+from cachetools import LRUCache, TTLCache
+
+import metrics
+from diagnostics import USAGE, Diagnostics
+from metrics import InstrumentedExecutor
+
+
+@pytest.fixture
+def services():
+    services = MagicMock()
+    services.azure_support.sub_list = [{'id': 's1'}, {'id': 's2'}]
+    services.azure_support.subscriptions_loaded_at = None
+    return services
+
+
+@pytest.fixture
+def diagnostics(services):
+    return Diagnostics(services, ['UADMIN'])
+
+
+def test_non_admins_are_refused(diagnostics, services):
+    assert 'only available' in diagnostics.handle('UOTHER', ['invalidate', 'all'])
+    services.azure_support.refresh_subscription_list.assert_not_called()
+
+
+def test_report_covers_caches_preloader_executors_and_calls(diagnostics, monkeypatch):
+    cache = TTLCache(maxsize=10, ttl=60)
+    cache['a'] = 1
+    monkeypatch.setitem(metrics._caches, 'diag_test_cache', cache)
+    monkeypatch.setitem(metrics._cache_reset_times, 'diag_test_cache', 0)
+    metrics.CACHE_REQUESTS.inc('diag_test_cache', 'hit', amount=3)
+    metrics.CACHE_REQUESTS.inc('diag_test_cache', 'miss')
+    monkeypatch.setitem(metrics._executors, 'diag_test', InstrumentedExecutor(max_workers=3))
+    metrics.AZURE_CALLS.inc('GET resources', '200', amount=5)
+
+    report = diagnostics.handle('UADMIN', [])
+    cache_line = next(line for line in report.splitlines() if line.startswith('diag_test_cache'))
+    assert cache_line.split()[:4] == ['diag_test_cache', '1', '1/10', '75%']
+    assert '2 subscriptions, not loaded yet' in report
+    assert any(line.split() == ['diag_test', '0', '0', '3'] for line in report.splitlines())
+    assert 'Azure: ' in report
+
+
+def test_fill_of_memory_bounded_caches_is_in_bytes(diagnostics, monkeypatch):
+    cache = LRUCache(maxsize=2 * 1024 * 1024, getsizeof=len)
+    cache['a'] = 'x' * 2048
+    monkeypatch.setitem(metrics._caches, 'diag_test_bytes', cache)
+    line = next(line for line in diagnostics.get_cache_report().splitlines() if line.startswith('diag_test_bytes'))
+    assert '2KiB/2MiB' in line
+
+
+def test_invalidate(diagnostics, monkeypatch):
+    cache = TTLCache(maxsize=10, ttl=60)
+    cache['a'] = 1
+    monkeypatch.setitem(metrics._caches, 'diag_test_cache', cache)
+    assert diagnostics.handle('UADMIN', ['invalidate', 'diag_test_cache']) == 'Invalidated diag_test_cache.'
+    assert len(cache) == 0
+    assert metrics.get_cache_reset_time('diag_test_cache') > 0
+    assert diagnostics.handle('UADMIN', ['invalidate', 'nope']).startswith('Unknown cache `nope`')
+
+
+def test_warm(diagnostics, services):
+    services.options_handler.prefetch.return_value = [object(), object()]
+    assert diagnostics.handle('UADMIN', ['warm', 'subscriptions']) == 'Reloaded 2 subscriptions.'
+    services.azure_support.refresh_subscription_list.assert_called_once()
+    assert 'Loading 2 resource type(s)' in diagnostics.handle('UADMIN', ['warm', 'resources', 'sub1', 'svc1'])
+    services.options_handler.prefetch.assert_called_once_with('sub1', 'svc1')
+    assert diagnostics.handle('UADMIN', ['warm', 'nothing']) == USAGE
+
+
+def test_memory_report_starts_tracing_then_lists_top_consumers(diagnostics, monkeypatch):
+    import tracemalloc
+    was_tracing = tracemalloc.is_tracing()
+    try:
+        if not was_tracing:
+            assert diagnostics.handle('UADMIN', ['memory']).startswith('Started memory tracing')
+        data = [bytearray(1024) for _ in range(100)]
+        report = diagnostics.handle('UADMIN', ['memory'])
+        assert report.startswith('*Memory* traced')
+        assert 'test_diagnostics.py' in report
+        del data
+    finally:
+        if not was_tracing:
+            tracemalloc.stop()
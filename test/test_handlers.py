@@ -1,6 +1,9 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
 import pytest
 from unittest.mock import MagicMock, patch
-from handlers import OptionsHandler, SupportTicketSubmissionHandler
+from handlers import LOADING_VALUE, OptionsHandler, SupportTicketSubmissionHandler
 
 
 @pytest.fixture
@@ -13,9 +16,9 @@ def mock_azure_support():
         'Group1': [{'id': 'svc1', 'displayName': 'Service 1'}]
     }
     mock.get_resource_types_by_service_id.return_value = ['type1']
-    mock.get_sub_resources_by_resource_type_concurrent.return_value = {
-        'rg1': [{'id': 'rid1', 'name': 'Resource 1'}]
-    }
+    mock.get_sub_resources_by_resource_type.return_value = [
+        {'id': '/subscriptions/sub1/resourceGroups/rg1/providers/type1/rid1', 'name': 'Resource 1'}
+    ]
     mock.get_problem_classifications_list.return_value = [
         MagicMock(id='id1', display_name='Group / Problem')
     ]
@@ -42,9 +45,77 @@ def test_get_select_azure_subscription_resources_mapped(options_handler):
     private_metadata = {'select_azure_subscription': 'sub1', 'select_azure_service': 'svc1'}
     result = options_handler.get_select_azure_subscription_resources_mapped(private_metadata)
     assert isinstance(result, list)
+    assert result[0]["label"]["text"] == "rg1"
     assert result[-1]["label"]["text"].startswith("General question")
 
 
+def test_resources_answer_at_deadline_with_fetched_types(mock_azure_support):
+    release = threading.Event()
+
+    def get_resources(credentials, subscription_id, resource_type):
+        if resource_type == 'slow':
+            release.wait(5)
+        return [{'id': f'/subscriptions/sub1/resourceGroups/rg-{resource_type}/providers/x/r', 'name': resource_type}]
+
+    mock_azure_support.get_resource_types_by_service_id.return_value = ['fast', 'slow']
+    mock_azure_support.get_sub_resources_by_resource_type.side_effect = get_resources
+    handler = OptionsHandler(MagicMock(), mock_azure_support, deadline_seconds=0.2)
+    private_metadata = {'select_azure_subscription': 'sub1', 'select_azure_service': 'svc1'}
+
+    result = handler.get_select_azure_subscription_resources_mapped(private_metadata)
+    labels = [group["label"]["text"] for group in result]
+    assert 'rg-fast' in labels and 'rg-slow' not in labels
+    assert result[-1]["options"][0]["value"] == LOADING_VALUE
+
+    # The slow type keeps loading in the background and is served afterwards
+    release.set()
+    for _ in range(50):
+        if ('resources', 'sub1', 'slow') in handler.snapshots:
+            break
+        threading.Event().wait(0.01)
+    mock_azure_support.get_sub_resources_by_resource_type.side_effect = RuntimeError('ARM error')
+    grouped, status = handler.get_select_azure_subscription_resources('sub1', 'svc1', timeout=1)
+    assert status == 'stale'
+    assert set(grouped) == {'rg-fast', 'rg-slow'}
+
+
+def test_problem_classifications_placeholder_until_loaded(mock_azure_support):
+    release = threading.Event()
+    problem_classifications = mock_azure_support.get_problem_classifications_list.return_value
+
+    def get_problem_classifications(*args):
+        release.wait(5)
+        return problem_classifications
+
+    mock_azure_support.get_problem_classifications_list.side_effect = get_problem_classifications
+    handler = OptionsHandler(MagicMock(), mock_azure_support, deadline_seconds=0.1)
+    private_metadata = {'select_azure_subscription': 'subid', 'select_azure_service': 'svc1'}
+
+    res = handler.get_select_azure_service_problem_classifications(private_metadata)
+    assert res['type'] == 'options'
+    assert res['values'][0]['value'] == LOADING_VALUE
+
+    release.set()
+    res = handler.get_select_azure_service_problem_classifications(private_metadata)
+    assert res['type'] == 'option_groups'
+    assert mock_azure_support.get_problem_classifications_list.call_count == 1
+
+
+def test_failed_resource_type_is_left_out(mock_azure_support):
+    def get_resources(credentials, subscription_id, resource_type):
+        if resource_type == 'broken':
+            raise RuntimeError('ARM error')
+        return [{'id': '/subscriptions/sub1/resourceGroups/rg1/providers/x/r', 'name': 'r'}]
+
+    mock_azure_support.get_resource_types_by_service_id.return_value = ['ok', 'broken']
+    mock_azure_support.get_sub_resources_by_resource_type.side_effect = get_resources
+    handler = OptionsHandler(MagicMock(), mock_azure_support)
+
+    grouped, status = handler.get_select_azure_subscription_resources('sub1', 'svc1', timeout=1)
+    assert status == 'complete'
+    assert list(grouped) == ['rg1']
+
+
 def test_get_problem_classifications_options_option_groups(options_handler, mock_azure_support):
     res = options_handler.get_problem_classifications_options('subid', 'svc1')
     assert res["type"] == "option_groups"
@@ -68,3 +139,55 @@ def test_support_ticket_submission_handler_handle():
     handler = SupportTicketSubmissionHandler(data, private_metadata, mock_azure_support, mock_client, mock_executor)
     handler.handle()
     mock_executor.submit.assert_called()
+
+
+def test_support_ticket_submission_handler_uses_draft():
+    mock_azure_support = MagicMock()
+    mock_drafts = MagicMock()
+    mock_drafts.build_ticket.return_value = ('sub1', 'svc1', 'details')
+    mock_azure_support.create_support_ticket.return_value = {'success': False}
+    mock_client = MagicMock()
+    data = {'select_azure_subscription': 'sub1', 'select_azure_service': 'svc1', 'select_azure_resource': 'hash'}
+    handler = SupportTicketSubmissionHandler(
+        data, {'user_id': 'U1'}, mock_azure_support, mock_client, ThreadPoolExecutor(max_workers=1),
+        ticket_drafts=mock_drafts, view_id='V1')
+    handler.handle()
+    handler.executor.shutdown(wait=True)
+
+    mock_drafts.build_ticket.assert_called_once_with('V1', data)
+    mock_azure_support.get_resource_id_by_resource_hash.assert_not_called()
+    mock_azure_support.create_support_ticket.assert_called_once_with('sub1', 'svc1', 'details')
+    mock_client.chat_postMessage.assert_called_once()
+
+
+def test_support_ticket_submission_handler_fans_out_additional_targets():
+    mock_fanout = MagicMock()
+    mock_client = MagicMock()
+    data = {'select_azure_subscription': 'sub1', 'select_azure_service': 'svc1', 'select_azure_resource': 'hash',
+            'select_additional_azure_subscriptions': ['sub2'], 'channel_select_block': 'C1'}
+    handler = SupportTicketSubmissionHandler(
+        data, {'user_id': 'U1'}, MagicMock(), mock_client, ThreadPoolExecutor(max_workers=1),
+        view_id='V1', ticket_fanout=mock_fanout)
+    handler.handle()
+    handler.executor.shutdown(wait=True)
+
+    args, kwargs = mock_fanout.file_tickets.call_args
+    assert [t.subscription_id for t in args[1]] == ['sub1', 'sub2']
+    assert args[2:4] == ('C1', 'U1') and args[5] == 'V1' and kwargs['mention']
+    mock_client.chat_postMessage.assert_not_called()
+
+
+def test_support_ticket_submission_handler_indexes_filed_ticket():
+    mock_azure_support = MagicMock()
+    mock_azure_support.create_support_ticket.return_value = {
+        'success': True, 'url': 'https://portal/t1', 'ticket_name': 't1', 'subscription_id': 'sub1'}
+    mock_index = MagicMock()
+    data = {'subject': 'VM down', 'problem_details': 'Since noon', 'select_azure_subscription': 'sub1',
+            'select_azure_service': 'svc1', 'select_azure_service_text': 'Virtual Machines',
+            'select_azure_resource_text': 'vm1'}
+    handler = SupportTicketSubmissionHandler(
+        data, {'user_id': 'U1'}, mock_azure_support, MagicMock(), MagicMock(), ticket_index=mock_index)
+    handler._submit_support_ticket(data, {'user_id': 'U1'}, ('sub1', 'svc1', 'details'))
+
+    mock_index.add_ticket.assert_called_once_with(
+        't1', 'VM down', 'Since noon', 'svc1', 'Virtual Machines', None, 'vm1', 'https://portal/t1')
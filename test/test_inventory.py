@@ -0,0 +1,62 @@
+import sys
+from types import SimpleNamespace
+
+from cachetools import LRUCache
+
+from azure_support import AzureSupportHelper
+from inventory import ResourceInventory, get_cached_size
+
+SUB = '/subscriptions/00000000-0000-0000-0000-000000000000/resourceGroups/'
+
+
+def _resources(count, groups=3):
+    return [
+        SimpleNamespace(
+            id=f'{SUB}rg-{i % groups}/providers/Microsoft.Compute/virtualMachines/vm-{i}',
+            name=f'vm-{i}')
+        for i in range(count)
+    ]
+
+
+def test_inventory_round_trips_ids_and_names():
+    resources = _resources(10)
+    resources.append(SimpleNamespace(
+        id=f'{SUB}rg-x/providers/Microsoft.Sql/servers/db1/databases/main', name='db1/main'))
+    resources.append(SimpleNamespace(id='/subscriptions/s/providers/Microsoft.Web/x', name='x'))
+    inventory = ResourceInventory.from_resources(iter(resources))
+
+    assert len(inventory) == 11
+    assert [r['id'] for r in inventory] == [r.id for r in resources[:11]]
+    assert [r['name'] for r in inventory] == [r.name for r in resources[:11]]
+    assert list(inventory)[-1]['resource_group'] == 'rg-x'
+    assert inventory.groups == ['rg-0', 'rg-1', 'rg-2', 'rg-x']
+
+
+def test_inventory_is_smaller_than_dicts():
+    resources = _resources(2000)
+    inventory = ResourceInventory.from_resources(resources)
+    as_dicts = [{'id': r.id, 'name': r.name} for r in resources]
+    dict_bytes = sum(sys.getsizeof(d) + sys.getsizeof(d['id']) + sys.getsizeof(d['name']) for d in as_dicts)
+
+    assert inventory.nbytes < dict_bytes / 3
+    assert get_cached_size(inventory) == inventory.nbytes
+
+
+def test_group_by_resource_group_accepts_inventories():
+    inventory = ResourceInventory.from_resources(_resources(6))
+    grouped = AzureSupportHelper.group_by_resource_group(inventory)
+
+    assert sorted(grouped) == ['rg-0', 'rg-1', 'rg-2']
+    assert grouped['rg-1'][0] == {'id': f'{SUB}rg-1/providers/Microsoft.Compute/virtualMachines/vm-1', 'name': 'vm-1'}
+
+
+def test_memory_bounded_cache_evicts_by_size():
+    small = ResourceInventory.from_resources(_resources(10))
+    large = ResourceInventory.from_resources(_resources(1000))
+    cache = LRUCache(maxsize=large.nbytes + small.nbytes, getsizeof=get_cached_size)
+    cache['small'] = small
+    cache['large'] = large
+    cache['other'] = ResourceInventory.from_resources(_resources(20))
+
+    assert 'small' not in cache
+    assert cache.currsize <= cache.maxsize
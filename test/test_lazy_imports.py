@@ -0,0 +1,18 @@
+import json
+from lazy_imports import LazyImport, lazy_import, resolve_lazy_imports
+
+
+def test_lazy_import_resolves_on_call_and_attribute():
+    dumps = LazyImport('json', 'dumps')
+    assert dumps._target is None
+    assert dumps({'a': 1}) == '{"a": 1}'
+    assert dumps.resolve() is json.dumps
+
+    decoder = LazyImport('json', 'JSONDecoder')
+    assert decoder.__name__ == 'JSONDecoder'
+
+
+def test_resolve_lazy_imports_imports_registered():
+    loads = lazy_import('json', 'loads')
+    resolve_lazy_imports()
+    assert loads._target is json.loads
@@ -0,0 +1,29 @@
+import os
+import threading
+
+from leader import LeaderElection, SharedSnapshot
+
+
+def test_one_process_is_elected_until_it_exits(tmp_path):
+    path = str(tmp_path / 'leader.lock')
+    first, second = LeaderElection(path), LeaderElection(path)
+    elected = threading.Event()
+
+    first.start(lambda: None)
+    assert first.is_leader.wait(5)
+    second.start(elected.set)
+    assert not elected.wait(0.2)
+
+    # Closing the lock file is what the exit of the first process does
+    os.close(first._fd)
+    assert elected.wait(5) and second.is_leader.is_set()
+
+
+def test_snapshot_is_read_once_per_change(tmp_path):
+    path = str(tmp_path / 'subscriptions.json')
+    writer, reader = SharedSnapshot(path), SharedSnapshot(path)
+    assert reader.read_if_changed() is None
+
+    writer.publish([{'id': 'sub1'}])
+    assert reader.read_if_changed() == [{'id': 'sub1'}]
+    assert reader.read_if_changed() is None
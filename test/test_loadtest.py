@@ -0,0 +1,104 @@
+import hashlib
+import hmac
+import json
+import urllib.error
+import urllib.request
+
+import pytest
+
+import loadtest
+
+
+def _request(url, method='GET', data=None, headers=None):
+    request = urllib.request.Request(url, data=data, method=method, headers=headers or {})
+    try:
+        with urllib.request.urlopen(request, timeout=5) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read())
+
+
+@pytest.fixture
+def fake_slack():
+    server = loadtest.FakeSlack().start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def fake_arm():
+    server = loadtest.FakeArm(resources=5, resource_groups=2).start()
+    yield server
+    server.stop()
+
+
+def test_sign_request_matches_slack_scheme():
+    headers = loadtest.sign_request('payload=x', timestamp=1700000000, secret='secret')
+    expected = hmac.new(b'secret', b'v0:1700000000:payload=x', hashlib.sha256).hexdigest()
+    assert headers == {'X-Slack-Request-Timestamp': '1700000000', 'X-Slack-Signature': f'v0={expected}'}
+
+
+def test_percentile():
+    values = [i / 100 for i in range(1, 101)]
+    assert loadtest.percentile(values, 50) == 0.5
+    assert loadtest.percentile(values, 99) == 0.99
+    assert loadtest.percentile(values, 100) == 1.0
+    assert loadtest.percentile([], 50) == 0.0
+
+
+def test_fake_slack_keeps_views(fake_slack):
+    headers = {'Content-Type': 'application/json'}
+    _, opened = _request(f'{fake_slack.url}/views.open', 'POST',
+                         json.dumps({'trigger_id': 't1', 'view': {'type': 'modal', 'blocks': []}}).encode(), headers)
+    view = fake_slack.wait_for_view(trigger_id='t1', timeout=1)
+    assert view['id'] == opened['view']['id']
+
+    _, conflict = _request(f'{fake_slack.url}/views.update', 'POST', json.dumps(
+        {'view_id': view['id'], 'hash': 'stale', 'view': {'type': 'modal', 'blocks': [{}]}}).encode(), headers)
+    assert conflict == {'ok': False, 'error': 'hash_conflict'}
+    _request(f'{fake_slack.url}/views.update', 'POST', json.dumps(
+        {'view_id': view['id'], 'hash': view['hash'], 'view': {'type': 'modal', 'blocks': [{}]}}).encode(), headers)
+    updated = fake_slack.wait_for_view(view_id=view['id'], after_hash=view['hash'], timeout=1)
+    assert updated['blocks'] == [{}]
+    assert fake_slack.calls == {'views.open': 1, 'views.update': 2}
+
+
+def test_fake_arm_serves_tenant(fake_arm):
+    status, body = _request(f'{fake_arm.url}/subscriptions/s1/resources?%24filter=resourceType+eq+%27a%2Fb%27')
+    assert status == 200
+    assert len(body['value']) == 5
+    assert body['value'][1]['id'] == '/subscriptions/s1/resourceGroups/rg-1/providers/a/b/res-1'
+    status, _ = _request(f'{fake_arm.url}/unknown')
+    assert status == 404
+    assert fake_arm.calls == {'GET resources': 1, 'GET other': 1}
+
+
+def test_stub_server_injects_rate_limits():
+    server = loadtest.FakeArm(rate_limit_ratio=1.0, retry_after=7).start()
+    try:
+        request = urllib.request.Request(f'{server.url}/subscriptions')
+        with pytest.raises(urllib.error.HTTPError) as e:
+            urllib.request.urlopen(request, timeout=5)
+        assert e.value.code == 429
+        assert e.value.headers['Retry-After'] == '7'
+        assert server.rate_limited == {'GET subscriptions': 1}
+    finally:
+        server.stop()
+
+
+def test_format_report(fake_slack, fake_arm):
+    stats = loadtest.LoadStats()
+    stats.record('shortcut', 0.010)
+    stats.record('view_submission', 0.020, error='HTTP 500')
+    stats.record_session(True)
+    stats.record_session(False)
+    report = loadtest.format_report(stats, fake_slack, fake_arm, 1.0)
+    assert 'Sessions: 2 (1 failed)' in report
+    assert 'Requests: 2, errors: 1 (50.0%)' in report
+    assert 'view_submission HTTP 500: 1' in report
+    assert 'Azure calls: 0 (0.0 per session, 0 answered 429)' in report
+
+
+def test_stub_server_needs_the_api_it_stands_in_for():
+    with pytest.raises(TypeError):
+        loadtest.StubServer()
@@ -0,0 +1,148 @@
+import os
+from unittest.mock import MagicMock, patch
+from metrics import (
+    MetricsRegistry, MultiProcessMetrics, InstrumentedTTLCache, InstrumentedWebClient, ListenerExecutor, TimedAck, AzureCallMetricsPolicy,
+    ACK_LATENCY, AZURE_CALLS, CACHE_EVICTIONS, CACHE_REQUESTS, HANDLER_LATENCY, SLACK_CALLS,
+    bolt_metrics_middleware, get_azure_operation
+)
+from tracing import bolt_tracing_middleware, get_current_request
+
+
+def test_registry_renders_counter_and_histogram():
+    registry = MetricsRegistry()
+    counter = registry.counter('calls_total', 'Calls', ('method',))
+    histogram = registry.histogram('latency_seconds', 'Latency', ('method',), buckets=(0.1, 1.0))
+    counter.inc('a')
+    counter.inc('a')
+    histogram.observe(0.5, 'a')
+    registry.gauge('depth', 'Depth', lambda: 3)
+
+    text = registry.render()
+    assert 'calls_total{method="a"} 2' in text
+    assert 'latency_seconds_bucket{method="a",le="0.1"} 0' in text
+    assert 'latency_seconds_bucket{method="a",le="1.0"} 1' in text
+    assert 'latency_seconds_bucket{method="a",le="+Inf"} 1' in text
+    assert 'latency_seconds_count{method="a"} 1' in text
+    assert 'depth 3' in text
+
+
+def test_multiprocess_metrics_render_every_worker_once_per_family(tmp_path):
+    registry = MetricsRegistry()
+    registry.counter('calls_total', 'Calls', ('method',)).inc('a')
+    # Last write of another worker, pid 1
+    other = MetricsRegistry()
+    other.counter('calls_total', 'Calls', ('method',)).inc('a', amount=5)
+    other_worker = MultiProcessMetrics(str(tmp_path), other)
+    other_worker.path = str(tmp_path / 'metrics-1.json')
+    other_worker.write()
+
+    text = MultiProcessMetrics(str(tmp_path), registry).render()
+
+    assert text.count('# TYPE calls_total counter') == 1
+    assert 'calls_total{worker="1",method="a"} 5' in text
+    assert f'calls_total{{worker="{os.getpid()}",method="a"}} 1' in text
+
+    # A worker that stopped writing is left out
+    os.utime(other_worker.path, (0, 0))
+    assert 'worker="1"' not in MultiProcessMetrics(str(tmp_path), registry).render()
+
+
+def test_instrumented_ttl_cache_counts_hits_misses_evictions():
+    cache = InstrumentedTTLCache('test_cache', maxsize=1, ttl=60)
+    hits = CACHE_REQUESTS.get('test_cache', 'hit')
+    misses = CACHE_REQUESTS.get('test_cache', 'miss')
+    evictions = CACHE_EVICTIONS.get('test_cache', 'size')
+
+    cache['a'] = 1
+    assert cache['a'] == 1
+    cache['b'] = 2
+    assert cache.get('a') is None
+
+    assert CACHE_REQUESTS.get('test_cache', 'hit') == hits + 1
+    assert CACHE_REQUESTS.get('test_cache', 'miss') >= misses
+    assert CACHE_EVICTIONS.get('test_cache', 'size') == evictions + 1
+
+
+def test_bolt_metrics_middleware_times_ack_once():
+    context = {}
+    body = {'type': 'block_suggestion', 'action_id': 'mw_test'}
+
+    def next():
+        context['ack']()
+        context['ack']()
+
+    bolt_metrics_middleware(context, body, next)
+    assert isinstance(context['ack'], TimedAck)
+    assert ACK_LATENCY.get_count('options', 'mw_test') == 1
+
+
+def test_get_azure_operation():
+    assert get_azure_operation('GET', 'https://m.azure.com/subscriptions?api-version=1') == 'GET subscriptions'
+    assert get_azure_operation('GET', 'https://m.azure.com/subscriptions/s1/resources') == 'GET resources'
+    assert get_azure_operation(
+        'PUT', 'https://m.azure.com/subscriptions/s1/providers/Microsoft.Support/supportTickets/t1'
+    ) == 'PUT supportTickets'
+
+
+def test_azure_call_metrics_policy_records_status():
+    request = MagicMock()
+    request.context = {}
+    request.http_request.method = 'GET'
+    request.http_request.url = 'https://m.azure.com/providers/Microsoft.Support/services/s1/problemClassifications'
+    response = MagicMock()
+    response.http_response.status_code = 200
+    before = AZURE_CALLS.get('GET problemClassifications', '200')
+
+    policy = AzureCallMetricsPolicy()
+    policy.on_request(request)
+    policy.on_response(request, response)
+
+    assert AZURE_CALLS.get('GET problemClassifications', '200') == before + 1
+
+
+@patch('slack_sdk.WebClient.api_call', side_effect=RuntimeError('boom'))
+def test_instrumented_web_client_counts_errors(mock_api_call):
+    before = SLACK_CALLS.get('users.info', 'error')
+    try:
+        InstrumentedWebClient('xoxb-test').api_call('users.info')
+    except RuntimeError:
+        pass
+    assert SLACK_CALLS.get('users.info', 'error') == before + 1
+
+
+def test_listener_executor_times_listener_in_request_context():
+    body = {'type': 'block_suggestion', 'action_id': 'listener_test'}
+    bolt_tracing_middleware(body, lambda: None)
+    with ListenerExecutor(max_workers=1) as executor:
+        assert executor.submit(get_current_request).result() == ('options', 'listener_test')
+    assert HANDLER_LATENCY.get_count('options', 'listener_test') == 1
+
+
+def test_shared_executor_is_created_once_and_registered():
+    from metrics import get_executors, get_shared_executor
+    executor = get_shared_executor(None, 'shared_test', 2)
+    try:
+        assert get_executors()['shared_test'] is executor
+        assert get_shared_executor(executor, 'shared_test', 2) is executor
+    finally:
+        executor.shutdown()
+
+
+def test_instrumented_executor_counts_queued_and_running_work():
+    import threading
+    from metrics import InstrumentedExecutor
+    release = threading.Event()
+    with InstrumentedExecutor(max_workers=1) as executor:
+        running = executor.submit(release.wait, 5)
+        queued = executor.submit(release.wait, 5)
+        cancelled = executor.submit(release.wait, 5)
+        assert cancelled.cancel()
+        for _ in range(100):
+            if executor.running:
+                break
+            release.wait(0.01)
+        assert (executor.queued, executor.running, executor.max_workers) == (1, 1, 1)
+        release.set()
+        running.result()
+        queued.result()
+    assert (executor.queued, executor.running) == (0, 0)
@@ -0,0 +1,82 @@
+import threading
+import time
+from unittest.mock import MagicMock
+from handlers import LOADING_VALUE
+from options_throttle import OptionsThrottle
+
+
+def make_body(value='', user='U1', team='T1'):
+    return {'type': 'block_suggestion', 'action_id': 'select_azure_service', 'value': value,
+            'user': {'id': user}, 'team': {'id': team}, 'view': {'private_metadata': '{}'}}
+
+
+def make_listener(calls):
+    def listener(ack, body):
+        calls.append(body['value'])
+        ack(options=[{'value': body['value']}])
+    return listener
+
+
+def test_request_after_a_pause_is_not_held():
+    throttle = OptionsThrottle(debounce_seconds=1)
+    calls = []
+    listener = throttle.wrap(make_listener(calls))
+
+    start = time.monotonic()
+    listener(ack=MagicMock(), body=make_body('v'))
+
+    assert calls == ['v']
+    assert time.monotonic() - start < 0.5
+
+
+def test_newer_request_supersedes_pending_one():
+    throttle = OptionsThrottle(debounce_seconds=0.2)
+    calls = []
+    listener = throttle.wrap(make_listener(calls))
+    listener(ack=MagicMock(), body=make_body('v'))
+    held_ack = MagicMock()
+
+    held = threading.Thread(target=listener, kwargs={'ack': held_ack, 'body': make_body('vm')})
+    held.start()
+    time.sleep(0.05)
+    listener(ack=MagicMock(), body=make_body('vmx'))
+    held.join(1)
+
+    assert calls == ['v', 'vmx']
+    # Nothing was found for 'vm' yet
+    held_ack.assert_called_once_with(options=[])
+
+
+def test_over_budget_request_gets_last_result_for_its_value():
+    throttle = OptionsThrottle(debounce_seconds=0, user_rate=(1, 1))
+    calls = []
+    listener = throttle.wrap(make_listener(calls))
+    listener(ack=MagicMock(), body=make_body('v'))
+
+    ack = MagicMock()
+    listener(ack=ack, body=make_body('v'))
+    other_ack = MagicMock()
+    listener(ack=other_ack, body=make_body('vm'))
+
+    assert calls == ['v']
+    ack.assert_called_once_with(options=[{'value': 'v'}])
+    other_ack.assert_called_once_with(options=[])
+
+
+def test_placeholder_result_is_not_repeated():
+    throttle = OptionsThrottle(debounce_seconds=0, user_rate=(1, 1))
+
+    def loading(ack, body):
+        ack(option_groups=[{'options': [{'value': LOADING_VALUE}]}])
+    throttle.wrap(loading)(ack=MagicMock(), body=make_body('v'))
+
+    ack = MagicMock()
+    throttle.wrap(loading)(ack=ack, body=make_body('v'))
+    ack.assert_called_once_with(options=[])
+
+
+def test_workspace_budget_is_shared_by_users():
+    throttle = OptionsThrottle(debounce_seconds=0, workspace_rate=(1, 1))
+    assert throttle.admit(make_body(user='U1')) == 'admitted'
+    assert throttle.admit(make_body(user='U2')) == 'workspace_throttled'
+    assert throttle.admit(make_body(user='U3', team='T2')) == 'admitted'
@@ -0,0 +1,105 @@
+import threading
+import time
+from unittest.mock import MagicMock
+
+import pytest
+
+from prefetch import PredictivePrefetcher, PrefetchHistoryStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    return PrefetchHistoryStore(str(tmp_path / 'prefetch.db'))
+
+
+@pytest.fixture
+def options_handler():
+    mock = MagicMock()
+    mock.azure_support.get_resource_types_by_service_id.return_value = ['type1', 'type2']
+    mock.prefetch.return_value = []
+    return mock
+
+
+def test_likely_combinations_rank_by_uses_and_recency(store, options_handler):
+    now = time.time()
+    store.record('U1', 'sub1', 'svc1', now - 90 * 86400)
+    store.record('U1', 'sub1', 'svc1', now - 90 * 86400)
+    store.record('U1', 'sub1', 'svc1', now - 90 * 86400)
+    store.record('U1', 'sub2', 'svc2', now)
+    store.record('U1', 'sub2', 'svc3', now - 86400)
+    store.record('U2', 'sub9', 'svc9', now)
+    prefetcher = PredictivePrefetcher(store, options_handler, top_combinations=2)
+
+    assert prefetcher.get_likely_combinations('U1', now) == [('sub2', 'svc2'), ('sub2', 'svc3')]
+    assert prefetcher.get_likely_combinations('U3', now) == []
+
+
+def test_prefetch_for_user_warms_within_budget(store, options_handler):
+    store.record('U1', 'sub1', 'svc1', time.time())
+    store.record('U1', 'sub2', 'svc2', time.time())
+    # Each combination costs three lookups, the budget covers one
+    prefetcher = PredictivePrefetcher(store, options_handler, user_budget=(1, 4))
+    prefetcher.prefetch_for_user('U1')
+    prefetcher.pending['U1'][0][1].result(5)
+    prefetcher.executor.shutdown(wait=True)
+
+    options_handler.prefetch.assert_called_once()
+
+
+def test_combination_over_the_burst_is_warmed_in_part(store, options_handler):
+    store.record('U1', 'sub1', 'svc1', time.time())
+    options_handler.azure_support.get_resource_types_by_service_id.return_value = ['t1', 't2', 't3', 't4']
+    prefetcher = PredictivePrefetcher(store, options_handler, user_budget=(1, 3))
+    prefetcher.prefetch_for_user('U1')
+    prefetcher.pending['U1'][0][1].result(5)
+    prefetcher.executor.shutdown(wait=True)
+
+    options_handler.prefetch.assert_called_once_with('sub1', 'svc1', ['t1', 't2'])
+
+
+def test_history_is_read_off_the_listener_thread(store, options_handler):
+    store.record('U1', 'sub1', 'svc1', time.time())
+    store.record('U1', 'sub2', 'svc2', time.time() - 60)
+    release = threading.Event()
+    options_handler.prefetch.side_effect = lambda *args: release.wait(5) and []
+    prefetcher = PredictivePrefetcher(store, options_handler, workers=1)
+    # Keep the only worker busy, the history is read once it is free
+    blocker = prefetcher.executor.submit(release.wait, 5)
+    prefetcher.prefetch_for_user('U1')
+    plan = prefetcher.pending['U1'][0][1]
+    assert not plan.done()
+
+    # A pick made meanwhile limits the warm-ups to it
+    prefetcher.cancel('U1', 'sub2')
+    release.set()
+    blocker.result(5)
+    plan.result(5)
+    prefetcher.executor.shutdown(wait=True)
+
+    assert [c.args[:2] for c in options_handler.prefetch.call_args_list] == [('sub2', 'svc2')]
+
+
+def test_cancel_drops_queued_warm_ups_for_other_picks(store, options_handler):
+    store.record('U1', 'sub1', 'svc1', time.time())
+    store.record('U1', 'sub2', 'svc2', time.time() - 60)
+    store.record('U1', 'sub3', 'svc3', time.time() - 120)
+    release = threading.Event()
+    options_handler.prefetch.side_effect = lambda *args: release.wait(5) and []
+    prefetcher = PredictivePrefetcher(store, options_handler, workers=1)
+    prefetcher.prefetch_for_user('U1')
+    plan = prefetcher.pending['U1'][0][1]
+
+    prefetcher.cancel('U1', 'sub3')
+    release.set()
+    plan.result(5)
+    prefetcher.executor.shutdown(wait=True)
+
+    warmed = [c.args[:2] for c in options_handler.prefetch.call_args_list]
+    assert ('sub3', 'svc3') in warmed
+    assert ('sub2', 'svc2') not in warmed
+
+
+def test_record_ignores_incomplete_picks(store, options_handler):
+    prefetcher = PredictivePrefetcher(store, options_handler)
+    prefetcher.record('U1', 'sub1', None)
+    assert store.get_selections('U1') == []
@@ -0,0 +1,47 @@
+import json
+import random
+
+import pytest
+
+import serialization
+from serialization import decode_private_metadata, encode_private_metadata
+
+
+def test_private_metadata_uses_short_keys():
+    data = {'user_id': 'U1', 'select_azure_service_problem_classifications': 'pc1', 'custom': [1, 2]}
+
+    encoded = encode_private_metadata(data)
+
+    assert encoded.startswith('1.')
+    assert 'select_azure' not in encoded
+    assert decode_private_metadata(encoded) == data
+
+
+def test_private_metadata_keeps_keys_colliding_with_short_ones():
+    data = {'u': 'short', 'user_id': 'U1', '_private': True}
+    assert decode_private_metadata(encode_private_metadata(data)) == data
+
+
+def test_large_private_metadata_is_compressed():
+    data = {f'select_resource_{i}': 'a' * 64 for i in range(40)}
+    assert len(json.dumps(data)) > serialization.PRIVATE_METADATA_MAX_CHARS
+
+    encoded = encode_private_metadata(data)
+
+    assert encoded.startswith('1z.')
+    assert len(encoded) <= serialization.PRIVATE_METADATA_MAX_CHARS
+    assert decode_private_metadata(encoded) == data
+
+
+def test_private_metadata_over_the_limit_is_rejected():
+    data = {'blob': random.Random(0).randbytes(4000).hex()}
+    with pytest.raises(ValueError):
+        encode_private_metadata(data)
+
+
+def test_decodes_plain_json_of_older_views():
+    assert decode_private_metadata('{"select_azure_service": "svc1"}') == {'select_azure_service': 'svc1'}
+    assert decode_private_metadata('') == {}
+    assert decode_private_metadata(None) == {}
+    with pytest.raises(ValueError):
+        decode_private_metadata('9.{}')
@@ -0,0 +1,71 @@
+import threading
+import time
+from unittest.mock import MagicMock, patch
+import pytest
+from slack_sdk.errors import SlackApiError
+from metrics import SLACK_RATE_LIMITED
+from slack_client import (
+    PRIORITY_BULK, PRIORITY_INTERACTIVE, ConcurrencyLimiter, PriorityLimiter, RateLimitedWebClient, TokenBucket
+)
+
+
+def test_token_bucket_paces_after_burst():
+    bucket = TokenBucket(rate_per_minute=600, burst=1)
+    start = time.monotonic()
+    for _ in range(3):
+        bucket.acquire()
+    assert time.monotonic() - start >= 0.18
+
+
+def test_limiter_serves_higher_priority_first():
+    limiter = ConcurrencyLimiter(1)
+    limiter.acquire()
+    order = []
+
+    def acquire(name, priority):
+        limiter.acquire(priority)
+        order.append(name)
+        limiter.release()
+
+    bulk = threading.Thread(target=acquire, args=('bulk', PRIORITY_BULK))
+    bulk.start()
+    time.sleep(0.05)
+    interactive = threading.Thread(target=acquire, args=('views', PRIORITY_INTERACTIVE))
+    interactive.start()
+    time.sleep(0.05)
+
+    limiter.release()
+    bulk.join(1)
+    interactive.join(1)
+    assert order == ['views', 'bulk']
+
+
+def test_api_call_retries_after_429():
+    response = MagicMock(status_code=429, headers={'Retry-After': '0'})
+    client = RateLimitedWebClient('xoxb-test')
+    before = SLACK_RATE_LIMITED.get('chat.postMessage')
+
+    with patch('metrics.InstrumentedWebClient.api_call',
+               side_effect=[SlackApiError('ratelimited', response), 'ok']) as mock_api_call:
+        assert client.api_call('chat.postMessage', json={'channel': 'C1', 'text': 'hi'}) == 'ok'
+
+    assert mock_api_call.call_count == 2
+    assert SLACK_RATE_LIMITED.get('chat.postMessage') == before + 1
+
+
+def test_buckets_are_per_channel_for_chat_post_message():
+    client = RateLimitedWebClient('xoxb-test')
+    first = client._get_bucket('chat.postMessage', {'json': {'channel': 'C1'}})
+    assert first is client._get_bucket('chat.postMessage', {'json': {'channel': 'C1'}})
+    assert first is not client._get_bucket('chat.postMessage', {'json': {'channel': 'C2'}})
+    assert client._get_bucket('apps.connections.open', {}) is None
+
+
+def test_connection_errors_are_retried_by_slack_sdk():
+    client = RateLimitedWebClient('xoxb-test')
+    assert [type(h).__name__ for h in client.retry_handlers] == ['ConnectionErrorRetryHandler']
+
+
+def test_limiters_must_implement_try_take():
+    with pytest.raises(TypeError):
+        PriorityLimiter()
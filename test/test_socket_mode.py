@@ -0,0 +1,57 @@
+from unittest.mock import MagicMock, patch
+from slack_bolt import App
+from slack_bolt.authorization import AuthorizeResult
+from slack_sdk import WebClient
+from slack_sdk.socket_mode.request import SocketModeRequest
+from socket_mode import SocketModeRunner, get_backoff_delay
+
+
+def make_app():
+    app = App(
+        client=WebClient('xoxb-test'), signing_secret='secret',
+        authorize=lambda **kwargs: AuthorizeResult(
+            enterprise_id=None, team_id='T1', bot_token='xoxb-test', bot_user_id='UB', bot_id='B1'))
+
+    @app.shortcut('open_form')
+    def handle_shortcut(ack):
+        ack()
+    return app
+
+
+def test_get_backoff_delay_grows_and_caps():
+    for attempt, upper in ((1, 1), (2, 2), (3, 4), (10, 60)):
+        delay = get_backoff_delay(attempt, cap=60)
+        assert upper / 2 <= delay <= upper
+
+
+def test_dispatch_acks_through_the_connection():
+    runner = SocketModeRunner(make_app(), 'xapp-test', concurrency=2)
+    client = MagicMock()
+    req = SocketModeRequest(type='interactive', envelope_id='e1', payload={
+        'type': 'shortcut', 'callback_id': 'open_form', 'trigger_id': 't', 'team': {'id': 'T1'},
+        'user': {'id': 'U1'}})
+
+    runner._on_request(client, req)
+    runner.executor.shutdown(wait=True)
+
+    response = client.send_socket_mode_response.call_args[0][0]
+    assert response.envelope_id == 'e1'
+
+
+@patch('socket_mode.get_backoff_delay', return_value=0)
+def test_supervise_reconnects_after_failures(mock_backoff):
+    runner = SocketModeRunner(make_app(), 'xapp-test')
+    client = MagicMock()
+    client.is_connected.return_value = False
+
+    def connect():
+        if client.connect_to_new_endpoint.call_count == 3:
+            runner.stopped.set()
+            return
+        raise ConnectionError('refused')
+    client.connect_to_new_endpoint.side_effect = connect
+
+    runner._supervise(client, 0)
+
+    assert client.connect_to_new_endpoint.call_count == 3
+    assert [c.args[0] for c in mock_backoff.call_args_list] == [1, 2]
@@ -0,0 +1,15 @@
+from sqlite_store import SQLiteStore
+
+
+class NotesStore(SQLiteStore):
+    SCHEMA = 'CREATE TABLE IF NOT EXISTS notes (text TEXT NOT NULL);'
+
+
+def test_connection_is_opened_on_first_use_with_the_schema(tmp_path):
+    store = NotesStore(str(tmp_path / 'notes.db'))
+    assert store._conn is None
+
+    with store.lock, store.conn:
+        store.conn.execute("INSERT INTO notes VALUES ('a')")
+
+    assert NotesStore(store.path).conn.execute('SELECT text FROM notes').fetchall() == [('a',)]
@@ -0,0 +1,32 @@
+from startup import StartupProfile, format_import_report, parse_import_times
+
+IMPORT_TIME_OUTPUT = """import time: self [us] | cumulative | imported package
+import time:       120 |        120 |     json.decoder
+import time:       300 |        420 |   json
+import time:       500 |        920 | app
+"""
+
+
+def test_parse_import_times():
+    assert parse_import_times(IMPORT_TIME_OUTPUT) == [
+        ('json.decoder', 120, 120, 2), ('json', 300, 420, 1), ('app', 500, 920, 0)]
+
+
+def test_format_import_report_sorts_by_cumulative_time():
+    report = format_import_report(parse_import_times(IMPORT_TIME_OUTPUT), top=2)
+    lines = report.splitlines()
+    assert lines[0] == 'Total import time: 0.9 ms'
+    assert lines[3].endswith('app')
+    assert lines[4].endswith('  json')
+    assert len(lines) == 5
+
+
+def test_startup_profile_records_phases_and_ready_once():
+    profile = StartupProfile(started_at=0)
+    with profile.phase('dataset'):
+        pass
+    profile.mark_ready()
+    ready_seconds = profile.ready_seconds
+    profile.mark_ready()
+    assert 'dataset' in profile.phases
+    assert profile.ready_seconds == ready_seconds > 0
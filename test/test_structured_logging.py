@@ -0,0 +1,74 @@
+import json
+import logging
+import pytest
+from structured_logging import (
+    REDACTED, StructuredFormatter, _parse_sample_rates, log_event, settings, summarize
+)
+
+
+@pytest.fixture(autouse=True)
+def reset_settings(monkeypatch):
+    monkeypatch.setattr(settings, 'max_payload_chars', 20)
+    monkeypatch.setattr(settings, 'max_items', 3)
+    monkeypatch.setattr(settings, 'sample_rates', {})
+
+
+def make_record(**fields):
+    record = logging.LogRecord('test', logging.INFO, __file__, 1, 'event.name', None, None)
+    record.event_fields = fields
+    return record
+
+
+def test_summarize_redacts_nested_fields():
+    result = summarize({'user': {'email': 'a@b.com', 'user_id': 'U1'}})
+    assert result == {'user': {'email': REDACTED, 'user_id': 'U1'}}
+
+
+def test_summarize_caps_strings_and_collections():
+    assert summarize('x' * 25) == 'x' * 20 + '...(+5 chars)'
+    assert summarize(list(range(10))) == {'count': 10, 'head': [0, 1, 2]}
+    assert summarize({str(i): i for i in range(5)})['...'] == '2 more keys'
+
+
+def test_summarize_caps_depth(monkeypatch):
+    monkeypatch.setattr(settings, 'max_depth', 2)
+    nested = {'a': {'b': {'c': 1}}}
+    assert summarize(nested) == {'a': {'b': 'dict of 1 items'}}
+
+    cyclic = []
+    cyclic.append(cyclic)
+    assert summarize(cyclic) == [['list of 1 items']]
+
+
+def test_log_event_skips_disabled_levels(caplog):
+    logger = logging.getLogger('test_disabled')
+    with caplog.at_level(logging.INFO, logger='test_disabled'):
+        log_event(logger, logging.DEBUG, 'event.debug', payload='x')
+    assert caplog.records == []
+
+
+def test_log_event_applies_sample_rate(caplog, monkeypatch):
+    monkeypatch.setattr(settings, 'sample_rates', {'event.sampled': 0.0})
+    logger = logging.getLogger('test_sampled')
+    with caplog.at_level(logging.INFO, logger='test_sampled'):
+        log_event(logger, logging.INFO, 'event.sampled')
+        log_event(logger, logging.INFO, 'event.other')
+    assert [r.getMessage() for r in caplog.records] == ['event.other']
+
+
+def test_json_formatter_summarizes_fields():
+    record = make_record(phone='555', private_metadata={'real_name': 'John', 'id': 1})
+    payload = json.loads(StructuredFormatter(json_output=True).format(record))
+    assert payload['message'] == 'event.name'
+    assert payload['phone'] == REDACTED
+    assert payload['private_metadata'] == {'real_name': REDACTED, 'id': 1}
+
+
+def test_text_formatter_appends_fields():
+    text = StructuredFormatter().format(make_record(count=3))
+    assert text.endswith('event.name count=3')
+
+
+def test_parse_sample_rates():
+    assert _parse_sample_rates('a=0.5, b=1') == {'a': 0.5, 'b': 1.0}
+    assert _parse_sample_rates('') == {}
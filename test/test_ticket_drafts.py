@@ -0,0 +1,72 @@
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import MagicMock
+
+import pytest
+
+from ticket_drafts import TicketDrafts
+
+SELECTION = {
+    'select_azure_subscription': 'sub1',
+    'select_azure_service': 'svc1',
+    'select_azure_service_problem_classifications': 'pc1',
+    'select_azure_resource': 'hash1',
+}
+
+
+@pytest.fixture
+def azure_support():
+    mock = MagicMock()
+    mock.get_resource_id_by_resource_hash.return_value = '/subscriptions/sub1/resourceGroups/rg1/providers/x/r1'
+    mock.build_support_ticket.return_value = ('sub1', 'svc1', 'details')
+    return mock
+
+
+@pytest.fixture
+def executor():
+    executor = ThreadPoolExecutor(max_workers=2)
+    yield executor
+    executor.shutdown(wait=True)
+
+
+def _resolve(drafts, view_id, private_metadata, executor):
+    drafts.update(view_id, private_metadata)
+    drafts.drafts[view_id][1].result(timeout=5)
+
+
+def test_build_ticket_uses_resolved_draft(azure_support, executor):
+    drafts = TicketDrafts(azure_support, executor)
+    _resolve(drafts, 'V1', dict(SELECTION, user_id='U1'), executor)
+    azure_support.get_problem_classification_details.assert_called_once_with('sub1', 'svc1', 'pc1')
+
+    data = dict(SELECTION, subject='Broken')
+    assert drafts.build_ticket('V1', data) == ('sub1', 'svc1', 'details')
+    built = azure_support.build_support_ticket.call_args[0][0]
+    assert built['resource_id'] == '/subscriptions/sub1/resourceGroups/rg1/providers/x/r1'
+    assert built['subject'] == 'Broken'
+    assert 'V1' not in drafts.drafts
+
+
+def test_build_ticket_ignores_draft_of_other_selection(azure_support, executor):
+    drafts = TicketDrafts(azure_support, executor)
+    _resolve(drafts, 'V1', SELECTION, executor)
+    assert drafts.build_ticket('V1', dict(SELECTION, select_azure_resource='hash2')) is None
+    assert drafts.build_ticket('V2', SELECTION) is None
+
+
+def test_build_ticket_ignores_failed_draft(azure_support, executor):
+    azure_support.get_problem_classification_details.side_effect = RuntimeError('not found')
+    drafts = TicketDrafts(azure_support, executor)
+    drafts.update('V1', SELECTION)
+    with pytest.raises(RuntimeError):
+        drafts.drafts['V1'][1].result(timeout=5)
+    assert drafts.build_ticket('V1', SELECTION) is None
+
+
+def test_update_skips_incomplete_and_unchanged_selections(azure_support):
+    executor = MagicMock()
+    drafts = TicketDrafts(azure_support, executor)
+    drafts.update('V1', {'select_azure_subscription': 'sub1'})
+    executor.submit.assert_not_called()
+    drafts.update('V1', SELECTION)
+    drafts.update('V1', dict(SELECTION, user_id='U1'))
+    assert executor.submit.call_count == 1
@@ -0,0 +1,86 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import MagicMock
+
+from helpers import Blocks
+from ticket_fanout import TicketFanOut, TicketTarget, get_ticket_name, get_ticket_targets
+
+
+def _data(**extra):
+    return dict({
+        Blocks.SUBJECT: 'Outage',
+        Blocks.AZURE_SUBSCRIPTION: 'sub1', Blocks.AZURE_SUBSCRIPTION_TEXT: 'Sub 1',
+        Blocks.AZURE_SERVICE: 'svc1',
+        Blocks.AZURE_RESOURCE: 'hash1', Blocks.AZURE_RESOURCE_TEXT: 'vm1',
+    }, **extra)
+
+
+def _azure_support():
+    azure_support = MagicMock()
+    azure_support.build_support_ticket.side_effect = lambda data: (
+        data[Blocks.AZURE_SUBSCRIPTION], data[Blocks.AZURE_SERVICE], data['resource_id'])
+    azure_support.get_resource_id_by_resource_hash.side_effect = lambda sub, svc, h: h and f'/{sub}/{h}'
+    azure_support.create_support_ticket.side_effect = lambda sub, svc, details, ticket_name: {
+        'success': True, 'url': f'https://portal/{ticket_name}', 'ticket_name': ticket_name, 'subscription_id': sub}
+    return azure_support
+
+
+def test_targets_are_deduplicated_in_order():
+    targets = get_ticket_targets(_data(**{
+        Blocks.ADDITIONAL_AZURE_SUBSCRIPTIONS: ['sub2', 'sub2', 'sub3'],
+        Blocks.ADDITIONAL_AZURE_SUBSCRIPTIONS_TEXT: ['Sub 2', 'Sub 2', 'Sub 3'],
+        Blocks.ADDITIONAL_AZURE_RESOURCES: ['hash1', 'hash2', 'none'],
+        Blocks.ADDITIONAL_AZURE_RESOURCES_TEXT: ['vm1', 'vm2', 'General question'],
+    }))
+
+    assert [(t.subscription_id, t.resource_hash) for t in targets] == [
+        ('sub1', 'hash1'), ('sub2', None), ('sub3', None), ('sub1', 'hash2'), ('sub1', None)]
+    assert targets[1].label == 'Sub 2 (general question)'
+    assert targets[3].label == 'Sub 1 / vm2'
+
+
+def test_single_target_without_additional_picks():
+    assert len(get_ticket_targets(_data())) == 1
+
+
+def test_file_tickets_in_parallel_and_update_one_message():
+    azure_support = _azure_support()
+    started = threading.Barrier(3, timeout=5)
+
+    def create(sub, svc, details, ticket_name):
+        # All three are in flight at once
+        started.wait()
+        return {'success': True, 'url': f'https://portal/{ticket_name}', 'ticket_name': ticket_name,
+                'subscription_id': sub}
+    azure_support.create_support_ticket.side_effect = create
+    client = MagicMock()
+    client.chat_postMessage.return_value = {'channel': 'D1', 'ts': '1.0'}
+    fanout = TicketFanOut(azure_support, client, executor=ThreadPoolExecutor(max_workers=3))
+    targets = get_ticket_targets(_data(**{Blocks.ADDITIONAL_AZURE_SUBSCRIPTIONS: ['sub2', 'sub3']}))
+
+    fanout.file_tickets(_data(), targets, 'U1', 'U1', 'summary', 'V1')
+
+    assert all(t.result['success'] for t in targets)
+    names = {c.kwargs['ticket_name'] for c in azure_support.create_support_ticket.call_args_list}
+    assert len(names) == 3
+    assert client.chat_postMessage.call_args_list[1].kwargs['thread_ts'] == '1.0'
+    assert client.chat_update.call_count == 3
+    last = client.chat_update.call_args.kwargs
+    assert last['channel'] == 'D1' and last['ts'] == '1.0'
+    assert 'Filed 3 of 3' in last['text']
+
+
+def test_failed_create_finds_ticket_and_refiling_is_idempotent():
+    azure_support = _azure_support()
+    azure_support.create_support_ticket.side_effect = None
+    azure_support.create_support_ticket.return_value = {'success': False}
+    azure_support.get_support_ticket.return_value = {'success': True, 'url': 'https://portal/t', 'ticket_name': 't'}
+    fanout = TicketFanOut(azure_support, MagicMock(), executor=ThreadPoolExecutor(max_workers=2))
+    target = TicketTarget('sub2', 'Sub 2')
+    ticket_name = get_ticket_name('svc1', 'V1', target)
+
+    assert fanout._file_ticket(_data(), target, 'V1')['success']
+    azure_support.get_support_ticket.assert_called_once_with('sub2', ticket_name)
+    assert fanout._file_ticket(_data(), target, 'V1')['success']
+    azure_support.create_support_ticket.assert_called_once()
+    assert get_ticket_name('svc1', 'V2', target) != ticket_name
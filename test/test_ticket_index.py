@@ -0,0 +1,43 @@
+import time
+
+from ticket_index import TicketIndex, get_match_query
+
+
+def _index(tmp_path):
+    index = TicketIndex(str(tmp_path / 'index.db'))
+    now = time.time()
+    index.add_ticket('t1', 'VM does not start after resize', 'Boot diagnostics show nothing', 'svc-vm',
+                     'Virtual Machines', 'Cannot start', 'vm1', 'https://portal/t1', now - 60)
+    index.add_ticket('t2', 'Storage account slow', 'Blob reads time out when the vm reads', 'svc-storage',
+                     'Storage', 'Performance', None, 'https://portal/t2', now - 60)
+    index.add_ticket('t3', 'VM does not start', 'Old ticket', 'svc-vm', 'Virtual Machines', None, 'vm2',
+                     'https://portal/t3', now - 40 * 24 * 60 * 60)
+    return index, now
+
+
+def test_match_query_drops_stop_words_and_prefixes_last_word():
+    assert get_match_query('The VM is restar') == '"vm" OR "restar"*'
+    assert get_match_query('VM down ') == '"vm" OR "down"'
+    assert get_match_query('a !') is None
+
+
+def test_find_similar_ranks_subject_matches_first(tmp_path):
+    index, now = _index(tmp_path)
+
+    similar = index.find_similar('vm won\'t start', now=now)
+
+    # t3 was filed too long ago to still be open
+    assert [t['url'] for t in similar] == ['https://portal/t1', 'https://portal/t2']
+    assert similar[0]['subject'] == 'VM does not start after resize'
+
+
+def test_find_similar_prefers_the_picked_service(tmp_path):
+    index, now = _index(tmp_path)
+    assert index.find_similar('vm', 'svc-storage', now=now)[0]['url'] == 'https://portal/t2'
+
+
+def test_closed_tickets_are_not_suggested(tmp_path):
+    index, now = _index(tmp_path)
+    index.close_ticket('t1')
+    assert [t['url'] for t in index.find_similar('resize', now=now)] == []
+    assert index.find_similar('', now=now) == []
@@ -0,0 +1,131 @@
+import pytest
+from datetime import datetime, timezone
+from unittest.mock import MagicMock, patch
+from ticket_sync import TicketSyncEngine, TicketSyncStore
+
+
+@pytest.fixture
+def store():
+    return TicketSyncStore(':memory:')
+
+
+@pytest.fixture
+def engine(store):
+    return TicketSyncEngine(MagicMock(), MagicMock(), store)
+
+
+def make_communication(name, minute, body='<p>Hello&amp;bye</p>'):
+    c = MagicMock()
+    c.name = name
+    c.subject = f'Subject {name}'
+    c.body = body
+    c.created_date = datetime(2026, 1, 1, 10, minute, tzinfo=timezone.utc)
+    return c
+
+
+def test_store_mark_communication_is_idempotent(store):
+    assert store.mark_communication('t1', 'c1') is True
+    assert store.mark_communication('t1', 'c1') is False
+    store.unmark_communication('t1', 'c1')
+    assert store.mark_communication('t1', 'c1') is True
+
+
+def test_store_watermark_only_moves_forward(store):
+    store.add_ticket('t1', 'sub1', 'C1', '1.1', '2026-01-01T10:00:00Z')
+    store.set_watermark('t1', '2026-01-01T10:05:00Z')
+    store.set_watermark('t1', '2026-01-01T10:01:00Z')
+    assert store.get_open_tickets()[0]['watermark'] == '2026-01-01T10:05:00Z'
+
+
+def test_html_to_mrkdwn():
+    assert TicketSyncEngine._html_to_mrkdwn('<p>a<br/>b</p>&quot;x&quot;') == 'a\nb\n"x"'
+    assert TicketSyncEngine._html_to_mrkdwn('&lt;!channel&gt; see &lt;https://x|y&gt; &amp;') == (
+        '&lt;!channel&gt; see &lt;https://x|y&gt; &amp;')
+
+
+@patch('ticket_sync.MicrosoftSupport')
+def test_poll_once_posts_deltas_in_order_without_duplicates(mock_ms, engine, store):
+    store.add_ticket('t1', 'sub1', 'C1', '1.1', '2026-01-01T10:00:00Z')
+    support_client = mock_ms.return_value
+    ticket = MagicMock()
+    ticket.name = 't1'
+    support_client.support_tickets.list.return_value = [ticket]
+    support_client.communications.list.return_value = [
+        make_communication('c2', 2), make_communication('c1', 1)]
+
+    engine.poll_once()
+    engine.poll_once()
+
+    texts = [c.kwargs['text'] for c in engine.client.chat_postMessage.call_args_list]
+    assert len(texts) == 2
+    assert texts[0].startswith('*Subject c1*')
+    assert engine.client.chat_postMessage.call_args.kwargs['thread_ts'] == '1.1'
+    assert store.get_open_tickets()[0]['watermark'] == '2026-01-01T10:02:00Z'
+    assert 'createdDate ge 2026-01-01T10:02:00Z' in support_client.communications.list.call_args.kwargs['filter']
+
+
+@patch('ticket_sync.MicrosoftSupport')
+def test_failed_post_is_retried_by_the_next_poll(mock_ms, engine, store):
+    store.add_ticket('t1', 'sub1', 'C1', '1.1', '2026-01-01T10:00:00Z')
+    support_client = mock_ms.return_value
+    ticket = MagicMock()
+    ticket.name = 't1'
+    support_client.support_tickets.list.return_value = [ticket]
+    support_client.communications.list.return_value = [make_communication('c1', 1), make_communication('c2', 2)]
+    engine.client.chat_postMessage.side_effect = [Exception('ratelimited'), None, None]
+
+    engine.poll_once()
+    assert store.get_open_tickets()[0]['watermark'] == '2026-01-01T10:00:00Z'
+    engine.poll_once()
+
+    texts = [c.kwargs['text'] for c in engine.client.chat_postMessage.call_args_list]
+    assert [t.split('*')[1] for t in texts] == ['Subject c1', 'Subject c1', 'Subject c2']
+
+
+def test_seen_communications_are_forgotten_behind_the_watermark(engine, store):
+    store.add_ticket('t1', 'sub1', 'C1', '1.1', '2026-01-01T10:00:00Z')
+    # Posted from Slack, already in the seen set
+    store.mark_communication('t1', 'slack-1')
+    support_client = MagicMock()
+    support_client.communications.list.return_value = [
+        make_communication('slack-1', 1), make_communication('c2', 2)]
+
+    engine._sync_ticket(support_client, store.get_open_tickets()[0])
+
+    assert engine.client.chat_postMessage.call_count == 1
+    assert store.mark_communication('t1', 'slack-1') is True
+    assert store.mark_communication('t1', 'c2') is False
+    assert store.get_open_tickets()[0]['watermark'] == '2026-01-01T10:02:00Z'
+
+
+@patch('ticket_sync.MicrosoftSupport')
+def test_poll_once_stops_syncing_closed_tickets(mock_ms, engine, store):
+    store.add_ticket('t1', 'sub1', 'C1', '1.1', '2026-01-01T10:00:00Z')
+    mock_ms.return_value.support_tickets.list.return_value = []
+
+    engine.poll_once()
+
+    assert store.get_open_tickets() == []
+    mock_ms.return_value.communications.list.assert_not_called()
+
+
+@patch('ticket_sync.MicrosoftSupport')
+def test_handle_thread_reply_creates_communication_once(mock_ms, engine, store):
+    engine.executor = MagicMock()
+    engine.executor.submit.side_effect = lambda fn, *args: fn(*args)
+    store.add_ticket('t1', 'sub1', 'C1', '1.1', '2026-01-01T10:00:00Z')
+    event = {'channel': 'C1', 'thread_ts': '1.1', 'ts': '2.2', 'user': 'U1', 'text': 'more info'}
+
+    assert engine.handle_thread_reply(event) is True
+    assert engine.handle_thread_reply(event) is True
+
+    begin_create = mock_ms.return_value.communications.begin_create
+    begin_create.assert_called_once()
+    assert begin_create.call_args.kwargs['communication_name'] == 'slack-2-2'
+
+
+def test_handle_thread_reply_ignores_unknown_threads_and_bots(engine, store):
+    store.add_ticket('t1', 'sub1', 'C1', '1.1', '2026-01-01T10:00:00Z')
+    assert engine.handle_thread_reply({'channel': 'C1', 'thread_ts': '9.9', 'ts': '2.2'}) is False
+    assert engine.handle_thread_reply({'channel': 'C1', 'thread_ts': '1.1', 'ts': '2.2', 'bot_id': 'B1'}) is False
+    assert engine.handle_thread_reply({'channel': 'C1', 'ts': '2.2'}) is False
@@ -0,0 +1,138 @@
+import time
+from unittest.mock import MagicMock
+from azure.core.credentials import AccessToken
+from token_cache import CachingCredential, TokenFileCache
+
+SCOPE = 'https://management.azure.com/.default'
+
+
+class FakeMember:
+
+    def __init__(self, token=None):
+        self.token = token
+        self.calls = 0
+
+    def get_token(self, *scopes, **kwargs):
+        self.calls += 1
+        if self.token is None:
+            raise RuntimeError('unavailable')
+        return self.token
+
+
+class FakeChain:
+
+    def __init__(self, *credentials):
+        self.credentials = credentials
+        self._successful_credential = None
+        self.calls = 0
+
+    def get_token(self, *scopes, **kwargs):
+        self.calls += 1
+        for credential in self.credentials:
+            try:
+                token = credential.get_token(*scopes)
+                self._successful_credential = credential
+                return token
+            except RuntimeError:
+                pass
+        raise RuntimeError('no credential')
+
+
+class EnvironmentCredential(FakeMember):
+    pass
+
+
+class AzureCliCredential(FakeMember):
+    pass
+
+
+def make_token(expires_in=3600):
+    return AccessToken('token', int(time.time()) + expires_in)
+
+
+def test_get_token_is_cached_per_scope():
+    credential = MagicMock()
+    credential.get_token.return_value = make_token()
+    caching = CachingCredential(credential)
+
+    assert caching.get_token(SCOPE) is caching.get_token(SCOPE)
+    caching.get_token('other/.default')
+    assert credential.get_token.call_count == 2
+
+
+def test_claims_challenge_bypasses_cache():
+    credential = MagicMock()
+    credential.get_token.return_value = make_token()
+    caching = CachingCredential(credential)
+    caching.get_token(SCOPE)
+    caching.get_token(SCOPE, claims='{"access_token": {}}')
+    assert credential.get_token.call_count == 2
+
+
+def test_successful_chain_member_is_tried_first():
+    cli = AzureCliCredential(make_token())
+    chain = FakeChain(EnvironmentCredential(), cli)
+    caching = CachingCredential(chain)
+
+    caching.get_token(SCOPE)
+    assert caching.preferred_credential == 'AzureCliCredential'
+
+    caching.tokens.clear()
+    caching.get_token(SCOPE)
+    assert chain.calls == 1
+    assert cli.calls == 2
+
+
+def test_refresh_due_tokens_renews_before_expiry():
+    credential = MagicMock()
+    credential.get_token.side_effect = [make_token(expires_in=300), make_token(expires_in=3600)]
+    caching = CachingCredential(credential)
+    caching.get_token(SCOPE)
+
+    next_due = caching.refresh_due_tokens()
+
+    assert credential.get_token.call_count == 2
+    assert caching.tokens[next(iter(caching.tokens))].expires_on > time.time() + 3000
+    assert 0 < next_due <= CachingCredential.MAX_SLEEP
+
+
+def test_refresh_after_invalidation_fetches_the_token_again():
+    from metrics import clear_cache
+    credential = MagicMock()
+    credential.get_token.side_effect = [make_token(), make_token()]
+    caching = CachingCredential(credential, cache_partition='TINVALIDATE')
+    caching.get_token(SCOPE)
+
+    clear_cache('azure_token:TINVALIDATE')
+    caching.refresh_due_tokens()
+
+    assert credential.get_token.call_count == 2
+    assert len(caching.tokens) == 1
+
+
+def test_file_cache_shares_tokens_between_workers(tmp_path):
+    path = str(tmp_path / 'tokens.json')
+    first = MagicMock()
+    first.get_token.return_value = make_token()
+    CachingCredential(first, TokenFileCache(path)).get_token(SCOPE)
+
+    second = MagicMock()
+    token = CachingCredential(second, TokenFileCache(path)).get_token(SCOPE)
+
+    second.get_token.assert_not_called()
+    assert token.token == 'token'
+
+
+def test_hits_are_counted_under_the_workspace_cache_name():
+    from metrics import CACHE_REQUESTS
+    credential = MagicMock()
+    credential.get_token.return_value = make_token()
+    caching = CachingCredential(credential, cache_partition='TCOUNT')
+    primary_hits = CACHE_REQUESTS.get('azure_token', 'hit')
+
+    caching.get_token(SCOPE)
+    caching.get_token(SCOPE)
+
+    assert CACHE_REQUESTS.get('azure_token:TCOUNT', 'miss') == 1
+    assert CACHE_REQUESTS.get('azure_token:TCOUNT', 'hit') == 1
+    assert CACHE_REQUESTS.get('azure_token', 'hit') == primary_hits
@@ -0,0 +1,97 @@
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import MagicMock
+import tracing
+from tracing import (
+    Tracer, TracedCredential, get_request_kind_and_id, start_span, submit_with_context, to_otlp_payload, traced
+)
+
+
+class ListProcessor:
+
+    def __init__(self):
+        self.spans = []
+
+    def on_end(self, span):
+        self.spans.append(span)
+
+
+@pytest.fixture
+def processor(monkeypatch):
+    processor = ListProcessor()
+    monkeypatch.setattr(tracing, 'tracer', Tracer(processor, sample_ratio=1.0))
+    return processor
+
+
+def test_child_spans_share_trace_and_parent(processor):
+    with start_span('root') as root:
+        with start_span('child', key='value') as child:
+            pass
+
+    assert [s.name for s in processor.spans] == ['child', 'root']
+    assert child.trace_id == root.trace_id
+    assert child.parent_id == root.span_id
+    assert child.attributes == {'key': 'value'}
+
+
+def test_unsampled_root_records_nothing(monkeypatch):
+    processor = ListProcessor()
+    monkeypatch.setattr(tracing, 'tracer', Tracer(processor, sample_ratio=0.0))
+    with start_span('root'):
+        with start_span('child'):
+            pass
+    assert processor.spans == []
+
+
+def test_disabled_tracer_is_noop(monkeypatch):
+    monkeypatch.setattr(tracing, 'tracer', Tracer())
+
+    @traced
+    def add(a, b):
+        return a + b
+
+    assert add(1, 2) == 3
+
+
+def test_traced_records_errors(processor):
+    @traced
+    def fail():
+        raise ValueError('bad')
+
+    with pytest.raises(ValueError):
+        fail()
+    assert processor.spans[0].error == 'ValueError: bad'
+
+
+def test_submit_with_context_keeps_parent(processor):
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        with start_span('root') as root:
+            def work():
+                with start_span('work') as span:
+                    return span
+            span = submit_with_context(executor, work).result()
+    assert span.parent_id == root.span_id
+
+
+def test_traced_credential_wraps_get_token(processor):
+    credential = MagicMock()
+    credential.get_token.return_value = 'token'
+    assert TracedCredential(credential).get_token('scope/.default') == 'token'
+    assert processor.spans[0].name == 'azure.get_token'
+
+
+def test_to_otlp_payload(processor):
+    with start_span('root', count=3):
+        pass
+    span = to_otlp_payload(processor.spans)['resourceSpans'][0]['scopeSpans'][0]['spans'][0]
+    assert span['name'] == 'root'
+    assert len(span['traceId']) == 32
+    assert span['attributes'] == [{'key': 'count', 'value': {'intValue': '3'}}]
+
+
+def test_get_request_kind_and_id():
+    assert get_request_kind_and_id({'type': 'block_actions', 'actions': [{'action_id': 'x'}]}) == ('action', 'x')
+    assert get_request_kind_and_id({'type': 'block_suggestion', 'action_id': 'y'}) == ('options', 'y')
+    assert get_request_kind_and_id({'type': 'view_submission', 'view': {'callback_id': 'v'}}) == ('view', 'v')
+    assert get_request_kind_and_id({'type': 'shortcut', 'callback_id': 's'}) == ('shortcut', 's')
+    assert get_request_kind_and_id({'command': '/azure-support'}) == ('command', '/azure-support')
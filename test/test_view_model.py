@@ -0,0 +1,73 @@
+import pytest
+
+from serialization import encode_private_metadata
+from view_model import ModalView
+
+
+def _block(block_id, text='x'):
+    return {'type': 'section', 'block_id': block_id, 'text': {'type': 'plain_text', 'text': text}}
+
+
+def _body(*block_ids, private_metadata=None):
+    return {'view': {
+        'id': 'V1', 'hash': 'h1', 'type': 'modal', 'callback_id': 'cb', 'title': {'type': 'plain_text', 'text': 'T'},
+        'close': None, 'private_metadata': encode_private_metadata(private_metadata or {}),
+        'blocks': [_block(b) for b in block_ids],
+    }}
+
+
+def _ids(view):
+    return [b.get('block_id') for b in view]
+
+
+def test_insert_replace_and_remove_relative_to_block_ids():
+    view = ModalView.from_body(_body('a', 'b', 'c'))
+
+    view.insert_after('a', _block('a2'), _block('a3'))
+    view.insert_after('c', _block('d'))
+    view.replace('b', _block('b2'))
+    assert view.remove('a3')['block_id'] == 'a3'
+    assert view.remove('missing') is None
+
+    assert _ids(view) == ['a', 'a2', 'b2', 'c', 'd']
+    assert 'b' not in view and view.get('b2')['block_id'] == 'b2'
+    with pytest.raises(KeyError):
+        view.insert_after('missing', _block('e'))
+    with pytest.raises(ValueError):
+        view.append(_block('a'))
+
+
+def test_blocks_without_block_id_keep_their_place():
+    view = ModalView([{'type': 'divider'}, _block('a'), {'type': 'divider'}])
+    view.insert_after('a', _block('b'))
+    assert _ids(view) == [None, 'a', 'b', None]
+
+
+def test_unchanged_view_is_not_dirty():
+    view = ModalView.from_body(_body('a', 'b', private_metadata={'user_id': 'U1'}))
+    assert not view.is_dirty
+
+    view.replace('a', _block('a'))
+    view.upsert(_block('b'))
+    view.remove('missing')
+    view.private_metadata['user_id'] = 'U1'
+    assert not view.is_dirty
+
+    view.private_metadata['select_severity'] = 'minimal'
+    assert view.is_dirty
+
+
+def test_render_includes_properties_and_marks_clean():
+    view = ModalView.from_body(_body('a'))
+    view.upsert(_block('z'))
+
+    rendered = view.render()
+
+    assert rendered['callback_id'] == 'cb' and 'close' not in rendered
+    assert [b['block_id'] for b in rendered['blocks']] == ['a', 'z']
+    assert rendered['private_metadata'] == encode_private_metadata({})
+    assert not view.is_dirty
+
+
+def test_new_view_is_dirty():
+    assert ModalView([_block('a')]).is_dirty
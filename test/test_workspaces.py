@@ -0,0 +1,63 @@
+import json
+from types import SimpleNamespace
+
+import pytest
+from cachetools import LRUCache, cached
+
+from workspaces import PartitionedCache, WorkspaceInstallationStore, get_partition_name, load_workspaces
+
+
+def test_load_workspaces_reads_secrets_from_environment(tmp_path, monkeypatch):
+    path = tmp_path / 'workspaces.json'
+    path.write_text(json.dumps({'T2': {
+        'bot_token_env': 'BOT_TOKEN_T2', 'azure_tenant_id': 'tenant', 'azure_client_id': 'app',
+        'azure_client_secret_env': 'SECRET_T2', 'cache_quota_mb': 16}}))
+    monkeypatch.setenv('BOT_TOKEN_T2', 'xoxb-2')
+    monkeypatch.setenv('SECRET_T2', 'secret')
+    [workspace] = load_workspaces(str(path))
+    assert (workspace.team_id, workspace.bot_token, workspace.azure_client_secret) == ('T2', 'xoxb-2', 'secret')
+    assert workspace.cache_quota_mb == 16
+
+    monkeypatch.delenv('SECRET_T2')
+    with pytest.raises(ValueError, match='SECRET_T2'):
+        load_workspaces(str(path))
+
+
+def test_installation_store_finds_configured_bots():
+    store = WorkspaceInstallationStore([SimpleNamespace(team_id='T2', bot_token='xoxb-2')])
+    assert store.find_bot(enterprise_id=None, team_id='T2').bot_token == 'xoxb-2'
+    assert store.find_installation(enterprise_id=None, team_id='T2').bot_token == 'xoxb-2'
+    assert store.find_bot(enterprise_id=None, team_id='T3') is None
+
+
+def test_partitioned_cache_keeps_workspaces_apart():
+    sizes = {None: 2, 'T2': 1}
+    cache = PartitionedCache(lambda partition: LRUCache(maxsize=sizes[partition]))
+    calls = []
+
+    @cached(cache=cache)
+    def fetch(credentials, key):
+        calls.append((credentials.cache_partition, key))
+        return key
+
+    class Credential:
+        def __init__(self, cache_partition):
+            self.cache_partition = cache_partition
+
+    primary, other = Credential(None), Credential('T2')
+    fetch(primary, 'a')
+    fetch(primary, 'b')
+    # The small partition of T2 evicts its own entries only
+    fetch(other, 'c')
+    fetch(other, 'd')
+    fetch(primary, 'a')
+    fetch(primary, 'b')
+    assert calls == [(None, 'a'), (None, 'b'), ('T2', 'c'), ('T2', 'd')]
+    assert len(cache) == 3
+    cache.clear()
+    assert len(cache) == 0
+
+
+def test_partition_names():
+    assert get_partition_name('hash_cache', None) == 'hash_cache'
+    assert get_partition_name('hash_cache', 'T2') == 'hash_cache:T2'
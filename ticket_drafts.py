@@ -0,0 +1,85 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from cachetools import TTLCache
+
+from azure_support import AzureSupportHelper
+from helpers import Blocks
+from metrics import CACHE_REQUESTS, register_cache
+from tracing import submit_with_context
+from workspaces import get_partition_name
+
+logger = logging.getLogger(__name__)
+
+SELECTION_KEYS = (
+    Blocks.AZURE_SUBSCRIPTION,
+    Blocks.AZURE_SERVICE,
+    Blocks.AZURE_SERVICE_PROBLEM_CLASSIFICATIONS,
+    Blocks.AZURE_RESOURCE,
+)
+
+
+def _get_selection(values):
+    return tuple(values.get(k) for k in SELECTION_KEYS)
+
+
+class TicketDrafts:
+    """Resolves what a support ticket needs while its modal is filled in.
+
+    Every pick of a subscription, service, problem classification or
+    resource starts a background resolution for that view: the resource id
+    behind the option's hash is looked up and the problem classification is
+    checked against the service. On submit the ticket is built from the
+    draft if it matches the submitted selections, so nothing is fetched
+    before the job is queued.
+    """
+
+    def __init__(self, azure_support: AzureSupportHelper, executor: ThreadPoolExecutor, cache_partition=None):
+        self.azure_support = azure_support
+        self.executor = executor
+        self.drafts = TTLCache(maxsize=1024, ttl=60 * 60)
+        self.cache_name = get_partition_name('ticket_drafts', cache_partition)
+        register_cache(self.cache_name, self.drafts)
+        self.lock = threading.Lock()
+
+    def update(self, view_id, private_metadata):
+        selection = _get_selection(private_metadata)
+        subscription_id, service_id, _, _ = selection
+        if not view_id or not subscription_id or not service_id:
+            return
+        with self.lock:
+            draft = self.drafts.get(view_id)
+            if draft is not None and draft[0] == selection:
+                return
+            self.drafts[view_id] = (selection, submit_with_context(self.executor, self._resolve, selection))
+
+    def _resolve(self, selection):
+        subscription_id, service_id, problem_classification_id, resource_hash = selection
+        resolved = {}
+        if problem_classification_id:
+            # Raises for a classification that does not belong to the service
+            self.azure_support.get_problem_classification_details(
+                subscription_id, service_id, problem_classification_id)
+        if resource_hash:
+            resolved['resource_id'] = self.azure_support.get_resource_id_by_resource_hash(
+                subscription_id, service_id, resource_hash)
+        return resolved
+
+    def build_ticket(self, view_id, data):
+        """Returns (subscription_id, service_id, SupportTicketDetails) for the
+        submitted data, or None when the view has no resolved draft for the
+        same selections."""
+        with self.lock:
+            draft = self.drafts.pop(view_id, None)
+        if draft is None or draft[0] != _get_selection(data) or not draft[1].done():
+            CACHE_REQUESTS.inc(self.cache_name, 'miss')
+            return None
+        try:
+            resolved = draft[1].result()
+        except Exception as e:
+            logger.info("Ticket draft of view %s failed to resolve: %s", view_id, e)
+            CACHE_REQUESTS.inc(self.cache_name, 'miss')
+            return None
+        CACHE_REQUESTS.inc(self.cache_name, 'hit')
+        return self.azure_support.build_support_ticket(dict(data, **resolved))
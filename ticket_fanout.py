@@ -0,0 +1,194 @@
+import hashlib
+import logging
+import threading
+from concurrent.futures import as_completed
+
+from cachetools import TTLCache
+from slack_sdk import WebClient
+
+from azure_support import AzureSupportHelper
+from helpers import Blocks
+from metrics import get_shared_executor, register_cache
+from tracing import submit_with_context, traced
+from workspaces import get_partition_name
+
+logger = logging.getLogger(__name__)
+
+# Tickets of one submission, they are listed in a single Slack message
+MAX_TARGETS = 25
+
+
+def _get_resource_hash(value):
+    # "General question" is offered as the value 'none'
+    return value if value and value != 'none' else None
+
+
+class TicketTarget:
+    """A subscription, and optionally a resource, one of the tickets of a
+    submission is filed for."""
+
+    def __init__(self, subscription_id, subscription_text=None, resource_hash=None, resource_text=None):
+        self.subscription_id = subscription_id
+        self.subscription_text = subscription_text
+        self.resource_hash = resource_hash
+        self.resource_text = resource_text
+        self.result = None
+
+    @property
+    def label(self):
+        subscription = self.subscription_text or self.subscription_id
+        return f'{subscription} / {self.resource_text}' if self.resource_hash else f'{subscription} (general question)'
+
+
+def get_ticket_targets(data):
+    """Returns the targets of the submitted data without duplicates: the
+    picked subscription and resource, then the additional subscriptions,
+    then the additional resources of the picked subscription."""
+    subscription_id = data.get(Blocks.AZURE_SUBSCRIPTION)
+    subscription_text = data.get(Blocks.AZURE_SUBSCRIPTION_TEXT)
+    resource_hash = _get_resource_hash(data.get(Blocks.AZURE_RESOURCE))
+    targets = {(subscription_id, resource_hash): TicketTarget(
+        subscription_id, subscription_text, resource_hash, data.get(Blocks.AZURE_RESOURCE_TEXT))}
+
+    subscriptions = data.get(Blocks.ADDITIONAL_AZURE_SUBSCRIPTIONS) or []
+    texts = data.get(Blocks.ADDITIONAL_AZURE_SUBSCRIPTIONS_TEXT) or subscriptions
+    for subscription, text in zip(subscriptions, texts):
+        targets.setdefault((subscription, None), TicketTarget(subscription, text))
+
+    resources = data.get(Blocks.ADDITIONAL_AZURE_RESOURCES) or []
+    texts = data.get(Blocks.ADDITIONAL_AZURE_RESOURCES_TEXT) or resources
+    for resource, text in zip(resources, texts):
+        resource = _get_resource_hash(resource)
+        targets.setdefault((subscription_id, resource), TicketTarget(subscription_id, subscription_text, resource, text))
+    return list(targets.values())
+
+
+def get_ticket_name(service_id, view_id, target):
+    """Ticket name derived from the submission and the target, so filing a
+    target again finds the ticket instead of creating another one."""
+    key = hashlib.sha256(f'{view_id}|{target.subscription_id}|{target.resource_hash or ""}'.encode('utf-8'))
+    return f's{service_id}_{key.hexdigest()[:16]}'
+
+
+class TicketFanOut:
+    """Files one submission as a ticket per subscription or resource.
+
+    The tickets are created in parallel on a bounded pool, so filing twenty
+    takes about as long as filing the slowest one. A single Slack message
+    lists them and is updated as each one completes, the submitted details
+    go to its thread.
+
+    Each ticket is named after the submission and its target. A ticket
+    filed before is returned from memory, and when a create fails the
+    ticket is looked up in case Azure created it before the call failed.
+    """
+
+    WORKERS = 8
+
+    def __init__(self, azure_support: AzureSupportHelper, client: WebClient, executor=None,
+                 attachment_uploader=None, workers=WORKERS, cache_partition=None):
+        self.azure_support = azure_support
+        self.client = client
+        self.attachment_uploader = attachment_uploader
+        self.executor = get_shared_executor(executor, 'ticket_fanout', workers)
+        self.filed = TTLCache(maxsize=1024, ttl=24 * 60 * 60)
+        register_cache(get_partition_name('fanout_tickets', cache_partition), self.filed)
+        self.lock = threading.Lock()
+
+    @traced
+    def file_tickets(self, data, targets, channel, user_id, summary, view_id, mention=False):
+        """Files a ticket per target and returns the targets with their
+        results."""
+        ts = self._post_progress(channel, user_id, targets, data, mention)
+        if ts is not None:
+            channel, ts = ts
+            self._post(channel=channel, thread_ts=ts, text='.',
+                       blocks=[{"type": "section", "text": {"type": "mrkdwn", "text": f"```{summary}```"}}])
+
+        futures = {submit_with_context(self.executor, self._file_ticket, data, target, view_id): target
+                   for target in targets}
+        for future in as_completed(futures):
+            target = futures[future]
+            try:
+                target.result = future.result()
+            except Exception as e:
+                logger.exception("Exception in filing the ticket for %s: %s", target.label, e)
+                target.result = {'success': False}
+            if ts is not None:
+                self._update_progress(channel, ts, user_id, targets, data, mention)
+        filed = sum(1 for t in targets if t.result['success'])
+        logger.info('Filed %d of %d support tickets', filed, len(targets))
+        return targets
+
+    def _file_ticket(self, data, target, view_id):
+        service_id = data[Blocks.AZURE_SERVICE]
+        ticket_name = get_ticket_name(service_id, view_id, target)
+        with self.lock:
+            result = self.filed.get(ticket_name)
+        if result is not None:
+            return result
+
+        target_data = dict(data, **{
+            Blocks.AZURE_SUBSCRIPTION: target.subscription_id,
+            Blocks.AZURE_RESOURCE: target.resource_hash,
+        })
+        target_data['resource_id'] = self.azure_support.get_resource_id_by_resource_hash(
+            target.subscription_id, service_id, target.resource_hash)
+        ticket = self.azure_support.build_support_ticket(target_data)
+        result = self.azure_support.create_support_ticket(*ticket, ticket_name=ticket_name)
+        if not result['success']:
+            result = self.azure_support.get_support_ticket(target.subscription_id, ticket_name) or result
+        if not result['success']:
+            return result
+
+        with self.lock:
+            self.filed[ticket_name] = result
+        files = data.get(Blocks.FILE_ATTACHMENTS)
+        if files and self.attachment_uploader:
+            uploaded = self.attachment_uploader.upload_slack_files(target.subscription_id, ticket_name, files)
+            result = dict(result, attachments=len(uploaded))
+        return result
+
+    def _format_progress(self, user_id, targets, data, mention):
+        done = [t for t in targets if t.result is not None]
+        subject = data.get(Blocks.SUBJECT, '')
+        greeting = f'Hello <@{user_id}>!' if mention else 'Hello!'
+        if len(done) < len(targets):
+            header = f'{greeting} Filing {len(targets)} support requests for *{subject}*, {len(done)} done:'
+        else:
+            filed = sum(1 for t in done if t.result['success'])
+            header = f'{greeting} Filed {filed} of {len(targets)} support requests for *{subject}*:'
+        lines = [header]
+        for target in targets:
+            if target.result is None:
+                lines.append(f'• :hourglass_flowing_sand: {target.label}')
+            elif target.result['success']:
+                attachments = target.result.get('attachments')
+                files = f', {attachments} file(s) attached' if attachments else ''
+                lines.append(f"• :white_check_mark: <{target.result['url']}|{target.label}>{files}")
+            else:
+                lines.append(f'• :x: {target.label}, we had some trouble creating this one')
+        text = '\n'.join(lines)
+        return text, [{"type": "section", "text": {"type": "mrkdwn", "text": text}}]
+
+    def _post_progress(self, channel, user_id, targets, data, mention):
+        text, blocks = self._format_progress(user_id, targets, data, mention)
+        res = self._post(channel=channel, text=text, blocks=blocks)
+        if res is None:
+            return None
+        # A DM posted to a user id lands in the IM channel, updates need that
+        return res.get('channel', channel), res['ts']
+
+    def _update_progress(self, channel, ts, user_id, targets, data, mention):
+        text, blocks = self._format_progress(user_id, targets, data, mention)
+        try:
+            self.client.chat_update(channel=channel, ts=ts, text=text, blocks=blocks)
+        except Exception as e:
+            logger.exception("Exception in updating the ticket progress: %s", e)
+
+    def _post(self, **kwargs):
+        try:
+            return self.client.chat_postMessage(**kwargs)
+        except Exception as e:
+            logger.exception("Exception in posting the ticket progress: %s", e)
+            return None
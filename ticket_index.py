@@ -0,0 +1,96 @@
+import logging
+import re
+import time
+
+from sqlite_store import SQLiteStore
+
+logger = logging.getLogger(__name__)
+
+ticket_index_db_path = 'ticket_index.db'
+
+# Indexed columns come first, bm25 weights below follow their order
+TICKET_INDEX_SCHEMA = """
+    CREATE VIRTUAL TABLE IF NOT EXISTS tickets USING fts5(
+        subject,
+        details,
+        service,
+        classification,
+        resource,
+        ticket_name UNINDEXED,
+        service_id UNINDEXED,
+        url UNINDEXED,
+        filed_at UNINDEXED,
+        open UNINDEXED
+    );
+"""
+RANK_WEIGHTS = (5.0, 1.0, 2.0, 2.0, 2.0)
+
+_WORD = re.compile(r'\w+', re.UNICODE)
+# Words too common in tickets to tell them apart
+STOP_WORDS = frozenset((
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'but', 'by', 'can', 'for', 'from', 'has', 'have', 'i', 'in',
+    'is', 'it', 'not', 'of', 'on', 'or', 'our', 'that', 'the', 'this', 'to', 'was', 'we', 'when', 'with',
+))
+
+
+def get_match_query(text, max_words=12):
+    """FTS5 query matching any of the words of `text`, the last one also as
+    a prefix since it may still be typed."""
+    words = [w for w in _WORD.findall(text.lower()) if len(w) > 1 and w not in STOP_WORDS]
+    words = list(dict.fromkeys(words))[-max_words:]
+    if not words:
+        return None
+    terms = [f'"{w}"' for w in words]
+    if text[-1:].isalnum():
+        terms[-1] += '*'
+    return ' OR '.join(terms)
+
+
+class TicketIndex(SQLiteStore):
+    """SQLite FTS5 index of the tickets filed from Slack, searched for
+    similar open tickets while a new one is written.
+
+    Tickets are added as they are filed and closed as the ticket sync finds
+    them closed. Tickets never seen closed, such as those not synced, count
+    as open for `OPEN_DAYS`. Searches only query this index, never Azure.
+    """
+
+    OPEN_DAYS = 30
+    KEEP_DAYS = 365
+
+    SCHEMA = TICKET_INDEX_SCHEMA
+
+    def __init__(self, path=ticket_index_db_path):
+        super().__init__(path)
+
+    def add_ticket(self, ticket_name, subject, details, service_id, service, classification, resource, url,
+                   filed_at=None):
+        filed_at = time.time() if filed_at is None else filed_at
+        with self.lock, self.conn:
+            self.conn.execute('DELETE FROM tickets WHERE ticket_name = ?', (ticket_name,))
+            self.conn.execute(
+                'INSERT INTO tickets VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 1)',
+                (subject or '', details or '', service or '', classification or '', resource or '',
+                 ticket_name, service_id or '', url, filed_at))
+            # Forget tickets nobody will look for any more
+            self.conn.execute('DELETE FROM tickets WHERE filed_at < ?', (filed_at - self.KEEP_DAYS * 24 * 60 * 60,))
+
+    def close_ticket(self, ticket_name):
+        with self.lock, self.conn:
+            self.conn.execute('UPDATE tickets SET open = 0 WHERE ticket_name = ?', (ticket_name,))
+
+    def find_similar(self, text, service_id=None, limit=3, now=None):
+        """Returns the open tickets most similar to `text`, those of
+        `service_id` first, as dicts with subject, service, url and
+        filed_at."""
+        query = get_match_query(text)
+        if query is None:
+            return []
+        now = time.time() if now is None else now
+        with self.lock:
+            rows = self.conn.execute(
+                'SELECT subject, service, url, filed_at FROM tickets '
+                'WHERE tickets MATCH ? AND open = 1 AND filed_at >= ? '
+                f'ORDER BY service_id = ? DESC, bm25(tickets, {", ".join(map(str, RANK_WEIGHTS))}) LIMIT ?',
+                (query, now - self.OPEN_DAYS * 24 * 60 * 60, service_id or '', limit)).fetchall()
+        return [dict(zip(('subject', 'service', 'url', 'filed_at'), r)) for r in rows]
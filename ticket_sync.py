@@ -0,0 +1,297 @@
+import html
+import logging
+import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import TYPE_CHECKING
+
+from slack_sdk import WebClient
+from helpers import escape_mrkdwn
+from lazy_imports import lazy_import
+from metrics import AZURE_CLIENT_KWARGS
+from sqlite_store import SQLiteStore
+from ticket_index import TicketIndex
+
+if TYPE_CHECKING:
+    from azure.identity import ChainedTokenCredential
+
+MicrosoftSupport = lazy_import('azure.mgmt.support', 'MicrosoftSupport')
+CommunicationDetails = lazy_import('azure.mgmt.support.models', 'CommunicationDetails')
+
+logger = logging.getLogger(__name__)
+
+ticket_sync_db_path = 'ticket_sync.db'
+
+TICKET_SYNC_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS tickets (
+        ticket_name TEXT PRIMARY KEY,
+        subscription_id TEXT NOT NULL,
+        channel TEXT NOT NULL,
+        thread_ts TEXT NOT NULL,
+        watermark TEXT NOT NULL,
+        created_at TEXT NOT NULL,
+        open INTEGER NOT NULL DEFAULT 1
+    );
+    CREATE UNIQUE INDEX IF NOT EXISTS tickets_thread
+        ON tickets (channel, thread_ts);
+    CREATE TABLE IF NOT EXISTS communications (
+        ticket_name TEXT NOT NULL,
+        communication_name TEXT NOT NULL,
+        PRIMARY KEY (ticket_name, communication_name)
+    );
+"""
+
+
+class TicketSyncStore(SQLiteStore):
+    """SQLite backed bookkeeping of synced tickets.
+
+    Each ticket keeps a watermark (createdDate of the newest communication
+    already mirrored) so a poll only asks Azure for the delta, plus the set of
+    communication names seen at or after that watermark to drop duplicates.
+    Names the watermark has passed are dropped from that set.
+    """
+
+    SCHEMA = TICKET_SYNC_SCHEMA
+
+    def __init__(self, path=ticket_sync_db_path):
+        super().__init__(path)
+
+    def add_ticket(self, ticket_name, subscription_id, channel, thread_ts, created_at):
+        with self.lock, self.conn:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO tickets VALUES (?, ?, ?, ?, ?, ?, 1)',
+                (ticket_name, subscription_id, channel, thread_ts, created_at, created_at))
+
+    def get_open_tickets(self):
+        with self.lock:
+            rows = self.conn.execute(
+                'SELECT ticket_name, subscription_id, channel, thread_ts, watermark, created_at '
+                'FROM tickets WHERE open = 1').fetchall()
+        keys = ('ticket_name', 'subscription_id', 'channel', 'thread_ts', 'watermark', 'created_at')
+        return [dict(zip(keys, r)) for r in rows]
+
+    def get_ticket_by_thread(self, channel, thread_ts):
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT ticket_name, subscription_id FROM tickets '
+                'WHERE channel = ? AND thread_ts = ? AND open = 1',
+                (channel, thread_ts)).fetchone()
+        return {'ticket_name': row[0], 'subscription_id': row[1]} if row else None
+
+    def close_ticket(self, ticket_name):
+        with self.lock, self.conn:
+            self.conn.execute('UPDATE tickets SET open = 0 WHERE ticket_name = ?', (ticket_name,))
+            self.conn.execute('DELETE FROM communications WHERE ticket_name = ?', (ticket_name,))
+
+    def set_watermark(self, ticket_name, watermark):
+        with self.lock, self.conn:
+            self.conn.execute(
+                'UPDATE tickets SET watermark = ? WHERE ticket_name = ? AND watermark < ?',
+                (watermark, ticket_name, watermark))
+
+    def mark_communication(self, ticket_name, communication_name):
+        """Record a communication, returns False if it was already known."""
+        with self.lock, self.conn:
+            cur = self.conn.execute(
+                'INSERT OR IGNORE INTO communications VALUES (?, ?)',
+                (ticket_name, communication_name))
+            return cur.rowcount == 1
+
+    def unmark_communication(self, ticket_name, communication_name):
+        with self.lock, self.conn:
+            self.conn.execute(
+                'DELETE FROM communications WHERE ticket_name = ? AND communication_name = ?',
+                (ticket_name, communication_name))
+
+    def forget_communications(self, ticket_name, communication_names):
+        """Drop communications from the seen set once the watermark has
+        passed them."""
+        with self.lock, self.conn:
+            self.conn.executemany(
+                'DELETE FROM communications WHERE ticket_name = ? AND communication_name = ?',
+                [(ticket_name, name) for name in communication_names])
+
+
+class TicketSyncEngine:
+    """Mirrors Azure support communications into the ticket's Slack thread
+    and posts Slack thread replies back as communications."""
+
+    POLL_INTERVAL = 120
+    MAX_WORKERS = 8
+
+    def __init__(self, credentials: 'ChainedTokenCredential', client: WebClient, store: TicketSyncStore = None,
+                 poll_interval=POLL_INTERVAL, max_workers=MAX_WORKERS, ticket_index: TicketIndex = None):
+        self.credentials = credentials
+        self.client = client
+        self.store = store if store is not None else TicketSyncStore()
+        self.ticket_index = ticket_index
+        self.poll_interval = poll_interval
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='ticket-sync')
+        self.reply_queues = {}
+        self.reply_lock = threading.Lock()
+
+    def start(self):
+        threading.Thread(target=self._poll_forever, daemon=True).start()
+
+    @staticmethod
+    def _format_watermark(dt: datetime):
+        return dt.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+    @staticmethod
+    def _html_to_mrkdwn(body):
+        text = re.sub(r'<br\s*/?>|</p>|</div>', '\n', body or '', flags=re.IGNORECASE)
+        text = re.sub(r'<[^>]+>', '', text)
+        # Entities in the reply must not turn into Slack mentions or links
+        return escape_mrkdwn(html.unescape(text)).strip()
+
+    def register_ticket(self, ticket_name, subscription_id, channel, thread_ts):
+        created_at = self._format_watermark(datetime.now(timezone.utc))
+        self.store.add_ticket(ticket_name, subscription_id, channel, thread_ts, created_at)
+        logger.info('Ticket %s registered for sync in %s/%s', ticket_name, channel, thread_ts)
+
+    # Azure -> Slack
+
+    def _poll_forever(self):
+        while True:
+            try:
+                self.poll_once()
+            except Exception as e:
+                logger.exception('Exception in ticket sync poll: %s', e)
+            time.sleep(self.poll_interval)
+
+    def poll_once(self):
+        by_subscription = {}
+        for ticket in self.store.get_open_tickets():
+            by_subscription.setdefault(ticket['subscription_id'], []).append(ticket)
+
+        futures = []
+        for subscription_id, tickets in by_subscription.items():
+            support_client = MicrosoftSupport(self.credentials, subscription_id, **AZURE_CLIENT_KWARGS)
+            for ticket in self._filter_still_open(support_client, tickets):
+                futures.append(self.executor.submit(self._sync_ticket, support_client, ticket))
+
+        for future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                logger.exception('Exception in ticket sync: %s', e)
+
+    def _filter_still_open(self, support_client, tickets):
+        # One paged call per subscription instead of one GET per ticket.
+        oldest = min(t['created_at'] for t in tickets)
+        try:
+            open_names = {
+                t.name for t in support_client.support_tickets.list(
+                    filter=f"status eq 'Open' and createdDate ge {oldest[:10]}T00:00:00Z")
+            }
+        except Exception as e:
+            logger.info('Could not list open tickets, polling all: %s', e)
+            return tickets
+
+        still_open = []
+        for ticket in tickets:
+            if ticket['ticket_name'] in open_names:
+                still_open.append(ticket)
+            else:
+                logger.info('Ticket %s closed, stopping sync', ticket['ticket_name'])
+                self.store.close_ticket(ticket['ticket_name'])
+                if self.ticket_index is not None:
+                    self.ticket_index.close_ticket(ticket['ticket_name'])
+        return still_open
+
+    def _sync_ticket(self, support_client, ticket):
+        ticket_name = ticket['ticket_name']
+        communications = sorted(
+            support_client.communications.list(
+                ticket_name, filter=f"createdDate ge {ticket['watermark']}"),
+            key=lambda c: c.created_date)
+
+        watermark = ticket['watermark']
+        for c in communications:
+            created = self._format_watermark(c.created_date)
+            if created < ticket['watermark']:
+                # Mirrored by an earlier poll, and no longer in the seen set
+                continue
+            if self.store.mark_communication(ticket_name, c.name):
+                text = f"*{c.subject}*\n{self._html_to_mrkdwn(c.body)}"
+                try:
+                    self.client.chat_postMessage(
+                        text=text,
+                        channel=ticket['channel'],
+                        thread_ts=ticket['thread_ts'],
+                        blocks=[{"type": "section", "text": {"type": "mrkdwn", "text": text[:3000]}}]
+                    )
+                except Exception:
+                    # Posted by the next poll, later ones wait to keep the order
+                    self.store.unmark_communication(ticket_name, c.name)
+                    raise
+            # Replies posted from Slack move the watermark too, they are
+            # in the seen set already
+            self.store.set_watermark(ticket_name, created)
+            watermark = max(watermark, created)
+
+        # Communications older than the watermark are not listed again
+        self.store.forget_communications(
+            ticket_name, [c.name for c in communications if self._format_watermark(c.created_date) < watermark])
+
+    # Slack -> Azure
+
+    def handle_thread_reply(self, event):
+        thread_ts = event.get('thread_ts')
+        if not thread_ts or thread_ts == event.get('ts') or event.get('bot_id') or event.get('subtype'):
+            return False
+
+        ticket = self.store.get_ticket_by_thread(event.get('channel'), thread_ts)
+        if not ticket:
+            return False
+
+        # Replies for one ticket are drained by a single task so they reach
+        # Azure in the order Slack delivered them.
+        ticket_name = ticket['ticket_name']
+        with self.reply_lock:
+            queue = self.reply_queues.get(ticket_name)
+            start_drain = queue is None
+            if start_drain:
+                queue = self.reply_queues[ticket_name] = deque()
+            queue.append((ticket, event))
+        if start_drain:
+            self.executor.submit(self._drain_replies, ticket_name)
+        return True
+
+    def _drain_replies(self, ticket_name):
+        while True:
+            with self.reply_lock:
+                queue = self.reply_queues[ticket_name]
+                if not queue:
+                    del self.reply_queues[ticket_name]
+                    return
+                ticket, event = queue.popleft()
+            try:
+                self._post_reply(ticket, event)
+            except Exception as e:
+                logger.exception('Exception in posting thread reply to %s: %s', ticket_name, e)
+
+    def _post_reply(self, ticket, event):
+        ticket_name = ticket['ticket_name']
+        # Slack ts is unique per channel, so redelivered events map to the
+        # same communication name and are dropped here.
+        communication_name = f"slack-{event['ts'].replace('.', '-')}"
+        if not self.store.mark_communication(ticket_name, communication_name):
+            return
+
+        try:
+            MicrosoftSupport(self.credentials, ticket['subscription_id'], **AZURE_CLIENT_KWARGS).communications.begin_create(
+                support_ticket_name=ticket_name,
+                communication_name=communication_name,
+                create_communication_parameters=CommunicationDetails(
+                    subject=f"Reply from Slack user {event.get('user')}",
+                    body=event.get('text', '')
+                )
+            ).result()
+            logger.info('Posted Slack reply %s to ticket %s', communication_name, ticket_name)
+        except Exception:
+            self.store.unmark_communication(ticket_name, communication_name)
+            raise
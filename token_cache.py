@@ -0,0 +1,204 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+from azure.core.credentials import AccessToken, AccessTokenInfo
+
+from metrics import CACHE_REQUESTS, register_cache
+from workspaces import get_partition_name
+from tracing import start_span
+
+try:
+    import fcntl
+except ImportError:  # Windows, the file cache then works without locking
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+ARM_SCOPE = 'https://management.azure.com/.default'
+
+
+def _get_cache_key(scopes, tenant_id, enable_cae):
+    return f"{' '.join(scopes)}|{tenant_id or ''}|{'cae' if enable_cae else ''}"
+
+
+class TokenFileCache:
+    """Access tokens shared between the workers of one host through a JSON
+    file readable by the current user only."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock_path = f'{path}.lock'
+
+    @contextmanager
+    def locked(self):
+        fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            if fcntl:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+    def read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def write(self, data):
+        # mkstemp creates the file with 0600, os.replace swaps it in atomically
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)), prefix='.token-cache')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.path)
+
+
+class CachingCredential:
+    """Token credential serving cached tokens per scope.
+
+    Tokens are refreshed by a background thread well before they expire, so
+    Azure SDK clients created on the request path get a token from memory.
+    For chained credentials (DefaultAzureCredential) the member that succeeded
+    is remembered and tried first instead of probing the whole chain again.
+    """
+
+    REFRESH_MARGIN = 600
+    MIN_VALIDITY = 60
+    RETRY_INTERVAL = 30
+    MAX_SLEEP = 300
+
+    def __init__(self, credential, file_cache: TokenFileCache = None, cache_partition=None):
+        self._credential = credential
+        self.file_cache = file_cache
+        # Workspace whose cache partitions the Azure calls made with this fill
+        self.cache_partition = cache_partition
+        self.tokens = {}
+        self.requests = {}
+        self.fetch_locks = {}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.preferred_credential = file_cache.read().get('credential') if file_cache else None
+        self.cache_name = get_partition_name('azure_token', cache_partition)
+        register_cache(self.cache_name, self.tokens)
+
+    def start(self):
+        threading.Thread(target=self._refresh_forever, daemon=True).start()
+
+    def get_token(self, *scopes, claims=None, tenant_id=None, enable_cae=False, **kwargs):
+        if claims:
+            # A claims challenge always needs a new token
+            return self._credential.get_token(
+                *scopes, claims=claims, tenant_id=tenant_id, enable_cae=enable_cae, **kwargs)
+
+        key = _get_cache_key(scopes, tenant_id, enable_cae)
+        token = self.tokens.get(key)
+        if token is not None and token.expires_on - time.time() > self.MIN_VALIDITY:
+            CACHE_REQUESTS.inc(self.cache_name, 'hit')
+            return token
+        CACHE_REQUESTS.inc(self.cache_name, 'miss')
+        return self._refresh(key, scopes, tenant_id, enable_cae, self.MIN_VALIDITY)
+
+    def get_token_info(self, *scopes, options=None):
+        options = options or {}
+        token = self.get_token(
+            *scopes,
+            claims=options.get('claims'),
+            tenant_id=options.get('tenant_id'),
+            enable_cae=options.get('enable_cae', False))
+        return AccessTokenInfo(token.token, token.expires_on, refresh_on=token.expires_on - self.REFRESH_MARGIN)
+
+    def _get_fetch_lock(self, key):
+        with self.lock:
+            return self.fetch_locks.setdefault(key, threading.Lock())
+
+    def _refresh(self, key, scopes, tenant_id, enable_cae, min_validity):
+        # One fetch per scope at a time, in this process and, with a file
+        # cache, across all workers of the host.
+        with self._get_fetch_lock(key):
+            token = self.tokens.get(key)
+            if token is None or token.expires_on - time.time() <= min_validity:
+                if self.file_cache is None:
+                    token = self._fetch(scopes, tenant_id, enable_cae)
+                else:
+                    token = self._refresh_through_file(key, scopes, tenant_id, enable_cae, min_validity)
+                self.tokens[key] = token
+            self.requests[key] = (scopes, tenant_id, enable_cae)
+        self.wakeup.set()
+        return token
+
+    def _refresh_through_file(self, key, scopes, tenant_id, enable_cae, min_validity):
+        with self.file_cache.locked():
+            data = self.file_cache.read()
+            cached = data.get('tokens', {}).get(key)
+            if cached and cached['expires_on'] - time.time() > min_validity:
+                return AccessToken(cached['token'], cached['expires_on'])
+
+            self.preferred_credential = self.preferred_credential or data.get('credential')
+            token = self._fetch(scopes, tenant_id, enable_cae)
+            now = time.time()
+            tokens = {k: v for k, v in data.get('tokens', {}).items() if v['expires_on'] > now}
+            tokens[key] = {'token': token.token, 'expires_on': token.expires_on}
+            self.file_cache.write({'credential': self.preferred_credential, 'tokens': tokens})
+            return token
+
+    def _get_chain_member(self, name):
+        for credential in getattr(self._credential, 'credentials', None) or ():
+            if type(credential).__name__ == name:
+                return credential
+        return None
+
+    def _fetch(self, scopes, tenant_id, enable_cae):
+        member = self._get_chain_member(self.preferred_credential) if self.preferred_credential else None
+        if member is not None:
+            try:
+                with start_span('azure.get_token', scopes=' '.join(scopes), credential=self.preferred_credential):
+                    return member.get_token(*scopes, tenant_id=tenant_id, enable_cae=enable_cae)
+            except Exception as e:
+                logger.info('%s failed to get a token, trying the full chain: %s', self.preferred_credential, e)
+
+        token = self._credential.get_token(*scopes, tenant_id=tenant_id, enable_cae=enable_cae)
+        successful = getattr(self._credential, '_successful_credential', None)
+        if successful is not None:
+            self.preferred_credential = type(successful).__name__
+        return token
+
+    def refresh_due_tokens(self):
+        """Refreshes the tokens close to expiry, returns the seconds until the
+        next one is due."""
+        next_due = self.MAX_SLEEP
+        for key, (scopes, tenant_id, enable_cae) in list(self.requests.items()):
+            token = self.tokens.get(key)
+            # A token invalidated through diagnostics is fetched again now
+            due_in = token.expires_on - time.time() - self.REFRESH_MARGIN if token is not None else 0
+            if due_in <= 0:
+                try:
+                    token = self._refresh(key, scopes, tenant_id, enable_cae, self.REFRESH_MARGIN)
+                    due_in = token.expires_on - time.time() - self.REFRESH_MARGIN
+                except Exception as e:
+                    logger.warning('Failed to refresh the Azure token for %s: %s', scopes, e)
+                    due_in = 0
+                if due_in <= 0:
+                    due_in = self.RETRY_INTERVAL
+            next_due = min(next_due, due_in)
+        return next_due
+
+    def _refresh_forever(self):
+        while True:
+            self.wakeup.clear()
+            try:
+                next_due = self.refresh_due_tokens()
+            except Exception as e:
+                logger.exception('Exception in refreshing the Azure tokens: %s', e)
+                next_due = self.RETRY_INTERVAL
+            self.wakeup.wait(next_due)
+
+    def __getattr__(self, name):
+        return getattr(self._credential, name)
@@ -0,0 +1,315 @@
+import contextvars
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+import urllib.request
+from contextlib import contextmanager
+from functools import wraps
+
+from azure.core.pipeline.policies import SansIOHTTPPolicy
+
+logger = logging.getLogger(__name__)
+
+SERVICE_NAME = 'azure-support-slack-bot'
+
+_current_span = contextvars.ContextVar('current_span', default=None)
+_current_request = contextvars.ContextVar('current_request', default=None)
+
+
+class Span:
+
+    __slots__ = ('trace_id', 'span_id', 'parent_id', 'name', 'sampled', 'start_ns', 'end_ns',
+                 'attributes', 'error')
+
+    def __init__(self, name, trace_id, parent_id, sampled):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = f'{random.getrandbits(64):016x}'
+        self.parent_id = parent_id
+        self.sampled = sampled
+        self.start_ns = time.time_ns() if sampled else 0
+        self.end_ns = 0
+        self.attributes = {}
+        self.error = None
+
+    def set_attribute(self, key, value):
+        if self.sampled:
+            self.attributes[key] = value
+
+    def to_otlp(self):
+        span = {
+            'traceId': self.trace_id,
+            'spanId': self.span_id,
+            'name': self.name,
+            'kind': 1,
+            'startTimeUnixNano': str(self.start_ns),
+            'endTimeUnixNano': str(self.end_ns),
+            'attributes': [_to_otlp_attribute(k, v) for k, v in self.attributes.items()],
+            'status': {'code': 2, 'message': self.error} if self.error else {'code': 0},
+        }
+        if self.parent_id:
+            span['parentSpanId'] = self.parent_id
+        return span
+
+
+def _to_otlp_attribute(key, value):
+    if isinstance(value, bool):
+        return {'key': key, 'value': {'boolValue': value}}
+    if isinstance(value, int):
+        return {'key': key, 'value': {'intValue': str(value)}}
+    if isinstance(value, float):
+        return {'key': key, 'value': {'doubleValue': value}}
+    return {'key': key, 'value': {'stringValue': str(value)}}
+
+
+def to_otlp_payload(spans):
+    return {
+        'resourceSpans': [{
+            'resource': {'attributes': [_to_otlp_attribute('service.name', SERVICE_NAME)]},
+            'scopeSpans': [{'scope': {'name': SERVICE_NAME}, 'spans': [s.to_otlp() for s in spans]}]
+        }]
+    }
+
+
+class FileSpanExporter:
+    """Appends one OTLP/JSON payload per batch, the format read by the
+    collector's file receiver."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def export(self, spans):
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(to_otlp_payload(spans)) + '\n')
+
+
+class OtlpHttpSpanExporter:
+
+    def __init__(self, endpoint):
+        self.url = endpoint.rstrip('/') + '/v1/traces'
+
+    def export(self, spans):
+        request = urllib.request.Request(
+            self.url,
+            data=json.dumps(to_otlp_payload(spans)).encode('utf-8'),
+            headers={'Content-Type': 'application/json'})
+        urllib.request.urlopen(request, timeout=5).close()
+
+
+class BatchSpanProcessor:
+    """Hands finished spans to the exporter from a background thread. When the
+    queue is full spans are dropped rather than blocking the request."""
+
+    MAX_QUEUE_SIZE = 2048
+    MAX_BATCH_SIZE = 512
+    EXPORT_INTERVAL = 2
+
+    def __init__(self, exporter):
+        self.exporter = exporter
+        self.queue = queue.Queue(maxsize=self.MAX_QUEUE_SIZE)
+        self.dropped = 0
+        threading.Thread(target=self._export_forever, daemon=True).start()
+
+    def on_end(self, span):
+        try:
+            self.queue.put_nowait(span)
+        except queue.Full:
+            self.dropped += 1
+
+    def _export_forever(self):
+        while True:
+            batch = []
+            deadline = time.monotonic() + self.EXPORT_INTERVAL
+            while len(batch) < self.MAX_BATCH_SIZE:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            if batch:
+                self.export(batch)
+
+    def export(self, batch):
+        try:
+            self.exporter.export(batch)
+        except Exception as e:
+            logger.info('Span export failed, dropped %s spans: %s', len(batch), e)
+
+
+class Tracer:
+
+    def __init__(self, processor=None, sample_ratio=1.0):
+        self.processor = processor
+        self.sample_ratio = sample_ratio
+
+    @property
+    def enabled(self):
+        return self.processor is not None
+
+    @contextmanager
+    def start_span(self, name, **attributes):
+        parent = _current_span.get()
+        if not self.enabled or (parent is not None and not parent.sampled):
+            yield _NOOP_SPAN
+            return
+
+        if parent is None:
+            # Head sampling: children follow the root's decision
+            sampled = random.random() < self.sample_ratio
+            span = Span(name, f'{random.getrandbits(128):032x}', None, sampled)
+        else:
+            span = Span(name, parent.trace_id, parent.span_id, True)
+
+        token = _current_span.set(span)
+        try:
+            if span.sampled:
+                span.attributes.update(attributes)
+            yield span
+        except BaseException as e:
+            span.error = f'{type(e).__name__}: {e}'
+            raise
+        finally:
+            _current_span.reset(token)
+            if span.sampled:
+                span.end_ns = time.time_ns()
+                self.processor.on_end(span)
+
+
+_NOOP_SPAN = Span('noop', '0' * 32, None, False)
+
+tracer = Tracer()
+
+
+def configure_tracing(exporter=None, sample_ratio=1.0):
+    tracer.processor = BatchSpanProcessor(exporter) if exporter is not None else None
+    tracer.sample_ratio = sample_ratio
+
+
+def configure_tracing_from_env():
+    exporter_name = os.environ.get('TRACE_EXPORTER', 'none')
+    if exporter_name == 'file':
+        exporter = FileSpanExporter(os.environ.get('TRACE_FILE', 'traces.jsonl'))
+    elif exporter_name == 'otlp':
+        exporter = OtlpHttpSpanExporter(os.environ.get('OTEL_EXPORTER_OTLP_ENDPOINT', 'http://localhost:4318'))
+    else:
+        exporter = None
+    configure_tracing(exporter, float(os.environ.get('TRACE_SAMPLE_RATIO', 0.1)))
+
+
+def start_span(name, **attributes):
+    return tracer.start_span(name, **attributes)
+
+
+def traced(func):
+    name = func.__qualname__
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if not tracer.enabled:
+            return func(*args, **kwargs)
+        with tracer.start_span(name):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def submit_with_context(executor, fn, *args, **kwargs):
+    """executor.submit() that keeps the caller's current span as parent."""
+    ctx = contextvars.copy_context()
+    return executor.submit(ctx.run, fn, *args, **kwargs)
+
+
+def get_request_kind_and_id(body):
+    body_type = body.get('type')
+    if body_type == 'block_actions':
+        actions = body.get('actions') or [{}]
+        return 'action', actions[0].get('action_id', '')
+    if body_type == 'block_suggestion':
+        return 'options', body.get('action_id', '')
+    if body_type in ('view_submission', 'view_closed'):
+        return 'view', body.get('view', {}).get('callback_id', '')
+    if body_type in ('shortcut', 'message_action'):
+        return 'shortcut', body.get('callback_id', '')
+    if body_type == 'event_callback':
+        return 'event', body.get('event', {}).get('type', '')
+    if 'command' in body:
+        return 'command', body['command']
+    return 'other', body_type or ''
+
+
+def bolt_tracing_middleware(body, next):
+    # Bolt runs the listener only after the whole middleware chain returned,
+    # so the request is remembered here and its span is opened around the
+    # listener by run_listener().
+    _current_request.set(get_request_kind_and_id(body))
+    return next()
+
+
+def get_current_request():
+    """(kind, id) of the Slack request being handled, if any."""
+    return _current_request.get()
+
+
+def run_listener(fn, *args, **kwargs):
+    request = _current_request.get()
+    if request is None or not tracer.enabled:
+        return fn(*args, **kwargs)
+    kind, request_id = request
+    with tracer.start_span(f'slack.{kind} {request_id}', **{'slack.kind': kind, 'slack.id': request_id}):
+        return fn(*args, **kwargs)
+
+
+class AzureTracingPolicy(SansIOHTTPPolicy):
+
+    def on_request(self, request):
+        if not tracer.enabled:
+            return
+        # The span stays current while the rest of the pipeline runs, so
+        # token acquisition in the auth policy nests under it.
+        span_cm = tracer.start_span(
+            f'azure {request.http_request.method}',
+            **{'http.method': request.http_request.method, 'http.url': request.http_request.url.split('?')[0]})
+        request.context['tracing_span'] = (span_cm, span_cm.__enter__())
+
+    def _end(self, request, status=None, error=None):
+        if 'tracing_span' not in request.context:
+            return
+        span_cm, span = request.context['tracing_span']
+        del request.context['tracing_span']
+        if status is not None:
+            span.set_attribute('http.status_code', status)
+        if error and span.sampled:
+            span.error = error
+        span_cm.__exit__(None, None, None)
+
+    def on_response(self, request, response):
+        self._end(request, status=response.http_response.status_code)
+
+    def on_exception(self, request):
+        self._end(request, error='request failed')
+
+
+class TracedCredential:
+    """Wraps a token credential so token acquisition shows up as a span."""
+
+    def __init__(self, credential):
+        self._credential = credential
+
+    def get_token(self, *scopes, **kwargs):
+        with start_span('azure.get_token', scopes=' '.join(scopes)):
+            return self._credential.get_token(*scopes, **kwargs)
+
+    def __getattr__(self, name):
+        attr = getattr(self._credential, name)
+        if name != 'get_token_info':
+            return attr
+
+        def get_token_info(*scopes, **kwargs):
+            with start_span('azure.get_token', scopes=' '.join(scopes)):
+                return attr(*scopes, **kwargs)
+        return get_token_info
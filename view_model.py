@@ -0,0 +1,155 @@
+import itertools
+
+from serialization import decode_private_metadata, encode_private_metadata
+
+# View properties sent back with every update, next to the blocks and the
+# private_metadata
+RENDERED_PROPERTIES = ('type', 'callback_id', 'title', 'submit', 'close')
+
+
+class ModalView:
+    """A modal's blocks and state, parsed once per interaction.
+
+    Blocks are kept in a linked list indexed by block_id, so finding,
+    inserting next to, replacing and removing a block take the same time
+    however long the form gets. Changes made through these methods and to
+    `private_metadata` mark the view dirty; `render` builds the view dict
+    once, and a view that did not change needs no `views_update`.
+
+    Blocks returned by `get` are for reading, changes to them are not
+    tracked.
+    """
+
+    def __init__(self, blocks=(), private_metadata=None, properties=None, view_id=None, view_hash=None):
+        self.private_metadata = private_metadata if private_metadata is not None else {}
+        self.properties = properties or {}
+        self.view_id = view_id
+        self.view_hash = view_hash
+        self._blocks = {}
+        # Circular list with None as the head
+        self._next = {None: None}
+        self._prev = {None: None}
+        self._anonymous_keys = itertools.count()
+        for block in blocks:
+            self._link(self._prev[None], block)
+        self._blocks_changed = False
+        # None for a view not opened yet, always rendered
+        self._rendered_private_metadata = None
+
+    @classmethod
+    def from_body(cls, body, private_metadata=None):
+        """Parses the view of an interaction payload. `private_metadata`
+        replaces the view's own when the caller already decoded it."""
+        view = body['view']
+        encoded = view.get('private_metadata')
+        instance = cls(
+            view.get('blocks', ()),
+            private_metadata if private_metadata is not None else decode_private_metadata(encoded),
+            {k: view[k] for k in RENDERED_PROPERTIES if view.get(k) is not None},
+            view.get('id'),
+            view.get('hash'))
+        instance._rendered_private_metadata = encoded or ''
+        return instance
+
+    def _get_key(self, block):
+        # Slack gives every block of an opened view a block_id, blocks
+        # loaded from the templates may have none
+        block_id = block.get('block_id')
+        return block_id if block_id is not None else ('anonymous', next(self._anonymous_keys))
+
+    def _link(self, prev_key, block):
+        key = self._get_key(block)
+        if key in self._blocks:
+            raise ValueError(f'Duplicate block_id {key!r}')
+        next_key = self._next[prev_key]
+        self._blocks[key] = block
+        self._prev[key], self._next[key] = prev_key, next_key
+        self._next[prev_key] = self._prev[next_key] = key
+        self._blocks_changed = True
+        return key
+
+    def _unlink(self, key):
+        prev_key, next_key = self._prev.pop(key), self._next.pop(key)
+        self._next[prev_key], self._prev[next_key] = next_key, prev_key
+        self._blocks_changed = True
+        return self._blocks.pop(key)
+
+    def __contains__(self, block_id):
+        return block_id in self._blocks
+
+    def __len__(self):
+        return len(self._blocks)
+
+    def __iter__(self):
+        key = self._next[None]
+        while key is not None:
+            yield self._blocks[key]
+            key = self._next[key]
+
+    @property
+    def blocks(self):
+        return list(self)
+
+    def get(self, block_id):
+        return self._blocks.get(block_id)
+
+    def append(self, *blocks):
+        for block in blocks:
+            self._link(self._prev[None], block)
+
+    def insert_after(self, block_id, *blocks):
+        """Inserts `blocks` after the block `block_id`, KeyError if there is
+        none."""
+        if block_id not in self._blocks:
+            raise KeyError(block_id)
+        key = block_id
+        for block in blocks:
+            key = self._link(key, block)
+
+    def replace(self, block_id, block):
+        """Puts `block` in place of the block `block_id`, KeyError if there
+        is none. An equal block leaves the view unchanged."""
+        old = self._blocks[block_id]
+        if block == old:
+            return
+        key = self._get_key(block)
+        if key != block_id and key in self._blocks:
+            raise ValueError(f'Duplicate block_id {key!r}')
+        prev_key = self._prev[block_id]
+        self._unlink(block_id)
+        self._link(prev_key, block)
+
+    def upsert(self, block):
+        """Replaces the block with the same block_id, or appends `block`."""
+        block_id = block.get('block_id')
+        if block_id in self._blocks:
+            self.replace(block_id, block)
+        else:
+            self.append(block)
+
+    def remove(self, block_id):
+        """Removes the block `block_id` and returns it, None if there is
+        none."""
+        if block_id not in self._blocks:
+            return None
+        return self._unlink(block_id)
+
+    def set_initial_value(self, block_id, value):
+        """Sets the initial value of the input block `block_id`, if any."""
+        block = self._blocks.get(block_id)
+        if block is None or block['element'].get('initial_value') == value:
+            return
+        block['element']['initial_value'] = value
+        self._blocks_changed = True
+
+    @property
+    def is_dirty(self):
+        return (self._blocks_changed
+                or encode_private_metadata(self.private_metadata) != self._rendered_private_metadata)
+
+    def render(self):
+        """Returns the view to open or update, and marks it clean."""
+        encoded = encode_private_metadata(self.private_metadata)
+        self._blocks_changed = False
+        self._rendered_private_metadata = encoded
+        return dict(self.properties, private_metadata=encoded, blocks=self.blocks)
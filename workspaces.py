@@ -0,0 +1,149 @@
+import json
+import logging
+import os
+import threading
+from collections.abc import MutableMapping
+from contextvars import ContextVar
+
+from slack_sdk.oauth.installation_store import Bot, Installation, InstallationStore
+
+logger = logging.getLogger(__name__)
+
+_current_team_id = ContextVar('current_team_id', default=None)
+
+# Cache memory per workspace, by cache partition
+_cache_quotas = {}
+
+
+class WorkspaceConfig:
+    """A Slack workspace served by this process and the Azure tenant its
+    tickets are filed in. Secrets are read from the environment variables
+    named in the configuration, never from the file itself."""
+
+    def __init__(self, team_id, bot_token, azure_tenant_id=None, azure_client_id=None, azure_client_secret=None,
+                 cache_quota_mb=None):
+        self.team_id = team_id
+        self.bot_token = bot_token
+        self.azure_tenant_id = azure_tenant_id
+        self.azure_client_id = azure_client_id
+        self.azure_client_secret = azure_client_secret
+        self.cache_quota_mb = cache_quota_mb
+
+    @classmethod
+    def from_dict(cls, team_id, data):
+        def from_env(key):
+            name = data.get(key)
+            if name and name not in os.environ:
+                raise ValueError(f'Workspace {team_id}: environment variable {name} is not set')
+            return os.environ[name] if name else None
+        return cls(
+            team_id,
+            from_env('bot_token_env'),
+            azure_tenant_id=data.get('azure_tenant_id'),
+            azure_client_id=data.get('azure_client_id'),
+            azure_client_secret=from_env('azure_client_secret_env'),
+            cache_quota_mb=data.get('cache_quota_mb'))
+
+
+def load_workspaces(path):
+    """Reads `{team_id: {...}}` from the JSON file at `path`."""
+    with open(path) as f:
+        data = json.load(f)
+    return [WorkspaceConfig.from_dict(team_id, config) for team_id, config in data.items()]
+
+
+class WorkspaceInstallationStore(InstallationStore):
+    """Bolt installation store over the configured workspaces. Installs are
+    provisioned through the workspaces file, not the OAuth flow."""
+
+    def __init__(self, workspaces):
+        self.workspaces = {w.team_id: w for w in workspaces}
+
+    @property
+    def logger(self):
+        return logger
+
+    def find_bot(self, *, enterprise_id, team_id, is_enterprise_install=False):
+        workspace = self.workspaces.get(team_id)
+        if workspace is None:
+            return None
+        return Bot(enterprise_id=enterprise_id, team_id=team_id, bot_token=workspace.bot_token,
+                   bot_id=None, bot_user_id=None, installed_at=0.0)
+
+    def find_installation(self, *, enterprise_id, team_id, user_id=None, is_enterprise_install=False):
+        bot = self.find_bot(enterprise_id=enterprise_id, team_id=team_id)
+        if bot is None:
+            return None
+        return Installation(enterprise_id=enterprise_id, team_id=team_id, user_id=user_id or '',
+                            bot_token=bot.bot_token, installed_at=0.0)
+
+
+def workspace_middleware(context, next):
+    # Like the tracing middleware, this runs before Bolt submits the
+    # listener, which inherits the context.
+    _current_team_id.set(context.team_id)
+    return next()
+
+
+def get_current_team_id():
+    return _current_team_id.get()
+
+
+def get_partition_name(name, partition):
+    """Name of the cache of a workspace, unchanged for the default one."""
+    return name if partition is None else f'{name}:{partition}'
+
+
+def set_cache_quota(partition, nbytes):
+    _cache_quotas[partition] = nbytes
+
+
+def get_cache_quota(partition, default):
+    return _cache_quotas.get(partition, default)
+
+
+class PartitionedCache(MutableMapping):
+    """Cache for `cachetools.cached` keeping a separate cache per workspace,
+    so a large tenant cannot evict the entries of another one.
+
+    The partition is the `cache_partition` of the credential passed as the
+    first argument of the cached function. `factory(partition)` creates the
+    cache of a partition on first use.
+    """
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.partitions = {}
+        self.lock = threading.Lock()
+
+    def get_partition(self, key):
+        partition = getattr(key[0], 'cache_partition', None) if key else None
+        if not isinstance(partition, str):
+            partition = None
+        cache = self.partitions.get(partition)
+        if cache is None:
+            with self.lock:
+                cache = self.partitions.get(partition)
+                if cache is None:
+                    cache = self.partitions[partition] = self.factory(partition)
+        return cache
+
+    def __getitem__(self, key):
+        return self.get_partition(key)[key]
+
+    def __setitem__(self, key, value):
+        self.get_partition(key)[key] = value
+
+    def __delitem__(self, key):
+        del self.get_partition(key)[key]
+
+    def __iter__(self):
+        for cache in list(self.partitions.values()):
+            yield from list(cache)
+
+    def __len__(self):
+        return sum(len(cache) for cache in list(self.partitions.values()))
+
+    def clear(self):
+        for cache in list(self.partitions.values()):
+            cache.clear()
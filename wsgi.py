@@ -0,0 +1,27 @@
+from slack_bolt.adapter.wsgi import SlackRequestHandler
+
+import app as bot
+from metrics import render_metrics
+
+slack_handler = SlackRequestHandler(bot.create_app())
+
+
+def _respond(start_response, status, body, content_type='text/plain; charset=utf-8'):
+    payload = body.encode('utf-8')
+    start_response(status, [('Content-Type', content_type), ('Content-Length', str(len(payload)))])
+    return [payload]
+
+
+def application(environ, start_response):
+    path = environ.get('PATH_INFO', '')
+    if path == '/healthz':
+        return _respond(start_response, '200 OK', 'ok')
+    if path == '/readyz':
+        if bot.is_ready():
+            return _respond(start_response, '200 OK', 'ready')
+        return _respond(start_response, '503 Service Unavailable', 'not ready')
+    if path == '/metrics':
+        # All workers when METRICS_DIR is set, as gunicorn.conf.py does,
+        # else the worker that served the scrape
+        return _respond(start_response, '200 OK', render_metrics(), 'text/plain; version=0.0.4; charset=utf-8')
+    return slack_handler(environ, start_response)